@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 06:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querylog',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,79 @@
+from django.db import migrations
+
+# External-content FTS5 index over QueryLog: the text lives only in
+# authentication_querylog, and the triggers keep the index in step with
+# every insert, update and delete, including bulk and raw SQL writes.
+# user_id is indexed so a user's rows are found from the index itself.
+#
+# A SQLite table rebuild (AlterField and friends) drops the triggers with
+# the old table; query_engine recreates any that are missing after each
+# migrate, from TRIGGER_STATEMENTS below.
+TABLE_STATEMENT = """
+    CREATE VIRTUAL TABLE authentication_querylog_search USING fts5(
+        natural_language_query, generated_sql, user_id,
+        content='authentication_querylog', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+"""
+
+TRIGGER_STATEMENTS = {
+    'authentication_querylog_search_insert': """
+    CREATE TRIGGER authentication_querylog_search_insert AFTER INSERT ON authentication_querylog BEGIN
+        INSERT INTO authentication_querylog_search (rowid, natural_language_query, generated_sql, user_id)
+        VALUES (new.id, new.natural_language_query, new.generated_sql, new.user_id);
+    END
+    """,
+    'authentication_querylog_search_delete': """
+    CREATE TRIGGER authentication_querylog_search_delete AFTER DELETE ON authentication_querylog BEGIN
+        INSERT INTO authentication_querylog_search
+            (authentication_querylog_search, rowid, natural_language_query, generated_sql, user_id)
+        VALUES ('delete', old.id, old.natural_language_query, old.generated_sql, old.user_id);
+    END
+    """,
+    'authentication_querylog_search_update': """
+    CREATE TRIGGER authentication_querylog_search_update
+    AFTER UPDATE OF natural_language_query, generated_sql, user_id ON authentication_querylog BEGIN
+        INSERT INTO authentication_querylog_search
+            (authentication_querylog_search, rowid, natural_language_query, generated_sql, user_id)
+        VALUES ('delete', old.id, old.natural_language_query, old.generated_sql, old.user_id);
+        INSERT INTO authentication_querylog_search (rowid, natural_language_query, generated_sql, user_id)
+        VALUES (new.id, new.natural_language_query, new.generated_sql, new.user_id);
+    END
+    """,
+}
+
+# Re-reads every row from authentication_querylog
+REBUILD_STATEMENT = "INSERT INTO authentication_querylog_search (authentication_querylog_search) VALUES ('rebuild')"
+
+# The rebuild indexes the rows logged before this migration
+CREATE_STATEMENTS = [TABLE_STATEMENT, *TRIGGER_STATEMENTS.values(), REBUILD_STATEMENT]
+
+DROP_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS authentication_querylog_search_update",
+    "DROP TRIGGER IF EXISTS authentication_querylog_search_delete",
+    "DROP TRIGGER IF EXISTS authentication_querylog_search_insert",
+    "DROP TABLE IF EXISTS authentication_querylog_search",
+]
+
+
+class SQLiteRunSQL(migrations.RunSQL):
+    """RunSQL that is a no-op off SQLite: FTS5 is SQLite-only, and other backends fall back to substring search"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_querylog_stage_timings'),
+    ]
+
+    operations = [
+        SQLiteRunSQL(CREATE_STATEMENTS, reverse_sql=DROP_STATEMENTS),
+    ]
@@ -69,6 +69,7 @@ class QueryLog(models.Model):
     row_count = models.IntegerField(null=True, blank=True)
     success = models.BooleanField(default=True)
     error_message = models.TextField(blank=True, null=True)
+    stage_timings = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
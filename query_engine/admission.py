@@ -0,0 +1,200 @@
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from django.conf import settings
+
+
+class Throttled(Exception):
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Returns:
+            0 if a token was taken, otherwise the seconds until one is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate if self.rate else float('inf')
+
+
+class FairScheduler:
+    """
+    Global pool of execution slots with a bounded, per-user round-robin queue
+
+    When a slot frees up it is handed to the next waiting user in turn, so one
+    user with many queued requests cannot starve everyone else.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.active = 0
+        self._waiting = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, user_key, timeout):
+        with self._lock:
+            if self.active < self.slots and not self._waiting:
+                self.active += 1
+                return True
+            waiter = threading.Event()
+            self._waiting.setdefault(user_key, deque()).append(waiter)
+
+        if waiter.wait(timeout):
+            return True
+
+        with self._lock:
+            # The slot may have been handed over between the timeout and taking the lock
+            if waiter.is_set():
+                return True
+            queue = self._waiting.get(user_key)
+            if queue is not None:
+                queue.remove(waiter)
+                if not queue:
+                    del self._waiting[user_key]
+            return False
+
+    def release(self):
+        with self._lock:
+            if not self._waiting:
+                self.active -= 1
+                return
+            # Serve the user at the head, then move them to the back of the rotation
+            user_key, queue = next(iter(self._waiting.items()))
+            waiter = queue.popleft()
+            del self._waiting[user_key]
+            if queue:
+                self._waiting[user_key] = queue
+            # The slot passes straight to the waiter, so active is unchanged
+            waiter.set()
+
+
+class AdmissionController:
+    """
+    Admission control for execute requests, keyed on the user and their role
+
+    Each request spends one LLM token from both the user's bucket and the
+    role's shared bucket, must fit under the user's concurrency cap, and then
+    waits (boundedly) for a global execution slot. State is per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_buckets = {}
+        self._role_buckets = {}
+        self._in_flight = {}
+        self._scheduler = None
+
+    def limits_for(self, role_name):
+        limits = dict(getattr(settings, 'QUERY_ENGINE_DEFAULT_LIMITS', {}))
+        limits.update(getattr(settings, 'QUERY_ENGINE_ROLE_LIMITS', {}).get(role_name, {}))
+        return limits
+
+    def _bucket(self, buckets, key, per_minute, burst):
+        with self._lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(per_minute / 60.0, burst)
+                buckets[key] = bucket
+            return bucket
+
+    def _scheduler_instance(self):
+        with self._lock:
+            if self._scheduler is None:
+                self._scheduler = FairScheduler(getattr(settings, 'QUERY_ENGINE_MAX_CONCURRENT_EXECUTIONS', 8))
+            return self._scheduler
+
+    def _take_llm_token(self, user_key, role_name, limits):
+        wait = self._bucket(
+            self._user_buckets, user_key, limits['llm_per_minute'], limits['llm_burst']
+        ).take()
+        if wait:
+            raise Throttled('Query rate limit exceeded', 'user_rate', retry_after=wait)
+
+        if role_name and limits.get('role_llm_per_minute'):
+            wait = self._bucket(
+                self._role_buckets, role_name, limits['role_llm_per_minute'], limits['role_llm_burst']
+            ).take()
+            if wait:
+                raise Throttled('Query rate limit exceeded for this role', 'role_rate', retry_after=wait)
+
+    def max_concurrent(self, user):
+        """Requests (or background jobs) the user may have in flight at once"""
+        role_name = user.role.name if user.role_id else None
+        return self.limits_for(role_name).get('max_concurrent', 1)
+
+    def charge(self, user):
+        """
+        Spend an LLM token; called just before a request actually reaches the model
+
+        Raises:
+            Throttled: if the user or role bucket is empty
+        """
+        role_name = user.role.name if user.role_id else None
+        self._take_llm_token(user.pk, role_name, self.limits_for(role_name))
+
+    @contextmanager
+    def admit(self, user, timer=None):
+        """
+        Hold an execution slot for the duration of the block
+
+        LLM tokens are not taken here: answers from caches, templates and
+        earlier questions are free, so generate_sql charges the user only
+        when it calls the model.
+
+        Raises:
+            Throttled: if the user is over a limit or no slot frees up in time
+        """
+        role_name = user.role.name if user.role_id else None
+        limits = self.limits_for(role_name)
+
+        with self._lock:
+            in_flight = self._in_flight.get(user.pk, 0)
+            if in_flight >= limits.get('max_concurrent', 1):
+                raise Throttled('Too many queries in progress for this user', 'concurrency', retry_after=1)
+            self._in_flight[user.pk] = in_flight + 1
+
+        try:
+            scheduler = self._scheduler_instance()
+            timeout = getattr(settings, 'QUERY_ENGINE_QUEUE_TIMEOUT', 5)
+            started = time.perf_counter()
+            acquired = scheduler.acquire(user.pk, timeout)
+            if timer is not None:
+                timer.add('queue', time.perf_counter() - started)
+            if not acquired:
+                raise Throttled('Server is busy, please retry', 'queue_timeout', retry_after=timeout)
+            try:
+                yield
+            finally:
+                scheduler.release()
+        finally:
+            with self._lock:
+                self._in_flight[user.pk] -= 1
+                if not self._in_flight[user.pk]:
+                    del self._in_flight[user.pk]
+
+
+admission = AdmissionController()
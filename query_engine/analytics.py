@@ -0,0 +1,345 @@
+import bisect
+import json
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Max, Sum
+from django.utils import timezone
+from .metrics import LATENCY_BUCKETS
+from .models import QueryRollup, RollupState, StatementRollup
+from .sql_generator import sql_hash
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_STATE = 'query_log'
+
+# Report windows and the granularity of their trend series
+WINDOWS = {
+    '24h': (timedelta(hours=24), 'hour'),
+    '7d': (timedelta(days=7), 'day'),
+    '30d': (timedelta(days=30), 'day'),
+}
+
+PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+def empty_histogram():
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def merge_histograms(target, source):
+    for i, count in enumerate(source):
+        target[i] += count
+    return target
+
+
+def histogram_percentile(histogram, fraction, max_time):
+    """Estimate a latency percentile, interpolating linearly inside the bucket it falls in"""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for i, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else max(max_time, lower)
+            return round(min(lower + (upper - lower) * (rank - seen) / count, max_time), 3)
+        seen += count
+    return round(max_time, 3)
+
+
+def _absorb_batch(size):
+    """Fold the next QueryLog rows into the rollups; returns the number of rows absorbed"""
+    from authentication.models import QueryLog
+
+    with transaction.atomic():
+        state, _ = RollupState.objects.get_or_create(name=ROLLUP_STATE)
+        logs = list(
+            QueryLog.objects.filter(id__gt=state.last_id).order_by('id').values_list(
+                'id', 'user_id', 'database_name', 'natural_language_query', 'generated_sql',
+                'execution_time', 'row_count', 'success', 'error_message', 'created_at'
+            )[:size]
+        )
+        if not logs:
+            return 0
+        # Claim the rows first; a refresh that read the same watermark concurrently updates nothing
+        if not RollupState.objects.filter(pk=state.pk, last_id=state.last_id).update(last_id=logs[-1][0]):
+            return 0
+
+        hours, statements = {}, {}
+        for _, user_id, database_name, question, sql, seconds, row_count, success, error, created_at in logs:
+            bucket = created_at.replace(minute=0, second=0, microsecond=0)
+            hour = hours.get((bucket, database_name, user_id))
+            if hour is None:
+                hour = hours[bucket, database_name, user_id] = QueryRollup(
+                    bucket=bucket, database_name=database_name, user_id=user_id, latency_histogram=empty_histogram()
+                )
+            hour.queries += 1
+            hour.failures += not success
+            hour.rows += row_count or 0
+            if seconds is not None:
+                hour.total_time += seconds
+                hour.max_time = max(hour.max_time, seconds)
+                hour.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+            if not sql:
+                continue
+            key = (created_at.date(), database_name, sql_hash(sql, database_name))
+            statement = statements.get(key)
+            if statement is None:
+                statement = statements[key] = StatementRollup(
+                    day=key[0], database_name=database_name, sql_hash=key[2], sql=sql, sample_question=question,
+                    last_seen_at=created_at
+                )
+            statement.queries += 1
+            statement.failures += not success
+            statement.last_seen_at = created_at
+            if not success and error:
+                statement.last_error = error
+            if seconds is not None:
+                statement.timed_queries += 1
+                statement.total_time += seconds
+                statement.max_time = max(statement.max_time, seconds)
+
+        _merge_hours(hours)
+        _merge_statements(statements)
+    return len(logs)
+
+
+def _update_rows(model, fields, rollups):
+    """
+    Write back the given fields of existing rollups
+
+    One parameterized UPDATE run with executemany; bulk_update builds a
+    CASE expression per field that gets slow past a few hundred rows.
+    """
+    if not rollups:
+        return
+    assignments = ', '.join(f"{connection.ops.quote_name(field)} = %s" for field in fields)
+    values = []
+    for rollup in rollups:
+        row = [getattr(rollup, field) for field in fields]
+        values.append([json.dumps(value) if isinstance(value, list) else value for value in row] + [rollup.pk])
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"UPDATE {connection.ops.quote_name(model._meta.db_table)} SET {assignments} WHERE id = %s", values
+        )
+
+
+def _merge_hours(hours):
+    existing = QueryRollup.objects.filter(
+        bucket__in={key[0] for key in hours}, database_name__in={key[1] for key in hours}
+    )
+    updated = []
+    for rollup in existing:
+        new = hours.pop((rollup.bucket, rollup.database_name, rollup.user_id), None)
+        if new is None:
+            continue
+        rollup.queries += new.queries
+        rollup.failures += new.failures
+        rollup.rows += new.rows
+        rollup.total_time += new.total_time
+        rollup.max_time = max(rollup.max_time, new.max_time)
+        rollup.latency_histogram = merge_histograms(
+            rollup.latency_histogram or empty_histogram(), new.latency_histogram
+        )
+        updated.append(rollup)
+    _update_rows(QueryRollup, ['queries', 'failures', 'rows', 'total_time', 'max_time', 'latency_histogram'], updated)
+    QueryRollup.objects.bulk_create(hours.values())
+
+
+def _merge_statements(statements):
+    existing = StatementRollup.objects.filter(
+        day__in={key[0] for key in statements}, sql_hash__in={key[2] for key in statements}
+    )
+    updated = []
+    for rollup in existing:
+        new = statements.pop((rollup.day, rollup.database_name, rollup.sql_hash), None)
+        if new is None:
+            continue
+        rollup.queries += new.queries
+        rollup.failures += new.failures
+        rollup.timed_queries += new.timed_queries
+        rollup.total_time += new.total_time
+        rollup.max_time = max(rollup.max_time, new.max_time)
+        rollup.last_seen_at = new.last_seen_at
+        rollup.last_error = new.last_error or rollup.last_error
+        updated.append(rollup)
+    _update_rows(
+        StatementRollup,
+        ['queries', 'failures', 'timed_queries', 'total_time', 'max_time', 'last_seen_at', 'last_error'],
+        updated
+    )
+    StatementRollup.objects.bulk_create(statements.values())
+
+
+def refresh_rollups(max_rows=None):
+    """
+    Fold QueryLog rows logged since the last refresh into the rollups
+
+    Only rows past the stored watermark are read, so the cost follows the
+    number of new rows, not the size of the log. max_rows bounds the work
+    done by one call.
+
+    Returns:
+        Number of QueryLog rows absorbed
+    """
+    batch_size = getattr(settings, 'QUERY_ENGINE_ANALYTICS_BATCH_SIZE', 5000)
+    absorbed = 0
+    while max_rows is None or absorbed < max_rows:
+        size = batch_size if max_rows is None else min(batch_size, max_rows - absorbed)
+        try:
+            count = _absorb_batch(size)
+        except DatabaseError as e:
+            # SQLite refuses a second writer; the other refresh carries on
+            logger.info("Analytics rollup refresh deferred: %s", e)
+            break
+        if not count:
+            break
+        absorbed += count
+    return absorbed
+
+
+def pending_rows():
+    from authentication.models import QueryLog
+
+    state = RollupState.objects.filter(name=ROLLUP_STATE).first()
+    return QueryLog.objects.filter(id__gt=state.last_id if state else 0).count()
+
+
+def prune_rollups(days):
+    """Delete rollups older than the given number of days; returns the number of rows deleted"""
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = QueryRollup.objects.filter(bucket__lt=cutoff).delete()
+    statements, _ = StatementRollup.objects.filter(day__lt=cutoff.date()).delete()
+    return deleted + statements
+
+
+def _summary(queries, failures, total_time, max_time, histogram):
+    timed = sum(histogram)
+    summary = {
+        'queries': queries,
+        'failures': failures,
+        'failure_rate': round(failures / queries, 4) if queries else 0.0,
+        'avg_time': round(total_time / timed, 3) if timed else None,
+        'max_time': round(max_time, 3) if timed else None,
+    }
+    for label, fraction in PERCENTILES:
+        summary[label] = histogram_percentile(histogram, fraction, max_time)
+    return summary
+
+
+class _Totals:
+    def __init__(self):
+        self.queries = 0
+        self.failures = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = empty_histogram()
+
+    def add(self, queries, failures, rows, total_time, max_time, histogram):
+        self.queries += queries
+        self.failures += failures
+        self.rows += rows
+        self.total_time += total_time
+        self.max_time = max(self.max_time, max_time)
+        merge_histograms(self.histogram, histogram or ())
+
+    def summary(self):
+        return _summary(self.queries, self.failures, self.total_time, self.max_time, self.histogram)
+
+
+def _statements(since, database_name, order, limit, failing=False):
+    statements = StatementRollup.objects.filter(day__gte=since.date())
+    if database_name:
+        statements = statements.filter(database_name=database_name)
+    grouped = statements.values('database_name', 'sql_hash').annotate(
+        total_queries=Sum('queries'), total_failures=Sum('failures'), total_timed=Sum('timed_queries'),
+        time_sum=Sum('total_time'), slowest=Max('max_time'), sql_text=Max('sql'), question=Max('sample_question'),
+        last_seen=Max('last_seen_at')
+    )
+    if failing:
+        grouped = grouped.filter(total_failures__gt=0)
+    else:
+        grouped = grouped.filter(total_timed__gt=0).annotate(
+            average=ExpressionWrapper(F('time_sum') / F('total_timed'), output_field=FloatField())
+        )
+    top = list(grouped.order_by(*order)[:limit])
+
+    errors = {}
+    if failing and top:
+        latest = statements.filter(sql_hash__in=[row['sql_hash'] for row in top]).exclude(last_error='')
+        for sql_digest, error in latest.order_by('last_seen_at').values_list('sql_hash', 'last_error'):
+            errors[sql_digest] = error
+
+    return [{
+        'database': row['database_name'],
+        'sql': row['sql_text'],
+        'sample_question': row['question'],
+        'queries': row['total_queries'],
+        'failures': row['total_failures'],
+        'avg_time': round(row['time_sum'] / row['total_timed'], 3) if row['total_timed'] else None,
+        'max_time': round(row['slowest'], 3) if row['total_timed'] else None,
+        'last_seen_at': row['last_seen'].isoformat(),
+        **({'last_error': errors.get(row['sql_hash'])} if failing else {}),
+    } for row in top]
+
+
+def workload_report(window='24h', database_name=None, limit=10):
+    """
+    Workload analytics over a window, read from the rollups only
+
+    Hourly figures cover whole hours since the start of the window; the
+    statement lists cover whole days.
+    """
+    span, granularity = WINDOWS[window]
+    since = (timezone.now() - span).replace(minute=0, second=0, microsecond=0)
+
+    rollups = QueryRollup.objects.filter(bucket__gte=since)
+    if database_name:
+        rollups = rollups.filter(database_name=database_name)
+
+    overall = _Totals()
+    databases, users, points, user_points = {}, {}, {}, {}
+    for bucket, database, user_id, queries, failures, rows, total_time, max_time, histogram in rollups.values_list(
+        'bucket', 'database_name', 'user_id', 'queries', 'failures', 'rows', 'total_time', 'max_time',
+        'latency_histogram'
+    ):
+        values = (queries, failures, rows, total_time, max_time, histogram)
+        point = bucket if granularity == 'hour' else bucket.replace(hour=0)
+        overall.add(*values)
+        databases.setdefault(database, _Totals()).add(*values)
+        users.setdefault(user_id, _Totals()).add(*values)
+        points.setdefault(point, _Totals()).add(*values)
+        volumes = user_points.setdefault(user_id, {})
+        volumes[point] = volumes.get(point, 0) + queries
+
+    from authentication.models import User
+
+    timeline = sorted(points)
+    top_users = sorted(users.items(), key=lambda item: (-item[1].queries, item[0]))[:limit]
+    emails = dict(User.objects.filter(id__in=[user_id for user_id, _ in top_users]).values_list('id', 'email'))
+
+    return {
+        'window': window,
+        'since': since.isoformat(),
+        'totals': {**overall.summary(), 'rows': overall.rows},
+        'databases': [
+            {'database': name, **totals.summary()} for name, totals in sorted(databases.items())
+        ],
+        'slowest_sql': _statements(since, database_name, ['-average'], limit),
+        'failing_sql': _statements(since, database_name, ['-total_failures', '-last_seen'], limit, failing=True),
+        'users': [{
+            'user_id': user_id,
+            'email': emails.get(user_id),
+            **totals.summary(),
+            'volume': [user_points[user_id].get(point, 0) for point in timeline],
+        } for user_id, totals in top_users],
+        'trend': {
+            'granularity': granularity,
+            'points': [{'bucket': point.isoformat(), **points[point].summary()} for point in timeline],
+        },
+    }
@@ -1,6 +1,59 @@
+import logging
+import time
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def invalidate_permissions(**kwargs):
+    """Drop every cached permission check, in all workers, when a DatabasePermission changes"""
+    from .cache import get_cache
+    get_cache('permissions').invalidate()
 
 
 class QueryEngineConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'query_engine'
+
+    def ready(self):
+        from django.apps import apps
+        from django.db.models.signals import post_delete, post_migrate, post_save
+        from authentication.models import DatabasePermission
+        from .history import ensure_search_index
+
+        post_save.connect(invalidate_permissions, sender=DatabasePermission, dispatch_uid='query_engine_permission_saved')
+        post_delete.connect(invalidate_permissions, sender=DatabasePermission, dispatch_uid='query_engine_permission_deleted')
+        post_migrate.connect(ensure_search_index, sender=apps.get_app_config('authentication'), dispatch_uid='query_engine_search_index')
+
+        warmup = getattr(settings, 'QUERY_ENGINE_WARMUP', [])
+        if warmup:
+            self.warm_up(warmup)
+
+    def warm_up(self, steps):
+        """Preload caches before the worker starts serving requests"""
+        from .database_schemas import DATABASES, get_schema_prompt
+        from .connections import get_pool
+
+        start_time = time.perf_counter()
+        for database_name in DATABASES:
+            if 'schema_cache' in steps:
+                get_schema_prompt(database_name)
+            if 'memory_copies' in steps and database_name in getattr(settings, 'QUERY_ENGINE_IN_MEMORY_DATABASES', ()):
+                try:
+                    # Loads the in-memory copy and points the pool at it
+                    get_pool(database_name)
+                except Exception as e:
+                    logger.warning("Could not load %s into memory: %s", database_name, e)
+            if 'connection_pool' in steps:
+                try:
+                    get_pool(database_name).warm()
+                except Exception as e:
+                    # A missing database file must not stop the worker from booting
+                    logger.warning("Could not warm connection pool for %s: %s", database_name, e)
+
+        if 'process_pool' in steps:
+            from .process_pool import process_backend
+            process_backend.warm()
+
+        logger.info("Query engine warm-up (%s) took %.3fs", ', '.join(steps), time.perf_counter() - start_time)
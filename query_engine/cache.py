@@ -0,0 +1,350 @@
+import hashlib
+import marshal
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from django.conf import settings
+from . import metrics
+
+# Payloads at least this large are zlib-compressed when that makes them smaller
+COMPRESS_MIN_BYTES = 1024
+
+# Seconds a namespace's version is trusted before it is re-read from the backend,
+# i.e. how long an invalidate() in another worker can take to be seen
+VERSION_CHECK_INTERVAL = 1.0
+
+_MISSING = object()
+
+
+def serialize(value):
+    """
+    Encode a value as bytes prefixed with a one-byte format tag
+
+    Row payloads (lists/tuples/dicts of int, float, str, bytes, None) use
+    marshal, which is compact and fast; anything else, such as a DataFrame,
+    falls back to pickle. Upper-case tags mark zlib-compressed data.
+    """
+    try:
+        data, kind = marshal.dumps(value), b'm'
+    except ValueError:
+        data, kind = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), b'p'
+    if len(data) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            data, kind = compressed, kind.upper()
+    return kind + data
+
+
+def deserialize(blob):
+    kind, data = blob[:1], blob[1:]
+    if kind.isupper():
+        data, kind = zlib.decompress(data), kind.lower()
+    return marshal.loads(data) if kind == b'm' else pickle.loads(data)
+
+
+def _expires(ttl):
+    return time.time() + ttl if ttl else None
+
+
+class LocMemBackend:
+    """Per-process LRU store bounded by the total size of the serialized values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()  # key -> (blob, expires)
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] < time.time():
+            self._pop(key)
+            return None
+        return item
+
+    def _pop(self, key):
+        blob, _ = self._data.pop(key)
+        self.size -= len(blob)
+
+    def _store(self, key, blob, ttl):
+        if key in self._data:
+            self._pop(key)
+        if len(blob) > self.max_bytes:
+            return
+        self._data[key] = (blob, _expires(ttl))
+        self.size += len(blob)
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._data)))
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, blob, ttl):
+        with self._lock:
+            self._store(key, blob, ttl)
+
+    def add(self, key, blob, ttl):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, blob, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def stats(self):
+        return {'entries': len(self._data), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class SQLiteBackend:
+    """
+    Store in a SQLite file shared by every worker on the machine
+
+    Eviction is approximately least-recently-used: access times are only
+    rewritten when they are stale, and the size limit is enforced every
+    EVICT_EVERY writes.
+    """
+
+    EVICT_EVERY = 100
+    TOUCH_AFTER = 30  # seconds before a read refreshes an entry's access time
+
+    def __init__(self, path, max_bytes):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+                " expires REAL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value, expires, accessed FROM cache_entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        now = time.time()
+        if expires is not None and expires < now:
+            conn.execute("DELETE FROM cache_entries WHERE key = ? AND expires < ?", (key, now))
+            return None
+        if now - accessed > self.TOUCH_AFTER:
+            conn.execute("UPDATE cache_entries SET accessed = ? WHERE key = ?", (now, key))
+        return value
+
+    def set(self, key, blob, ttl):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, blob, len(blob), _expires(ttl), time.time())
+        )
+        self._after_write()
+
+    def add(self, key, blob, ttl):
+        conn = self._connection()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so check-and-insert is atomic across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM cache_entries WHERE key = ? AND expires < ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO cache_entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), _expires(ttl), now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._after_write()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def _after_write(self):
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY:
+                return
+        self.evict()
+
+    def evict(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM cache_entries WHERE expires < ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        cutoff = None
+        for key, size in conn.execute("SELECT key, size FROM cache_entries ORDER BY accessed"):
+            excess -= size
+            cutoff = key
+            if excess <= 0:
+                break
+        if cutoff is not None:
+            conn.execute(
+                "DELETE FROM cache_entries WHERE accessed <= (SELECT accessed FROM cache_entries WHERE key = ?)",
+                (cutoff,)
+            )
+
+    def stats(self):
+        entries, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries"
+        ).fetchone()
+        return {'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+class DjangoCacheBackend:
+    """Delegates to a Django cache alias, e.g. Redis or memcached for multi-machine setups"""
+
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, blob, ttl):
+        self.cache.set(key, blob, timeout=ttl)
+
+    def add(self, key, blob, ttl):
+        return self.cache.add(key, blob, timeout=ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def stats(self):
+        return {}
+
+
+def _build_backend(config):
+    backend = config.get('BACKEND', 'locmem')
+    max_bytes = config.get('MAX_BYTES', 64 * 1024 * 1024)
+    if backend == 'locmem':
+        return LocMemBackend(max_bytes)
+    if backend == 'sqlite':
+        return SQLiteBackend(config.get('PATH', os.path.join(settings.BASE_DIR, 'query_cache.sqlite3')), max_bytes)
+    if backend == 'django':
+        return DjangoCacheBackend(config.get('ALIAS', 'default'))
+    raise ValueError(f"Unknown query engine cache backend: {backend}")
+
+
+class CacheNamespace:
+    """
+    One logical cache (e.g. 'generation') stored in one of the backends
+
+    Keys are hashed and versioned: the effective key includes
+    QUERY_ENGINE_CACHE_VERSION and a per-namespace version held in the
+    backend itself, so invalidate() drops every entry in all workers
+    without having to enumerate them.
+    """
+
+    def __init__(self, name, backend, ttl):
+        self.name = name
+        self.backend = backend
+        self.ttl = ttl
+        self._version = None
+        self._version_checked = 0.0
+
+    def _version_key(self):
+        return f"qe:{self.name}:version"
+
+    def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked > VERSION_CHECK_INTERVAL:
+            blob = self.backend.get(self._version_key())
+            self._version = deserialize(blob) if blob is not None else 0
+            self._version_checked = now
+        return self._version
+
+    def make_key(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return f"qe:{self.name}:{getattr(settings, 'QUERY_ENGINE_CACHE_VERSION', 1)}.{self.version()}:{digest}"
+
+    def get(self, key, default=None, record=True):
+        blob = self.backend.get(self.make_key(key))
+        if record:
+            metrics.count_cache(self.name, hit=blob is not None)
+        return deserialize(blob) if blob is not None else default
+
+    def set(self, key, value, ttl=_MISSING):
+        self.backend.set(self.make_key(key), serialize(value), self.ttl if ttl is _MISSING else ttl)
+
+    def add(self, key, value, ttl=_MISSING):
+        """Store only if the key is absent; returns True if this call stored it"""
+        return self.backend.add(self.make_key(key), serialize(value), self.ttl if ttl is _MISSING else ttl)
+
+    def delete(self, key):
+        self.backend.delete(self.make_key(key))
+
+    def get_or_set(self, key, build, ttl=_MISSING):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = build()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self):
+        version = self.version() + 1
+        self.backend.set(self._version_key(), serialize(version), None)
+        self._version = version
+        self._version_checked = time.monotonic()
+
+
+_backends = {}
+_namespaces = {}
+_lock = threading.Lock()
+
+
+def get_backend(alias):
+    with _lock:
+        backend = _backends.get(alias)
+        if backend is None:
+            configs = getattr(settings, 'QUERY_ENGINE_CACHES', {})
+            backend = _build_backend(configs.get(alias, {}))
+            _backends[alias] = backend
+        return backend
+
+
+def get_cache(name):
+    """Return the cache namespace configured in QUERY_ENGINE_CACHE_NAMESPACES"""
+    namespace = _namespaces.get(name)
+    if namespace is not None:
+        return namespace
+    config = getattr(settings, 'QUERY_ENGINE_CACHE_NAMESPACES', {}).get(name, {})
+    backend = get_backend(config.get('cache', 'local'))
+    with _lock:
+        return _namespaces.setdefault(name, CacheNamespace(name, backend, config.get('ttl')))
+
+
+def cache_stats():
+    return {alias: backend.stats() for alias, backend in dict(_backends).items()}
@@ -0,0 +1,331 @@
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from . import metrics
+from .database_schemas import get_database_path
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only connections to one target SQLite database
+
+    Connections normally open the database file; retarget() switches the
+    pool to an in-memory copy, after which connections to the old target
+    are replaced as they are returned.
+    """
+
+    def __init__(self, database_name, db_path, size, timeout):
+        self.database_name = database_name
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self.in_use = 0
+        # Read-only mode keeps generated SQL from modifying the target database
+        self.uri = f"file:{db_path}?mode=ro"
+        self.generation = 0
+        self._generations = {}  # connection -> generation it was opened for
+        # LIFO so the most recently used (warmest page cache) connection is reused first
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            uri, generation = self.uri, self.generation
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if 'mode=memory' in uri:
+            # An in-memory copy can't be opened with mode=ro
+            conn.execute("PRAGMA query_only = ON")
+        with self._lock:
+            self._generations[conn] = generation
+        return conn
+
+    def _is_stale(self, conn):
+        with self._lock:
+            return self._generations.get(conn) != self.generation
+
+    def _close(self, conn):
+        with self._lock:
+            self._generations.pop(conn, None)
+        conn.close()
+
+    def _replace(self, conn):
+        """Close a connection to an old target and open one to the current target in its place"""
+        self._close(conn)
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self.created -= 1
+            raise
+
+    def retarget(self, uri):
+        """Point new connections at uri; idle connections to the old target are replaced now"""
+        with self._lock:
+            self.uri = uri
+            self.generation += 1
+        stale = []
+        while True:
+            try:
+                stale.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for conn in stale:
+            try:
+                self._idle.put(self._replace(conn))
+            except Exception as e:
+                logger.warning("Could not reopen a %s connection: %s", self.database_name, e)
+
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            return self._replace(conn) if self._is_stale(conn) else conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self.created -= 1
+                raise
+
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolExhausted(f"No database connection available after {self.timeout}s")
+        return self._replace(conn) if self._is_stale(conn) else conn
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        with self._lock:
+            self.in_use += 1
+        metrics.set_pool_utilization(self.database_name, self.utilization())
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            if self._is_stale(conn):
+                try:
+                    conn = self._replace(conn)
+                except Exception:
+                    conn = None
+            if conn is not None:
+                self._idle.put(conn)
+            metrics.set_pool_utilization(self.database_name, self.utilization())
+
+    def warm(self):
+        """Open every connection up front and load the schema into each of them"""
+        conns = []
+        try:
+            for _ in range(self.size):
+                conn = self._acquire()
+                conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                conns.append(conn)
+        finally:
+            for conn in conns:
+                self._idle.put(conn)
+
+    def utilization(self):
+        return self.in_use / self.size if self.size else 0.0
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_name):
+    """Return the connection pool for a target database, creating it on first use"""
+    pool = _pools.get(database_name)
+    if pool is None:
+        with _pools_lock:
+            if database_name not in _pools:
+                _pools[database_name] = ConnectionPool(
+                    database_name,
+                    get_database_path(database_name),
+                    size=getattr(settings, 'QUERY_ENGINE_POOL_SIZE', 4),
+                    timeout=getattr(settings, 'QUERY_ENGINE_POOL_TIMEOUT', 10)
+                )
+            pool = _pools[database_name]
+
+    if database_name in getattr(settings, 'QUERY_ENGINE_IN_MEMORY_DATABASES', ()):
+        refresh_memory_copy(database_name)
+    return pool
+
+
+def all_pools():
+    return dict(_pools)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+@contextmanager
+def time_budget(conn, seconds, cancelled=None):
+    """
+    Interrupt whatever conn is executing once it has run for the given number of seconds
+
+    cancelled is an optional callable; the statement is also interrupted as
+    soon as it returns True.
+    """
+    if not seconds and cancelled is None:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds if seconds else None
+
+    def should_interrupt():
+        if deadline is not None and time.monotonic() > deadline:
+            return True
+        return cancelled is not None and cancelled()
+
+    # Called every N virtual machine instructions; a truthy return aborts the statement
+    conn.set_progress_handler(should_interrupt, 10000)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if deadline is not None and time.monotonic() > deadline and 'interrupted' in str(e):
+            raise BudgetExceeded(f"Query exceeded the {seconds}s execution time budget")
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def get_database_version(database_name):
+    """
+    Return a token that changes whenever the database file is written
+
+    Built from the modification time and size of the database file and its
+    WAL, so it is comparable across connections and worker processes.
+    """
+    db_path = get_database_path(database_name)
+    parts = []
+    for path in (db_path, f"{db_path}-wal"):
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            continue
+        parts.append(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    return '.'.join(parts)
+
+
+class MemoryCopy:
+    """
+    A target database loaded into a shared-cache in-memory database
+
+    The anchor connection keeps the copy alive; pool connections open the
+    same URI. Each load gets a new URI, so a reload never disturbs queries
+    still running against the previous copy.
+    """
+
+    def __init__(self, database_name, db_path, generation):
+        name = re.sub(r'\W', '_', database_name)
+        self.uri = f"file:query_engine_{name}_{generation}?mode=memory&cache=shared"
+        # Taken before copying, so a write during the copy causes another reload
+        self.version = get_database_version(database_name)
+        self.anchor = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            source.backup(self.anchor)
+        finally:
+            source.close()
+        page_count = self.anchor.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.anchor.execute("PRAGMA page_size").fetchone()[0]
+        self.bytes = page_count * page_size
+        self.loaded_at = time.time()
+        self.checked_at = time.monotonic()
+
+    def close(self):
+        self.anchor.close()
+
+
+_copies = {}
+_copy_locks = {}
+_skipped = set()
+
+
+def refresh_memory_copy(database_name):
+    """
+    Load a database into memory, or reload it if its file has changed
+
+    Checked at most every QUERY_ENGINE_IN_MEMORY_CHECK_INTERVAL seconds. The
+    reload happens in one thread while the others keep using the current
+    copy, and the pool is switched over only once the new copy is complete.
+    """
+    copy = _copies.get(database_name)
+    now = time.monotonic()
+    if copy is not None:
+        if now - copy.checked_at < getattr(settings, 'QUERY_ENGINE_IN_MEMORY_CHECK_INTERVAL', 1):
+            return copy
+        copy.checked_at = now
+        if copy.version == get_database_version(database_name):
+            return copy
+
+    with _pools_lock:
+        lock = _copy_locks.setdefault(database_name, threading.Lock())
+    # Without a copy yet, wait for the loader; otherwise keep serving the old one
+    if not lock.acquire(blocking=copy is None):
+        return copy
+    try:
+        current = _copies.get(database_name)
+        if current is not copy:
+            # Another thread reloaded while this one waited
+            return current
+        db_path = get_database_path(database_name)
+        if not db_path or not os.path.exists(db_path):
+            return copy
+        max_bytes = getattr(settings, 'QUERY_ENGINE_IN_MEMORY_MAX_BYTES', None)
+        if max_bytes and os.path.getsize(db_path) > max_bytes:
+            if database_name not in _skipped:
+                _skipped.add(database_name)
+                logger.warning("%s is larger than QUERY_ENGINE_IN_MEMORY_MAX_BYTES; serving it from disk", database_name)
+            return copy
+
+        start_time = time.perf_counter()
+        # Called from get_pool(), so the pool exists
+        pool = _pools[database_name]
+        new_copy = MemoryCopy(database_name, db_path, pool.generation + 1)
+        _copies[database_name] = new_copy
+        pool.retarget(new_copy.uri)
+        if copy is not None:
+            # Connections still reading the old copy keep it alive until they are replaced
+            copy.close()
+        metrics.set_memory_copy_bytes(database_name, new_copy.bytes)
+        logger.info(
+            "Loaded %s into memory (%d bytes) in %.3fs",
+            database_name, new_copy.bytes, time.perf_counter() - start_time
+        )
+        return new_copy
+    finally:
+        lock.release()
+
+
+def memory_copy_stats():
+    """Per-database size and load time of this process's in-memory copies"""
+    return {
+        database_name: {'bytes': copy.bytes, 'loaded_at': copy.loaded_at, 'version': copy.version}
+        for database_name, copy in dict(_copies).items()
+    }
@@ -4,6 +4,12 @@ from datetime import datetime, timedelta
 from faker import Faker
 import os
 
+try:
+    from .database_schemas import DATABASES
+except ImportError:
+    # Running as a standalone script from inside query_engine/
+    from database_schemas import DATABASES
+
 fake = Faker()
 
 class DatabaseCreator:
@@ -12,6 +18,25 @@ class DatabaseCreator:
         if not os.path.exists(self.db_folder):
             os.makedirs(self.db_folder)
     
+    def create_indexes(self, conn, database_name):
+        """Index foreign keys and declared filter columns, then refresh planner statistics"""
+        cursor = conn.cursor()
+        
+        for table_name, table_info in DATABASES[database_name]['tables'].items():
+            cursor.execute(f"PRAGMA foreign_key_list({table_name})")
+            columns = [fk[3] for fk in cursor.fetchall()]
+            columns += table_info.get('filter_columns', [])
+            
+            # dict.fromkeys keeps declaration order while dropping duplicates
+            for column in dict.fromkeys(columns):
+                cursor.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{column} ON {table_name} ({column})"
+                )
+        
+        # Indexes are built after the bulk load so inserts don't pay for them,
+        # and ANALYZE gives the planner row counts to choose between them
+        cursor.execute("ANALYZE")
+    
     def create_ecommerce_db(self):
         """Create and populate e-commerce database"""
         db_path = os.path.join(self.db_folder, "ecommerce.db")
@@ -150,6 +175,8 @@ class DatabaseCreator:
             # Update order total
             cursor.execute("UPDATE orders SET total_amount = ? WHERE order_id = ?", (total, order_id))
         
+        self.create_indexes(conn, "E-Commerce")
+        
         conn.commit()
         conn.close()
         print("✅ E-commerce database created successfully!")
@@ -328,6 +355,8 @@ class DatabaseCreator:
                 start_date + timedelta(days=random.randint(7, 90))
             ))
         
+        self.create_indexes(conn, "Hospital Management")
+        
         conn.commit()
         conn.close()
         print("✅ Hospital database created successfully!")
@@ -515,6 +544,8 @@ class DatabaseCreator:
                     fake.date_between(start_date='-6m', end_date='today')
                 ))
         
+        self.create_indexes(conn, "School Management")
+        
         conn.commit()
         conn.close()
         print("✅ School database created successfully!")
@@ -1,3 +1,16 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+from django.conf import settings
+
+# Database file mapping
+DB_FILE_MAPPING = {
+    "E-Commerce": "databases/ecommerce.db",
+    "Hospital Management": "databases/hospital.db",
+    "School Management": "databases/school.db"
+}
+
 DATABASES = {
     "E-Commerce": {
         "description": "An e-commerce database for online shopping",
@@ -13,7 +26,8 @@ DATABASES = {
                     "city (VARCHAR(50))",
                     "country (VARCHAR(50))"
                 ],
-                "description": "Stores customer information"
+                "description": "Stores customer information",
+                "filter_columns": ["country", "created_at"]
             },
             "products": {
                 "columns": [
@@ -25,7 +39,8 @@ DATABASES = {
                     "description (TEXT)",
                     "created_at (TIMESTAMP)"
                 ],
-                "description": "Stores product information"
+                "description": "Stores product information",
+                "filter_columns": ["category"]
             },
             "orders": {
                 "columns": [
@@ -36,7 +51,8 @@ DATABASES = {
                     "status (VARCHAR(20))",
                     "shipping_address (TEXT)"
                 ],
-                "description": "Stores order information"
+                "description": "Stores order information",
+                "filter_columns": ["status", "order_date"]
             },
             "order_items": {
                 "columns": [
@@ -49,6 +65,30 @@ DATABASES = {
                 ],
                 "description": "Stores individual items in each order"
             }
+        },
+        # Pre-aggregated tables kept in the database file by the
+        # refresh_summaries command; matching aggregate queries are
+        # rewritten to read them (see summaries.py)
+        "summaries": {
+            "summary_category_monthly_sales": {
+                "fact": "order_items",
+                "watermark": "order_item_id",
+                "joins": {
+                    "orders": "orders.order_id = order_items.order_id",
+                    "products": "products.product_id = order_items.product_id"
+                },
+                "dimensions": {
+                    "category": "products.category",
+                    "month": "strftime('%Y-%m', orders.order_date)",
+                    "status": "orders.status"
+                },
+                "measures": {
+                    "revenue": "SUM(order_items.quantity * order_items.unit_price)",
+                    "subtotal": "SUM(order_items.subtotal)",
+                    "units": "SUM(order_items.quantity)",
+                    "items": "COUNT(*)"
+                }
+            }
         }
     },
     
@@ -67,7 +107,8 @@ DATABASES = {
                     "address (TEXT)",
                     "blood_type (VARCHAR(5))"
                 ],
-                "description": "Stores patient information"
+                "description": "Stores patient information",
+                "filter_columns": ["blood_type"]
             },
             "doctors": {
                 "columns": [
@@ -80,7 +121,8 @@ DATABASES = {
                     "hire_date (DATE)",
                     "salary (DECIMAL(10,2))"
                 ],
-                "description": "Stores doctor information"
+                "description": "Stores doctor information",
+                "filter_columns": ["specialization"]
             },
             "appointments": {
                 "columns": [
@@ -92,7 +134,8 @@ DATABASES = {
                     "status (VARCHAR(20))",
                     "notes (TEXT)"
                 ],
-                "description": "Stores appointment information"
+                "description": "Stores appointment information",
+                "filter_columns": ["status", "appointment_date"]
             },
             "prescriptions": {
                 "columns": [
@@ -105,7 +148,8 @@ DATABASES = {
                     "start_date (DATE)",
                     "end_date (DATE)"
                 ],
-                "description": "Stores prescription information"
+                "description": "Stores prescription information",
+                "filter_columns": ["medication_name", "start_date"]
             },
             "departments": {
                 "columns": [
@@ -117,6 +161,26 @@ DATABASES = {
                 ],
                 "description": "Stores hospital department information"
             }
+        },
+        "summaries": {
+            "summary_doctor_monthly_appointments": {
+                "fact": "appointments",
+                "watermark": "appointment_id",
+                "joins": {
+                    "doctors": "doctors.doctor_id = appointments.doctor_id"
+                },
+                "dimensions": {
+                    "doctor_id": "appointments.doctor_id",
+                    "first_name": "doctors.first_name",
+                    "last_name": "doctors.last_name",
+                    "specialization": "doctors.specialization",
+                    "month": "strftime('%Y-%m', appointments.appointment_date)",
+                    "status": "appointments.status"
+                },
+                "measures": {
+                    "appointments": "COUNT(*)"
+                }
+            }
         }
     },
     
@@ -134,7 +198,8 @@ DATABASES = {
                     "email (VARCHAR(100))",
                     "phone (VARCHAR(20))"
                 ],
-                "description": "Stores student information"
+                "description": "Stores student information",
+                "filter_columns": ["grade_level"]
             },
             "teachers": {
                 "columns": [
@@ -158,7 +223,8 @@ DATABASES = {
                     "semester (VARCHAR(20))",
                     "year (INT)"
                 ],
-                "description": "Stores course information"
+                "description": "Stores course information",
+                "filter_columns": ["semester", "year"]
             },
             "enrollments": {
                 "columns": [
@@ -169,7 +235,8 @@ DATABASES = {
                     "grade (VARCHAR(2))",
                     "status (VARCHAR(20))"
                 ],
-                "description": "Stores student course enrollments"
+                "description": "Stores student course enrollments",
+                "filter_columns": ["status"]
             },
             "grades": {
                 "columns": [
@@ -180,7 +247,8 @@ DATABASES = {
                     "max_points (DECIMAL(5,2))",
                     "grade_date (DATE)"
                 ],
-                "description": "Stores student grades"
+                "description": "Stores student grades",
+                "filter_columns": ["grade_date"]
             }
         }
     }
@@ -188,9 +256,19 @@ DATABASES = {
 
 
 def get_schema_prompt(database_name):
-    """Generate a formatted schema description for the selected database"""
+    """Return the formatted schema description, cached under the schema's hash"""
     if database_name not in DATABASES:
         return ""
+    from .cache import get_cache
+    
+    return get_cache('schema').get_or_set(
+        f"{database_name}:{get_schema_hash(database_name)}",
+        lambda: build_schema_prompt(database_name)
+    )
+
+
+def build_schema_prompt(database_name):
+    """Generate a formatted schema description for the selected database"""
     
     db = DATABASES[database_name]
     schema_text = f"Database: {database_name}\n"
@@ -204,4 +282,30 @@ def get_schema_prompt(database_name):
         for column in table_info['columns']:
             schema_text += f"  - {column}\n"
     
-    return schema_text
\ No newline at end of file
+    return schema_text
+
+
+def get_public_schema(database_name):
+    """Return the schema as shown to clients, without the engine's tuning config"""
+    db = DATABASES[database_name]
+    return {
+        'description': db['description'],
+        'tables': {
+            table_name: {'columns': table_info['columns'], 'description': table_info['description']}
+            for table_name, table_info in db['tables'].items()
+        }
+    }
+
+
+def get_database_path(database_name):
+    """Return the absolute path of the SQLite file for a database, or None if unknown"""
+    if database_name not in DB_FILE_MAPPING:
+        return None
+    return os.path.join(settings.BASE_DIR, DB_FILE_MAPPING[database_name])
+
+
+@lru_cache(maxsize=None)
+def get_schema_hash(database_name):
+    """Return a stable hash of a database's schema definition"""
+    definition = json.dumps(DATABASES.get(database_name), sort_keys=True)
+    return hashlib.sha1(definition.encode('utf-8')).hexdigest()
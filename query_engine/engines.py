@@ -0,0 +1,595 @@
+import datetime
+import decimal
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from functools import lru_cache
+from django.conf import settings
+from django.utils.module_loading import import_string
+from . import metrics
+from .connections import BudgetExceeded, get_database_version, get_pool, time_budget
+from .database_schemas import get_database_path
+from .query_plan import plan_query
+from .summaries import NoMatch, find_call_end, tokenize, top_level_ranges
+from .validation import result_columns
+
+logger = logging.getLogger(__name__)
+
+# Statements worth handing to a columnar engine: aggregates and joins
+ANALYTIC_PATTERN = re.compile(
+    r'\bgroup\s+by\b|\bjoin\b|\b(?:sum|avg|count|total|min|max|group_concat)\s*\(', re.IGNORECASE
+)
+
+SNAPSHOT_INFO_TABLE = '_snapshot_info'
+
+# Rows copied from SQLite per Arrow batch while building a snapshot
+SNAPSHOT_BATCH_ROWS = 100000
+
+
+class EngineUnavailable(Exception):
+    """The engine can't run this statement; it is run on SQLite instead"""
+
+    def __init__(self, message, reason='error'):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ExecutionEngine:
+    """Runs one read-only statement against a target database"""
+
+    name = None
+
+    def execute(self, sql_query, database_name, params=(), job=None):
+        """
+        Returns:
+            Tuple of (columns, rows)
+
+        Raises EngineUnavailable when the statement should be retried on
+        SQLite, and BudgetExceeded when it ran out of time.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class SQLiteEngine(ExecutionEngine):
+    """
+    The default engine: pooled sqlite3 connections in this process
+
+    Statements run in the worker process pool when
+    QUERY_ENGINE_EXECUTION_BACKEND is 'process'. When a job is given, the
+    statement always runs in this process so it can be interrupted if the
+    job is cancelled.
+    """
+
+    name = 'sqlite'
+
+    def execute(self, sql_query, database_name, params=(), job=None):
+        budget = getattr(settings, 'QUERY_ENGINE_SQL_TIME_BUDGET', None)
+        if job is None and getattr(settings, 'QUERY_ENGINE_EXECUTION_BACKEND', 'thread') == 'process':
+            from .process_pool import process_backend
+            return process_backend.execute(sql_query, database_name, params)
+
+        with get_pool(database_name).connection() as conn, \
+                time_budget(conn, budget, job.cancelled if job else None), \
+                (job.attached(conn) if job else nullcontext()):
+            # sqlite3 caches prepared statements per connection, so templates skip re-parsing
+            cursor = conn.execute(sql_query, params)
+            columns = [description[0] for description in cursor.description or []]
+            rows = cursor.fetchall()
+        return columns, rows
+
+
+def snapshot_path(database_name):
+    stem = os.path.splitext(os.path.basename(get_database_path(database_name)))[0]
+    return os.path.join(
+        getattr(settings, 'QUERY_ENGINE_COLUMNAR_DIR', os.path.join(settings.BASE_DIR, 'databases', 'columnar')),
+        f"{stem}.duckdb"
+    )
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def column_types(conn, table):
+    """DuckDB type per column, from the storage classes the column's values actually use"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quote(table)})")]
+    if not columns:
+        return []
+    probes = ', '.join(
+        f"MAX(typeof({quote(column)}) = '{kind}')" for column in columns for kind in ('text', 'blob', 'real')
+    )
+    flags = conn.execute(f"SELECT {probes} FROM {quote(table)}").fetchone()
+    types = []
+    for i, column in enumerate(columns):
+        has_text, has_blob, has_real = flags[i * 3:i * 3 + 3]
+        if has_blob:
+            kind = 'BLOB'
+        elif has_text:
+            kind = 'VARCHAR'
+        elif has_real:
+            kind = 'DOUBLE'
+        else:
+            kind = 'BIGINT'
+        types.append((column, kind))
+    return types
+
+
+def build_snapshot(db_path, target_path, source_version=''):
+    """
+    Copy every table of a SQLite file into a new DuckDB file
+
+    Each column gets one type, so a column mixing storage classes is
+    stored as text (as CAST(x AS TEXT) would give). The snapshot is written
+    next to the target and renamed into place, so readers never see a
+    partial file.
+    """
+    import duckdb
+    import pyarrow as pa
+
+    arrow_types = {'BIGINT': pa.int64(), 'DOUBLE': pa.float64(), 'VARCHAR': pa.string(), 'BLOB': pa.binary()}
+    casts = {'BIGINT': 'INTEGER', 'DOUBLE': 'REAL', 'VARCHAR': 'TEXT', 'BLOB': 'BLOB'}
+
+    os.makedirs(os.path.dirname(target_path) or '.', exist_ok=True)
+    temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    target = duckdb.connect(temp_path)
+    try:
+        tables = [name for (name,) in source.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        )]
+        for table in tables:
+            types = column_types(source, table)
+            if not types:
+                continue
+            definitions = ', '.join(f"{quote(column)} {kind}" for column, kind in types)
+            target.execute(f"CREATE TABLE {quote(table)} ({definitions})")
+            schema = pa.schema([(column, arrow_types[kind]) for column, kind in types])
+            selected = ', '.join(f"CAST({quote(column)} AS {casts[kind]})" for column, kind in types)
+            cursor = source.execute(f"SELECT {selected} FROM {quote(table)}")
+            while True:
+                rows = cursor.fetchmany(SNAPSHOT_BATCH_ROWS)
+                if not rows:
+                    break
+                batch = pa.Table.from_arrays(
+                    [pa.array(values, type=schema.field(i).type) for i, values in enumerate(zip(*rows))],
+                    schema=schema
+                )
+                target.register('snapshot_batch', batch)
+                target.execute(f"INSERT INTO {quote(table)} SELECT * FROM snapshot_batch")
+                target.unregister('snapshot_batch')
+        target.execute(f"CREATE TABLE {SNAPSHOT_INFO_TABLE} (source_version VARCHAR, built_at DOUBLE)")
+        target.execute(f"INSERT INTO {SNAPSHOT_INFO_TABLE} VALUES (?, ?)", (source_version, time.time()))
+        target.execute("CHECKPOINT")
+    except BaseException:
+        target.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(temp_path, target_path)
+
+
+def to_duckdb_sql(sql_query):
+    """
+    Translate the SQLite idioms generated SQL relies on into DuckDB's
+
+    LIKE becomes ILIKE (SQLite's LIKE ignores ASCII case),
+    strftime(format, text) becomes strftime(CAST(text AS TIMESTAMP), format)
+    and CAST(x AS INTEGER) becomes CAST(trunc(x) AS BIGINT), since SQLite
+    truncates where DuckDB rounds. Anything else DuckDB rejects is run on
+    SQLite instead. Raises NoMatch when the statement can't be tokenized
+    or uses a function DuckDB gives a different meaning, such as
+    multi-argument min()/max(), which ignore NULLs there.
+    """
+    spans = []
+    tokens = tokenize(sql_query, spans)
+
+    def text(start, stop):
+        # Source text of tokens[start:stop], itself translated
+        return to_duckdb_sql(sql_query[spans[start][0]:spans[stop - 1][1]])
+
+    edits = []
+    for i, token in enumerate(tokens):
+        lowered = token.lower()
+        if lowered == 'like':
+            edits.append((spans[i][0], spans[i][1], 'ILIKE'))
+            continue
+        if i + 1 >= len(tokens) or tokens[i + 1] != '(':
+            continue
+        if lowered == 'strftime':
+            end = find_call_end(tokens, i + 1)
+            arguments = top_level_ranges(tokens[i + 2:end])
+            if len(arguments) != 2 or any(start == stop for start, stop in arguments):
+                continue
+            (fmt_start, fmt_stop), (value_start, value_stop) = [
+                (i + 2 + start, i + 2 + stop) for start, stop in arguments
+            ]
+            edits.append((
+                spans[i][0], spans[end][1],
+                f"strftime(CAST({text(value_start, value_stop)} AS TIMESTAMP), {text(fmt_start, fmt_stop)})"
+            ))
+        elif lowered == 'cast':
+            end = find_call_end(tokens, i + 1)
+            parts = top_level_ranges([token.lower() for token in tokens[i + 2:end]], 'as')
+            if len(parts) != 2 or parts[0][0] == parts[0][1]:
+                continue
+            # SQLite gives INTEGER affinity to any type name containing INT
+            type_name = ' '.join(tokens[i + 2 + parts[1][0]:end]).lower()
+            if 'int' in type_name:
+                value_stop = i + 2 + parts[0][1]
+                edits.append((spans[i][0], spans[end][1], f"CAST(trunc({text(i + 2, value_stop)}) AS BIGINT)"))
+        elif lowered in ('min', 'max'):
+            end = find_call_end(tokens, i + 1)
+            if len(top_level_ranges(tokens[i + 2:end])) > 1:
+                raise NoMatch(f"Multi-argument {lowered}() has no DuckDB equivalent")
+
+    # Edits nested in a rewritten call were applied to its translated arguments
+    result, position = [], 0
+    for start, stop, replacement in sorted(edits):
+        if start < position:
+            continue
+        result.append(sql_query[position:start])
+        result.append(replacement)
+        position = stop
+    result.append(sql_query[position:])
+    return ''.join(result)
+
+
+# Constructs SQLite happens to return in key or scan order, but DuckDB in hash order
+UNORDERED_WORDS = frozenset(('group', 'distinct', 'join', 'union', 'intersect', 'except'))
+
+
+def has_engine_defined_order(sql_query):
+    """
+    True if the statement's row order depends on the engine running it
+
+    That is a statement without a top-level ORDER BY that groups, joins,
+    deduplicates or combines rows, unless it is a single-row aggregate.
+    """
+    tokens = [token.lower() for token in tokenize(sql_query)]
+    depth, top_level = 0, []
+    for i, token in enumerate(tokens):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0:
+            top_level.append((token, tokens[i + 1] if i + 1 < len(tokens) else None))
+    if ('order', 'by') in top_level:
+        return False
+    if ('group', 'by') not in top_level and any(
+        token in ('sum', 'avg', 'count', 'total', 'min', 'max', 'group_concat') and following == '('
+        for token, following in top_level
+    ):
+        return False
+    from_clause = False
+    for token, _ in top_level:
+        if token == 'from':
+            from_clause = True
+        elif token in ('where', 'group', 'order', 'limit', 'having', 'window'):
+            from_clause = False
+        elif token == ',' and from_clause:
+            # FROM a, b is a join
+            return True
+    return any(token in UNORDERED_WORDS for token in tokens)
+
+
+def sqlite_value(value):
+    """Map DuckDB result values onto the types sqlite3 would return"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (int, float, str, bytes)) or value is None:
+        return value
+    return str(value)
+
+
+# Result types whose Python values are already what sqlite3 returns
+NATIVE_RESULT_TYPES = frozenset((
+    'BIGINT', 'INTEGER', 'SMALLINT', 'TINYINT', 'HUGEINT', 'UBIGINT', 'UINTEGER', 'USMALLINT', 'UTINYINT',
+    'DOUBLE', 'FLOAT', 'VARCHAR', 'BLOB'
+))
+
+
+class Snapshot:
+    def __init__(self, path, source_version, conn):
+        self.path = path
+        self.source_version = source_version
+        self.conn = conn
+        # Statements running on conn; a replaced snapshot is closed once none are left
+        self.users = 0
+        self.retired = False
+
+
+class DuckDBEngine(ExecutionEngine):
+    """
+    Columnar engine backed by DuckDB
+
+    Queries read a DuckDB snapshot of the SQLite file, built on first use
+    and rebuilt in the background whenever the file changes. Until a
+    current snapshot exists, and for any statement DuckDB rejects,
+    EngineUnavailable sends the query to SQLite.
+    """
+
+    name = 'duckdb'
+
+    # Config giving SQLite's results for integer division and NULL ordering.
+    # Generated SQL must not reach the filesystem or network (read_csv,
+    # ATTACH, COPY, INSTALL), and the lock stops a SET from undoing that.
+    CONFIG = {
+        'integer_division': True,
+        'default_null_order': 'nulls_first_on_asc_last_on_desc',
+        'enable_external_access': False,
+        'lock_configuration': True,
+    }
+
+    def __init__(self):
+        self._snapshots = {}
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def _open(self, path):
+        import duckdb
+
+        config = dict(self.CONFIG)
+        threads = getattr(settings, 'QUERY_ENGINE_COLUMNAR_THREADS', None)
+        if threads:
+            config['threads'] = threads
+        conn = duckdb.connect(path, read_only=True, config=config)
+        (source_version,) = conn.execute(f"SELECT source_version FROM {SNAPSHOT_INFO_TABLE}").fetchone()
+        return Snapshot(path, source_version, conn)
+
+    def _build(self, database_name, version):
+        try:
+            started = time.perf_counter()
+            build_snapshot(get_database_path(database_name), snapshot_path(database_name), version)
+            logger.info("Built columnar snapshot of %s in %.1fs", database_name, time.perf_counter() - started)
+        except Exception:
+            logger.exception("Building the columnar snapshot of %s failed", database_name)
+        finally:
+            with self._lock:
+                self._building.discard(database_name)
+
+    def _schedule_build(self, database_name, version):
+        with self._lock:
+            if database_name in self._building:
+                return
+            self._building.add(database_name)
+        threading.Thread(
+            target=self._build, args=(database_name, version), name=f'columnar-snapshot-{database_name}', daemon=True
+        ).start()
+
+    def _replace(self, database_name, snapshot):
+        """Make snapshot current, closing the one it replaces once no statement is using it"""
+        old = self._snapshots.get(database_name)
+        self._snapshots[database_name] = snapshot
+        if old is not None:
+            old.retired = True
+            if old.users == 0:
+                old.conn.close()
+
+    def snapshot(self, database_name):
+        """
+        The current snapshot of a database, held until release() is called
+
+        Schedules a rebuild and raises EngineUnavailable if there is none.
+        """
+        try:
+            import duckdb  # noqa: F401
+        except ImportError:
+            raise EngineUnavailable("The duckdb package is not installed", reason='not_installed')
+
+        version = get_database_version(database_name)
+        path = snapshot_path(database_name)
+        with self._lock:
+            snapshot = self._snapshots.get(database_name)
+            if (snapshot is None or snapshot.source_version != version) and os.path.exists(path):
+                try:
+                    opened = self._open(path)
+                except Exception as e:
+                    logger.warning("Could not open columnar snapshot %s: %s", path, e)
+                else:
+                    if opened.source_version == version:
+                        self._replace(database_name, opened)
+                        snapshot = opened
+                    else:
+                        opened.conn.close()
+            if snapshot is not None and snapshot.source_version == version:
+                snapshot.users += 1
+                return snapshot
+        self._schedule_build(database_name, version)
+        raise EngineUnavailable(f"The columnar snapshot of {database_name} is being built", reason='stale')
+
+    def release(self, snapshot):
+        with self._lock:
+            snapshot.users -= 1
+            if snapshot.retired and snapshot.users == 0:
+                snapshot.conn.close()
+
+    def execute(self, sql_query, database_name, params=(), job=None):
+        import duckdb
+
+        try:
+            translated = to_duckdb_sql(sql_query)
+            unordered = has_engine_defined_order(sql_query)
+        except NoMatch as e:
+            raise EngineUnavailable(str(e), reason='untranslatable')
+        if unordered:
+            raise EngineUnavailable("Rows would come back in a different order than on SQLite", reason='unordered')
+        snapshot = self.snapshot(database_name)
+        budget = getattr(settings, 'QUERY_ENGINE_SQL_TIME_BUDGET', None)
+        deadline = time.monotonic() + budget if budget else None
+        try:
+            cursor = snapshot.conn.cursor()
+        except BaseException:
+            self.release(snapshot)
+            raise
+        finished = threading.Event()
+
+        def watch():
+            # DuckDB has no progress handler, so the deadline and cancel flag are polled here
+            while not finished.wait(0.05):
+                if (deadline is not None and time.monotonic() > deadline) or (job is not None and job.cancelled()):
+                    cursor.interrupt()
+                    return
+
+        watcher = None
+        if deadline is not None or job is not None:
+            watcher = threading.Thread(target=watch, name='columnar-budget', daemon=True)
+            watcher.start()
+        try:
+            with (job.attached(cursor) if job else nullcontext()):
+                cursor.execute(translated, list(params))
+                description = cursor.description or []
+                rows = cursor.fetchall()
+        except duckdb.InterruptException:
+            if deadline is not None and time.monotonic() > deadline:
+                raise BudgetExceeded(f"Query exceeded the {budget}s execution time budget")
+            raise sqlite3.OperationalError('interrupted')
+        except duckdb.Error as e:
+            raise EngineUnavailable(str(e))
+        finally:
+            finished.set()
+            if watcher is not None:
+                watcher.join()
+            cursor.close()
+            self.release(snapshot)
+
+        # DuckDB names unaliased expressions differently, e.g. count_star() for COUNT(*)
+        columns = result_columns(sql_query, database_name, params)
+        if columns is None or len(columns) != len(description):
+            columns = [column[0] for column in description]
+        convert = [i for i, column in enumerate(description) if str(column[1]) not in NATIVE_RESULT_TYPES]
+        if convert:
+            rows = [
+                tuple(sqlite_value(value) if i in convert else value for i, value in enumerate(row)) for row in rows
+            ]
+        return columns, rows
+
+    def stats(self):
+        return {
+            name: {'path': snapshot.path, 'current': snapshot.source_version == get_database_version(name)}
+            for name, snapshot in dict(self._snapshots).items()
+        }
+
+
+ENGINES = {
+    'sqlite': SQLiteEngine,
+    'duckdb': DuckDBEngine,
+}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name):
+    """Return the engine registered under name, or imported from a dotted path"""
+    engine = _engines.get(name)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine_class = ENGINES[name] if name in ENGINES else import_string(name)
+                engine = _engines[name] = engine_class()
+    return engine
+
+
+def scanned_rows(sql_query, db_path):
+    """Rows the statement reads: the plan's estimate, else the size of the tables it reads"""
+    plan = plan_query(sql_query, db_path)
+    if plan['estimated_rows'] is not None:
+        return plan['estimated_rows']
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        total = 0
+        for table in plan['tables']:
+            try:
+                total += conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+            except sqlite3.Error:
+                # WITHOUT ROWID tables and views
+                total += conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        return total
+    finally:
+        conn.close()
+
+
+@lru_cache(maxsize=1024)
+def _auto_engine(sql_query, database_name, version, min_rows):
+    if not ANALYTIC_PATTERN.search(sql_query):
+        return 'sqlite'
+    try:
+        rows = scanned_rows(sql_query, get_database_path(database_name))
+    except sqlite3.Error:
+        return 'sqlite'
+    return 'duckdb' if rows >= min_rows else 'sqlite'
+
+
+def choose_engine(sql_query, database_name):
+    """
+    Name of the engine a statement should run on
+
+    QUERY_ENGINE_DATABASE_ENGINES maps a database to an engine name or
+    'auto'; auto sends aggregates and joins that read at least
+    QUERY_ENGINE_COLUMNAR_MIN_ROWS rows to the columnar engine.
+    """
+    choice = getattr(settings, 'QUERY_ENGINE_DATABASE_ENGINES', {}).get(
+        database_name, getattr(settings, 'QUERY_ENGINE_DEFAULT_ENGINE', 'sqlite')
+    )
+    if choice == 'auto':
+        return _auto_engine(
+            sql_query, database_name, get_database_version(database_name),
+            getattr(settings, 'QUERY_ENGINE_COLUMNAR_MIN_ROWS', 100000)
+        )
+    return choice
+
+
+def _execute_on(name, sql_query, database_name, params, job):
+    start_time = time.perf_counter()
+    try:
+        columns, rows = get_engine(name).execute(sql_query, database_name, params, job)
+    except EngineUnavailable:
+        raise
+    except BudgetExceeded:
+        metrics.count_budget_kill(database_name)
+        metrics.observe_sql(database_name, 'budget_exceeded', time.perf_counter() - start_time, name)
+        raise
+    except Exception:
+        metrics.observe_sql(database_name, 'error', time.perf_counter() - start_time, name)
+        raise
+    metrics.observe_sql(database_name, 'success', time.perf_counter() - start_time, name)
+    return columns, rows
+
+
+def run(sql_query, database_name, params=(), job=None):
+    """
+    Execute a statement on its engine, falling back to SQLite
+
+    Returns:
+        Tuple of (engine name, columns, rows)
+    """
+    name = choose_engine(sql_query, database_name)
+    if name != 'sqlite':
+        try:
+            return (name, *_execute_on(name, sql_query, database_name, params, job))
+        except EngineUnavailable as e:
+            metrics.count_engine_fallback(name, e.reason)
+            logger.debug("Running on sqlite instead of %s: %s", name, e)
+    return ('sqlite', *_execute_on('sqlite', sql_query, database_name, params, job))
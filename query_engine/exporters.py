@@ -0,0 +1,266 @@
+import re
+from .connections import time_budget
+
+EXPORT_BATCH_SIZE = 10000
+
+# Rows read to type the export's columns before streaming starts
+EXPORT_PROFILE_ROWS = 100000
+
+EXPORT_CONTENT_TYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+EXPORT_EXTENSIONS = {
+    'arrow': 'arrows',
+    'parquet': 'parquet',
+}
+
+
+class ChunkSink:
+    """Minimal writable file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_type_for_declared(declared_type):
+    """
+    Map a SQLite declared column type to an Arrow type following SQLite's affinity rules
+
+    Returns None for expression columns, which have no declared type.
+    """
+    import pyarrow as pa
+
+    declared_type = (declared_type or '').upper()
+    if not declared_type:
+        return None
+    if 'INT' in declared_type:
+        return pa.int64()
+    if declared_type.startswith('DATETIME') or declared_type.startswith('TIMESTAMP'):
+        return pa.timestamp('us')
+    if declared_type.startswith('DATE'):
+        return pa.date32()
+    if 'CHAR' in declared_type or 'CLOB' in declared_type or 'TEXT' in declared_type:
+        return pa.string()
+    if 'BLOB' in declared_type:
+        return pa.binary()
+    if 'BOOL' in declared_type:
+        return pa.bool_()
+    # REAL, FLOAT, DOUBLE and NUMERIC/DECIMAL affinities
+    return pa.float64()
+
+
+# Text SQLite's date functions understand and Arrow can cast, without a UTC offset
+DATE_PATTERN = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+TIMESTAMP_CHECK = (
+    "{c} GLOB '" + DATE_PATTERN + "*' AND {c} NOT GLOB '*[+Z]*'"
+    " AND {c} NOT GLOB '*[0-9]-[0-9][0-9]:[0-9][0-9]' AND datetime({c}) IS NOT NULL"
+)
+DATE_CHECK = "{c} GLOB '" + DATE_PATTERN + "' AND date({c}) IS NOT NULL"
+
+# Storage classes probed per column, followed by the two date checks
+STORAGE_CLASSES = ('integer', 'real', 'text', 'blob')
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def profile_columns(conn, sql_query, sample_rows=EXPORT_PROFILE_ROWS):
+    """
+    Resolve the declared type of each result column and the storage classes of its values
+
+    The statement is wrapped in a temporary view, whose columns inherit the
+    declared types of the table columns they select; its first sample_rows
+    rows are then scanned to see which storage classes every column holds,
+    since SQLite lets any column hold any class. The temp schema lives in
+    memory, so this also works on read-only connections.
+
+    Returns:
+        List of (declared type, set of storage classes, text is not a date,
+        text is not a timestamp) per column
+    """
+    statement = sql_query.strip().rstrip(';')
+    conn.execute(f"CREATE TEMP VIEW _export_columns AS {statement}")
+    try:
+        info = [(row[1], row[2]) for row in conn.execute("PRAGMA temp.table_info(_export_columns)")]
+        probes = []
+        for name, _ in info:
+            column = quote_identifier(name)
+            probes.extend(f"MAX(typeof({column}) = '{kind}')" for kind in STORAGE_CLASSES)
+            probes.append(f"MAX(typeof({column}) = 'text' AND NOT ({DATE_CHECK.format(c=column)}))")
+            probes.append(f"MAX(typeof({column}) = 'text' AND NOT ({TIMESTAMP_CHECK.format(c=column)}))")
+        flags = conn.execute(
+            f"SELECT {', '.join(probes)} FROM (SELECT * FROM temp._export_columns LIMIT ?)", (sample_rows,)
+        ).fetchone()
+    finally:
+        conn.execute("DROP VIEW temp._export_columns")
+
+    width = len(STORAGE_CLASSES) + 2
+    profiles = []
+    for index, (_, declared) in enumerate(info):
+        column_flags = flags[index * width:(index + 1) * width]
+        classes = {kind for kind, present in zip(STORAGE_CLASSES, column_flags) if present}
+        profiles.append((declared, classes, bool(column_flags[-2]), bool(column_flags[-1])))
+    return profiles
+
+
+def resolve_arrow_type(declared, classes, bad_dates, bad_timestamps):
+    """
+    Pick an Arrow type that holds every value of a column
+
+    The declared type wins when the values fit it; otherwise integers and
+    reals widen to float64 and anything mixed with text or blobs becomes a
+    string, so no value is truncated or fails to convert mid-stream.
+    """
+    import pyarrow as pa
+
+    arrow_type = arrow_type_for_declared(declared)
+    numeric = classes <= {'integer', 'real'}
+    if arrow_type is None:
+        if not classes or 'text' in classes or ('blob' in classes and classes != {'blob'}):
+            return pa.string()
+        if classes == {'blob'}:
+            return pa.binary()
+        return pa.float64() if 'real' in classes else pa.int64()
+    if pa.types.is_timestamp(arrow_type):
+        return arrow_type if classes <= {'text'} and not bad_timestamps else pa.string()
+    if pa.types.is_date(arrow_type):
+        return arrow_type if classes <= {'text'} and not bad_dates else pa.string()
+    if pa.types.is_integer(arrow_type):
+        if classes <= {'integer'}:
+            return arrow_type
+        return pa.float64() if numeric else pa.string()
+    if pa.types.is_boolean(arrow_type):
+        return arrow_type if classes <= {'integer'} else pa.float64() if numeric else pa.string()
+    if pa.types.is_floating(arrow_type):
+        return arrow_type if numeric else pa.string()
+    if pa.types.is_binary(arrow_type):
+        return arrow_type if classes <= {'blob'} else pa.string()
+    return arrow_type
+
+
+def build_schema(columns, profiles):
+    """Build the Arrow schema from the column profiles"""
+    import pyarrow as pa
+
+    return pa.schema([
+        pa.field(name, resolve_arrow_type(*profile)) for name, profile in zip(columns, profiles)
+    ])
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.hex()
+    return str(value)
+
+
+def record_batch(schema, rows):
+    """Convert cursor rows to a record batch, parsing SQLite date strings where needed"""
+    import pyarrow as pa
+
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            # SQLite stores dates as ISO-8601 text
+            arrays.append(pa.array(values, type=pa.string()).cast(field.type))
+        elif pa.types.is_string(field.type):
+            arrays.append(pa.array([to_text(value) for value in values], type=field.type))
+        elif pa.types.is_boolean(field.type):
+            # SQLite stores booleans as 0/1
+            arrays.append(pa.array([None if value is None else bool(value) for value in values], type=field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def stream_export(conn, sql_query, export_format, batch_size=EXPORT_BATCH_SIZE, budget=None,
+                  sample_rows=EXPORT_PROFILE_ROWS):
+    """
+    Execute a query and return a generator of Arrow IPC stream or Parquet bytes
+
+    The column types are resolved from the first sample_rows rows and the
+    first batch is converted before returning, so SQL and conversion errors
+    surface here rather than halfway through a streamed response; a later
+    value that doesn't fit the sampled type ends the stream with an error.
+    Rows are then fetched from the cursor batch by batch and the full result
+    is never materialized in Python. budget (seconds) bounds the whole
+    export, streaming included. The connection is closed once the generator
+    finishes or is closed by the response.
+    """
+    chunks = generate_export(conn, sql_query, export_format, batch_size, budget, sample_rows)
+    # Run everything up to the first write now; on error the generator has closed conn
+    next(chunks)
+    return chunks
+
+
+def generate_export(conn, sql_query, export_format, batch_size, budget, sample_rows):
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    try:
+        with time_budget(conn, budget):
+            profiles = profile_columns(conn, sql_query, sample_rows)
+            cursor = conn.execute(sql_query)
+            # Duplicate names (e.g. SELECT * over a join) are not allowed in Parquet
+            columns = unique_column_names([description[0] for description in cursor.description])
+            schema = build_schema(columns, profiles)
+            rows = cursor.fetchmany(batch_size)
+            batch = record_batch(schema, rows) if rows else None
+            yield b''
+
+            sink = ChunkSink()
+            if export_format == 'parquet':
+                writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+            else:
+                writer = pyarrow.ipc.new_stream(sink, schema)
+
+            while batch is not None:
+                writer.write_batch(batch)
+                data = sink.drain()
+                if data:
+                    yield data
+                rows = cursor.fetchmany(batch_size)
+                batch = record_batch(schema, rows) if rows else None
+
+            writer.close()
+            yield sink.drain()
+    finally:
+        conn.close()
+
+
+def unique_column_names(columns):
+    """Suffix repeated column names with _2, _3, ..."""
+    seen = {}
+    unique = []
+    for name in columns:
+        count = seen.get(name, 0) + 1
+        seen[name] = count
+        unique.append(name if count == 1 else f"{name}_{count}")
+    return unique
+
+
+def export_filename(source, export_format):
+    """Build a download filename like e_commerce_query_12.parquet"""
+    slug = re.sub(r'[^a-z0-9]+', '_', source.lower()).strip('_')
+    return f"{slug}.{EXPORT_EXTENSIONS[export_format]}"
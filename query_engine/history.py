@@ -0,0 +1,152 @@
+import base64
+import importlib
+import json
+import logging
+import re
+from django.db import connection, connections
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'authentication_querylog_search'
+
+# bm25 column weights: question, SQL, user_id (a filter only)
+SEARCH_WEIGHTS = (2.0, 1.0, 0.0)
+
+# Longer inputs are truncated; they only slow the match down
+MAX_SEARCH_TERMS = 16
+
+SEARCH_TERM_PATTERN = re.compile(r'\w+')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def search_migration():
+    return importlib.import_module('authentication.migrations.0003_querylog_search')
+
+
+def missing_search_triggers(using='default'):
+    """Names of the index triggers absent from the database, or None if there is no search index"""
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return None
+    with db.cursor() as cursor:
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE name LIKE %s", [SEARCH_TABLE + '%'])
+        present = {name for kind, name in cursor.fetchall()}
+    if SEARCH_TABLE not in present:
+        return None
+    return [name for name in search_migration().TRIGGER_STATEMENTS if name not in present]
+
+
+def ensure_search_index(using='default', **kwargs):
+    """
+    Recreate index triggers dropped by a table rebuild, then reindex
+
+    Runs after every migrate: SQLite rebuilds authentication_querylog for
+    most field changes, and the triggers go with the old table. Rows
+    written while they were missing are picked up by the rebuild.
+    """
+    missing = missing_search_triggers(using)
+    if not missing:
+        return
+    migration = search_migration()
+    logger.warning("Recreating query history search triggers: %s", ', '.join(missing))
+    with connections[using].cursor() as cursor:
+        for name in missing:
+            cursor.execute(migration.TRIGGER_STATEMENTS[name])
+        cursor.execute(migration.REBUILD_STATEMENT)
+
+
+def search_terms(text):
+    return SEARCH_TERM_PATTERN.findall(text.lower())[:MAX_SEARCH_TERMS]
+
+
+def fts_query(user_id, terms):
+    """
+    FTS5 MATCH expression for a user's rows containing every term
+
+    Terms are quoted so user input is never parsed as query syntax; the
+    last one matches as a prefix, for search-as-you-type.
+    """
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return f'user_id:"{user_id}" AND {{natural_language_query generated_sql}}: ({" ".join(quoted)})'
+
+
+def encode_cursor(score, query_id):
+    return base64.urlsafe_b64encode(json.dumps([score, query_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        score, query_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return float(score), int(query_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def search_history(user, text, database=None, limit=10, cursor=None):
+    """
+    Rank a user's logged queries against free text with bm25
+
+    Pages are keyset-paginated on (score, id): cursor is the next_cursor of
+    the previous page, so each page costs the same however deep it is.
+
+    Returns:
+        Tuple of (QueryLog list, best match first, and next_cursor or None)
+    """
+    from authentication.models import QueryLog
+
+    terms = search_terms(text)
+    if not terms:
+        return [], None
+    after = decode_cursor(cursor) if cursor else None
+
+    if connection.vendor != 'sqlite':
+        # No FTS5: substring match, newest first, with the id as the cursor
+        queries = QueryLog.objects.filter(user=user)
+        for term in terms:
+            queries = queries.filter(Q(natural_language_query__icontains=term) | Q(generated_sql__icontains=term))
+        if database:
+            queries = queries.filter(database_name=database)
+        if after:
+            queries = queries.filter(id__lt=after[1])
+        rows = list(queries.order_by('-id')[:limit + 1])
+        next_cursor = encode_cursor(0.0, rows[limit - 1].id) if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    sql = [
+        f"SELECT s.rowid, s.score FROM ("
+        f" SELECT rowid, bm25({SEARCH_TABLE}, {', '.join(str(weight) for weight in SEARCH_WEIGHTS)}) AS score"
+        f" FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+        f") s"
+    ]
+    params = [fts_query(user.id, terms)]
+    conditions = []
+    if database:
+        sql.append("JOIN authentication_querylog q ON q.id = s.rowid")
+        conditions.append("q.database_name = %s")
+        params.append(database)
+    if after:
+        # bm25 scores are negative; lower is a better match
+        conditions.append("(s.score > %s OR (s.score = %s AND s.rowid < %s))")
+        params.extend([after[0], after[0], after[1]])
+    if conditions:
+        sql.append("WHERE " + " AND ".join(conditions))
+    sql.append("ORDER BY s.score, s.rowid DESC LIMIT %s")
+    params.append(limit + 1)
+
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(' '.join(sql), params)
+        ranked = db_cursor.fetchall()
+
+    next_cursor = None
+    if len(ranked) > limit:
+        last_id, last_score = ranked[limit - 1]
+        next_cursor = encode_cursor(last_score, last_id)
+    ranked = ranked[:limit]
+    logs = QueryLog.objects.in_bulk([query_id for query_id, _ in ranked])
+    # A row deleted between the two reads is skipped
+    return [logs[query_id] for query_id, _ in ranked if query_id in logs], next_cursor
@@ -0,0 +1,308 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import close_old_connections
+from .admission import Throttled
+from .renderers import columnar_payload, dumps
+
+TERMINAL_STATES = ('succeeded', 'failed', 'cancelled')
+
+DEADLINE_ERROR = 'Job did not finish before its deadline'
+
+# Seconds a client is told to wait after a job was refused
+JOB_RETRY_AFTER = 5
+
+# Fields returned to clients; owner_id stays internal
+PUBLIC_FIELDS = (
+    'id', 'status', 'stage', 'database', 'query', 'sql_query', 'explanation', 'error',
+    'row_count', 'execution_time', 'summary_rewrite', 'created_at', 'started_at', 'finished_at', 'deadline',
+    'expires_at'
+)
+
+
+class JobFailed(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimedOut(JobCancelled):
+    pass
+
+
+class JobStore:
+    """
+    Job metadata and results spilled to a directory shared by all workers
+
+    Each job has <id>.json (metadata), <id>.result.json once it succeeds and
+    <id>.cancel when a cancel was requested. Files are replaced atomically so
+    readers in other processes never see a partial write.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = str(directory)
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, job_id, suffix):
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def _write_atomic(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def write(self, meta):
+        self._write_atomic(self.path(meta['id'], 'json'), json.dumps(meta).encode('utf-8'))
+
+    def read(self, job_id):
+        """Return the job's metadata, or None if it doesn't exist or has expired"""
+        try:
+            with open(self.path(job_id, 'json'), 'rb') as f:
+                meta = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        if meta.get('expires_at') and meta['expires_at'] < now:
+            self.delete(job_id)
+            return None
+        if meta['status'] not in TERMINAL_STATES and meta.get('deadline') and meta['deadline'] < now:
+            # The worker fails the job itself unless it died; either way it is over
+            meta.update(status='failed', stage='failed', error=DEADLINE_ERROR)
+        return meta
+
+    def write_result(self, job_id, payload):
+        self._write_atomic(self.path(job_id, 'result.json'), dumps(payload))
+
+    def read_result(self, job_id):
+        try:
+            with open(self.path(job_id, 'result.json'), 'rb') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def request_cancel(self, job_id):
+        self._write_atomic(self.path(job_id, 'cancel'), b'')
+
+    def cancel_requested(self, job_id):
+        return os.path.exists(self.path(job_id, 'cancel'))
+
+    def delete(self, job_id):
+        for suffix in ('json', 'result.json', 'cancel'):
+            try:
+                os.remove(self.path(job_id, suffix))
+            except OSError:
+                pass
+
+    def purge_expired(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name.endswith('.result.json'):
+                continue
+            job_id = name[:-len('.json')]
+            meta = self.read(job_id)
+            # read() already removed expired jobs; also drop results orphaned by a crash
+            if meta is None and os.path.exists(self.path(job_id, 'result.json')):
+                if os.path.getmtime(self.path(job_id, 'result.json')) + self.ttl < now:
+                    self.delete(job_id)
+
+
+class Job:
+    """Handle passed to the work function so it can report progress and be cancelled"""
+
+    # Seconds between checks for a cancel flag written by another worker
+    CANCEL_POLL_INTERVAL = 0.25
+
+    def __init__(self, store, meta):
+        self.store = store
+        self.meta = meta
+        self.id = meta['id']
+        self._cancelled = threading.Event()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._next_poll = 0.0
+
+    def update(self, **fields):
+        self.meta.update(fields)
+        self.store.write(self.meta)
+
+    def cancel(self):
+        """Cancel from this process: flag the job and interrupt any running statement"""
+        self._cancelled.set()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.interrupt()
+
+    def timed_out(self):
+        return self.meta.get('deadline') is not None and time.time() > self.meta['deadline']
+
+    def cancelled(self):
+        """True once the job was cancelled or ran past its deadline"""
+        if self._cancelled.is_set():
+            return True
+        if self.timed_out():
+            self._cancelled.set()
+            return True
+        # Also called from the sqlite progress handler, so the filesystem is polled sparingly
+        now = time.monotonic()
+        if now >= self._next_poll:
+            self._next_poll = now + self.CANCEL_POLL_INTERVAL
+            if self.store.cancel_requested(self.id):
+                self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled():
+            raise JobTimedOut() if self.timed_out() else JobCancelled()
+
+    @contextmanager
+    def attached(self, conn):
+        """Make conn the target of cancel() while the block runs"""
+        with self._lock:
+            self._conn = conn
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._conn = None
+
+
+class JobManager:
+    """Runs jobs on a local thread pool and keeps their state in a JobStore"""
+
+    def __init__(self):
+        self._executor = None
+        self._store = None
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = JobStore(
+                getattr(settings, 'QUERY_ENGINE_JOB_DIR', os.path.join(settings.BASE_DIR, 'query_jobs')),
+                getattr(settings, 'QUERY_ENGINE_JOB_TTL', 3600)
+            )
+        return self._store
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'QUERY_ENGINE_JOB_WORKERS', 2),
+                    thread_name_prefix='query-job'
+                )
+            return self._executor
+
+    def _admit(self, owner_id, max_in_flight):
+        """Refuse a new job when the owner or this worker's queue is at its limit; caller holds _lock"""
+        jobs = list(self._running.values())
+        if max_in_flight is not None and sum(1 for job in jobs if job.meta['owner_id'] == owner_id) >= max_in_flight:
+            raise Throttled('Too many jobs in progress for this user', 'job_concurrency', retry_after=JOB_RETRY_AFTER)
+        queued = sum(1 for job in jobs if job.meta['status'] == 'queued')
+        if queued >= getattr(settings, 'QUERY_ENGINE_JOB_MAX_QUEUED', 20):
+            raise Throttled('The job queue is full, please retry', 'job_queue', retry_after=JOB_RETRY_AFTER)
+
+    def submit(self, owner_id, query, database_name, work, max_in_flight=None):
+        """
+        Queue work(job) and return the new job's metadata
+
+        work returns a dict with columns, rows and execution_time, and raises
+        JobFailed (or any exception) on error. A job still unfinished at its
+        deadline fails, and its metadata expires a TTL later even if the
+        worker running it died.
+
+        Raises:
+            Throttled: if the owner already has max_in_flight unfinished jobs
+                in this worker, or QUERY_ENGINE_JOB_MAX_QUEUED jobs are
+                already waiting for a job thread
+        """
+        self.store.purge_expired()
+        now = time.time()
+        deadline = now + getattr(settings, 'QUERY_ENGINE_JOB_TIMEOUT', 1800)
+        meta = {
+            'id': str(uuid.uuid4()),
+            'owner_id': owner_id,
+            'status': 'queued',
+            'stage': 'queued',
+            'database': database_name,
+            'query': query,
+            'sql_query': None,
+            'explanation': None,
+            'error': None,
+            'row_count': None,
+            'execution_time': None,
+            'created_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'deadline': deadline,
+            'expires_at': deadline + self.store.ttl,
+        }
+        job = Job(self.store, meta)
+        with self._lock:
+            self._admit(owner_id, max_in_flight)
+            self._running[job.id] = job
+        self.store.write(meta)
+        self._get_executor().submit(self._run, job, work)
+        return meta
+
+    def _run(self, job, work):
+        try:
+            job.check_cancelled()
+            job.update(status='running', stage='starting', started_at=time.time())
+            outcome = work(job)
+            job.check_cancelled()
+            job.update(stage='saving')
+            self.store.write_result(job.id, columnar_payload(outcome['columns'], outcome['rows']))
+            self._finish(job, 'succeeded', row_count=len(outcome['rows']),
+                         execution_time=round(outcome['execution_time'], 3))
+        except JobTimedOut:
+            self._finish(job, 'failed', error=DEADLINE_ERROR)
+        except JobCancelled:
+            self._finish(job, 'cancelled', error='Job was cancelled')
+        except Exception as e:
+            if job.timed_out():
+                self._finish(job, 'failed', error=DEADLINE_ERROR)
+            elif job.cancelled():
+                self._finish(job, 'cancelled', error='Job was cancelled')
+            else:
+                self._finish(job, 'failed', error=str(e))
+        finally:
+            with self._lock:
+                self._running.pop(job.id, None)
+            # Worker threads hold their own Django DB connections
+            close_old_connections()
+
+    def _finish(self, job, status, **fields):
+        now = time.time()
+        job.update(status=status, stage=status, finished_at=now, expires_at=now + self.store.ttl, **fields)
+
+    def get(self, job_id):
+        return self.store.read(job_id)
+
+    def cancel(self, job_id):
+        """Request cancellation; jobs running in another worker notice the cancel flag"""
+        meta = self.store.read(job_id)
+        if meta is None or meta['status'] in TERMINAL_STATES:
+            return meta
+        self.store.request_cancel(job_id)
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            job.cancel()
+        return self.store.read(job_id)
+
+
+def public_job(meta):
+    return {field: meta.get(field) for field in PUBLIC_FIELDS}
+
+
+job_manager = JobManager()
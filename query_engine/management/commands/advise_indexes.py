@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from authentication.models import QueryLog
+from query_engine.database_schemas import DATABASES, get_database_path
+from query_engine.query_plan import check_generated_sql, explain_query_plan, full_scans, predicate_columns
+
+
+class Command(BaseCommand):
+    help = 'Replays logged SQL through EXPLAIN QUERY PLAN and proposes indexes for full scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='Only analyze this database')
+        parser.add_argument('--min-rows', type=int, default=500,
+                            help='Ignore scans on tables with fewer rows than this')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per statement when timing (best run is kept)')
+        parser.add_argument('--apply', action='store_true',
+                            help='Create the beneficial indexes on the target database files')
+
+    def handle(self, *args, **options):
+        databases = [options['database']] if options['database'] else list(DATABASES.keys())
+
+        for database_name in databases:
+            db_path = get_database_path(database_name)
+            if not db_path or not os.path.exists(db_path):
+                self.stdout.write(self.style.WARNING(f'Skipping {database_name}: database file not found'))
+                continue
+
+            workload = (
+                QueryLog.objects
+                .filter(database_name=database_name, success=True)
+                .values('generated_sql')
+                .annotate(count=Count('id'))
+                .order_by('-count')
+            )
+            # Only statements that pass the execute endpoint's check are replayed
+            workload = [
+                (entry['generated_sql'], entry['count']) for entry in workload
+                if check_generated_sql(entry['generated_sql']) is None
+            ]
+
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{database_name}: {len(workload)} distinct statements'
+            ))
+            if workload:
+                self.advise(database_name, db_path, workload, options)
+
+    def advise(self, database_name, db_path, workload, options):
+        source = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        row_counts = {
+            table: source.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            for table in DATABASES[database_name]['tables']
+        }
+        table_columns = {
+            table: [row[1] for row in source.execute(f'PRAGMA table_info({table})')]
+            for table in row_counts
+        }
+        indexed = self.leading_index_columns(source, row_counts)
+
+        # Find full scans of large tables and the columns that could avoid them
+        candidates = {}
+        for sql_query, count in workload:
+            try:
+                plan = explain_query_plan(source, sql_query)
+            except sqlite3.Error:
+                continue
+            for table in full_scans(plan, sql_query):
+                if row_counts.get(table, 0) < options['min_rows']:
+                    continue
+                self.stdout.write(f'  SCAN {table} ({row_counts[table]} rows) x{count}: {self.shorten(sql_query)}')
+                for column in predicate_columns(sql_query, table, table_columns[table]):
+                    if column in indexed[table]:
+                        continue
+                    candidates.setdefault((table, column), []).append((sql_query, count))
+
+        if not candidates:
+            self.stdout.write('  No index candidates')
+            source.close()
+            return
+
+        # Re-plan and time the affected statements against an in-memory copy
+        # that has the candidate index, so the real file is never touched
+        hypothetical = sqlite3.connect(':memory:')
+        source.backup(hypothetical)
+        source.close()
+
+        beneficial = []
+        for (table, column), statements in candidates.items():
+            index_name = f'idx_{table}_{column}'
+            before = sum(self.time_query(hypothetical, sql, options['repeat']) * count for sql, count in statements)
+
+            hypothetical.execute(f'CREATE INDEX {index_name} ON {table} ({column})')
+            hypothetical.execute(f'ANALYZE {index_name}')
+            improved = sum(
+                1 for sql, _ in statements
+                if table not in full_scans(explain_query_plan(hypothetical, sql), sql)
+            )
+            after = sum(self.time_query(hypothetical, sql, options['repeat']) * count for sql, count in statements)
+            hypothetical.execute(f'DROP INDEX {index_name}')
+
+            style = self.style.SUCCESS if improved else self.style.WARNING
+            self.stdout.write(style(
+                f'  {index_name}: removes scan in {improved}/{len(statements)} statements, '
+                f'{before * 1000:.2f}ms -> {after * 1000:.2f}ms'
+            ))
+            if improved and after < before:
+                beneficial.append((index_name, table, column, statements))
+        hypothetical.close()
+
+        if options['apply'] and beneficial:
+            self.apply(db_path, beneficial, options['repeat'])
+
+    def apply(self, db_path, beneficial, repeat):
+        # Logged statements are timed on a read-only connection; the writable
+        # one only ever runs CREATE INDEX and ANALYZE
+        reader = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        writer = sqlite3.connect(db_path)
+        try:
+            for index_name, table, column, statements in beneficial:
+                before = sum(self.time_query(reader, sql, repeat) * count for sql, count in statements)
+                writer.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({column})')
+                writer.execute(f'ANALYZE {index_name}')
+                writer.commit()
+                after = sum(self.time_query(reader, sql, repeat) * count for sql, count in statements)
+                self.stdout.write(self.style.SUCCESS(
+                    f'  Created {index_name}: {before * 1000:.2f}ms -> {after * 1000:.2f}ms'
+                ))
+        finally:
+            reader.close()
+            writer.close()
+
+    def leading_index_columns(self, conn, tables):
+        """Columns that already lead an index (or are the rowid alias) per table"""
+        indexed = {}
+        for table in tables:
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})') if row[5] == 1}
+            for index in conn.execute(f'PRAGMA index_list({table})').fetchall():
+                index_columns = conn.execute(f'PRAGMA index_info({index[1]})').fetchall()
+                if index_columns:
+                    columns.add(index_columns[0][2])
+            indexed[table] = columns
+        return indexed
+
+    def time_query(self, conn, sql_query, repeat):
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            conn.execute(sql_query).fetchall()
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def shorten(self, sql_query, length=80):
+        sql_query = ' '.join(sql_query.split())
+        return sql_query if len(sql_query) <= length else sql_query[:length - 3] + '...'
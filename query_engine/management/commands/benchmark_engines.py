@@ -0,0 +1,201 @@
+import math
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from django.core.management.base import BaseCommand, CommandError
+from query_engine.database_schemas import DATABASES, get_database_path
+from query_engine.engines import DuckDBEngine, build_snapshot, quote, to_duckdb_sql
+
+# Analyst-style aggregations per bundled schema
+WORKLOADS = {
+    'E-Commerce': [
+        ("revenue by category and month",
+         "SELECT p.category, strftime('%Y-%m', o.order_date) AS month, SUM(oi.subtotal) AS revenue, "
+         "COUNT(DISTINCT o.order_id) AS orders FROM order_items oi "
+         "JOIN orders o ON o.order_id = oi.order_id JOIN products p ON p.product_id = oi.product_id "
+         "GROUP BY p.category, month ORDER BY p.category, month"),
+        ("top customers by spend",
+         "SELECT c.country, c.city, COUNT(*) AS orders, SUM(o.total_amount) AS spend, AVG(o.total_amount) AS average "
+         "FROM orders o JOIN customers c ON c.customer_id = o.customer_id "
+         "GROUP BY c.country, c.city ORDER BY spend DESC, c.country, c.city LIMIT 20"),
+        ("order status mix",
+         "SELECT status, COUNT(*) AS orders, SUM(total_amount) AS total, MIN(order_date) AS first, "
+         "MAX(order_date) AS last FROM orders GROUP BY status ORDER BY status"),
+    ],
+    'Hospital Management': [
+        ("appointments per doctor and status",
+         "SELECT d.specialization, a.status, COUNT(*) AS appointments, COUNT(DISTINCT a.patient_id) AS patients "
+         "FROM appointments a JOIN doctors d ON d.doctor_id = a.doctor_id "
+         "GROUP BY d.specialization, a.status ORDER BY d.specialization, a.status"),
+        ("prescriptions by blood type",
+         "SELECT p.blood_type, pr.medication_name, COUNT(*) AS prescriptions FROM prescriptions pr "
+         "JOIN patients p ON p.patient_id = pr.patient_id "
+         "GROUP BY p.blood_type, pr.medication_name ORDER BY prescriptions DESC, p.blood_type, pr.medication_name "
+         "LIMIT 20"),
+    ],
+    'School Management': [
+        ("average grade per course",
+         "SELECT c.course_name, c.semester, AVG(g.grade_value * 100.0 / g.max_points) AS average_percent, "
+         "COUNT(*) AS grades FROM grades g JOIN enrollments e ON e.enrollment_id = g.enrollment_id "
+         "JOIN courses c ON c.course_id = e.course_id GROUP BY c.course_name, c.semester "
+         "ORDER BY c.course_name, c.semester"),
+        ("grades per student grade level",
+         "SELECT s.grade_level, e.status, COUNT(*) AS grades, MAX(g.grade_value) AS best FROM grades g "
+         "JOIN enrollments e ON e.enrollment_id = g.enrollment_id JOIN students s ON s.student_id = e.student_id "
+         "GROUP BY s.grade_level, e.status ORDER BY s.grade_level, e.status"),
+    ],
+}
+
+
+def scale_database(path, factor):
+    """
+    Append factor - 1 copies of every row to the tables of a SQLite file
+
+    Integer primary keys and the foreign keys pointing at them are shifted
+    by the table's original maximum key per copy, so joins keep matching,
+    and unique text columns get a copy suffix.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        tables = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        )]
+        keys, offsets = {}, {}
+        for table in tables:
+            primary = [row[1] for row in conn.execute(f"PRAGMA table_info({quote(table)})") if row[5]]
+            if len(primary) == 1:
+                keys[table] = primary[0]
+                offsets[table] = conn.execute(
+                    f"SELECT COALESCE(MAX({quote(primary[0])}), 0) FROM {quote(table)}"
+                ).fetchone()[0]
+
+        conn.execute("BEGIN")
+        for table in tables:
+            if table not in keys:
+                continue
+            references = {row[3]: row[2] for row in conn.execute(f"PRAGMA foreign_key_list({quote(table)})")}
+            unique = set()
+            for index in conn.execute(f"PRAGMA index_list({quote(table)})"):
+                if index[2]:
+                    unique.update(row[2] for row in conn.execute(f"PRAGMA index_info({quote(index[1])})"))
+
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quote(table)})")]
+            selected = []
+            for column in columns:
+                if column == keys[table]:
+                    selected.append(f"{quote(column)} + copies.k * {offsets[table]}")
+                elif references.get(column) in offsets:
+                    selected.append(f"{quote(column)} + copies.k * {offsets[references[column]]}")
+                elif column in unique:
+                    selected.append(f"{quote(column)} || '+' || copies.k")
+                else:
+                    selected.append(quote(column))
+            conn.execute(
+                f"INSERT INTO {quote(table)} ({', '.join(quote(column) for column in columns)}) "
+                f"WITH RECURSIVE copies(k) AS (SELECT 1 UNION ALL SELECT k + 1 FROM copies WHERE k < ?) "
+                f"SELECT {', '.join(selected)} FROM {quote(table)}, copies",
+                (factor - 1,)
+            )
+        conn.execute("COMMIT")
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+def same_results(expected, actual):
+    """True if both engines returned the same rows in the same order, up to float rounding"""
+    if len(expected) != len(actual):
+        return False
+    for expected_row, actual_row in zip(expected, actual):
+        for a, b in zip(expected_row, actual_row):
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                if not math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-6):
+                    return False
+            elif a != b:
+                return False
+    return True
+
+
+def timed(run, repeat):
+    timings, result = [], None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings), result
+
+
+class Command(BaseCommand):
+    help = 'Compares the sqlite and duckdb execution engines on scaled-up copies of the bundled databases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='Only benchmark this database')
+        parser.add_argument('--scale', type=int, nargs='+', default=[100],
+                            help='Scale factors: each table holds this many copies of its rows')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per query; the median is reported')
+
+    def handle(self, *args, **options):
+        if any(factor < 1 for factor in options['scale']):
+            raise CommandError('Scale factors must be at least 1')
+        databases = [options['database']] if options['database'] else list(WORKLOADS)
+        try:
+            import duckdb
+        except ImportError:
+            duckdb = None
+            self.stdout.write(self.style.WARNING('duckdb is not installed; only sqlite timings are reported'))
+
+        work_dir = tempfile.mkdtemp(prefix='benchmark_engines_')
+        try:
+            for database_name in databases:
+                if database_name not in DATABASES or database_name not in WORKLOADS:
+                    raise CommandError(f'No benchmark workload for {database_name}')
+                db_path = get_database_path(database_name)
+                if not os.path.exists(db_path):
+                    self.stdout.write(self.style.WARNING(f'Skipping {database_name}: database file not found'))
+                    continue
+                for factor in options['scale']:
+                    self._benchmark(database_name, db_path, factor, options['repeat'], duckdb, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _benchmark(self, database_name, db_path, factor, repeat, duckdb, work_dir):
+        copy_path = os.path.join(work_dir, f'x{factor}_{os.path.basename(db_path)}')
+        shutil.copyfile(db_path, copy_path)
+        start_time = time.perf_counter()
+        scale_database(copy_path, factor)
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{database_name} x{factor} ({os.path.getsize(copy_path) / 1024 / 1024:.1f}MB, '
+            f'scaled in {time.perf_counter() - start_time:.1f}s)'
+        ))
+
+        columnar = None
+        if duckdb is not None:
+            snapshot = copy_path + '.duckdb'
+            start_time = time.perf_counter()
+            build_snapshot(copy_path, snapshot)
+            self.stdout.write(f'  snapshot built in {time.perf_counter() - start_time:.1f}s')
+            columnar = duckdb.connect(snapshot, read_only=True, config=dict(DuckDBEngine.CONFIG))
+
+        row_store = sqlite3.connect(f'file:{copy_path}?mode=ro', uri=True)
+        try:
+            for label, sql_query in WORKLOADS[database_name]:
+                sqlite_seconds, expected = timed(lambda: row_store.execute(sql_query).fetchall(), repeat)
+                line = f'  {label}: sqlite {sqlite_seconds * 1000:.1f}ms'
+                if columnar is None:
+                    self.stdout.write(line)
+                    continue
+
+                translated = to_duckdb_sql(sql_query)
+                duckdb_seconds, actual = timed(lambda: columnar.execute(translated).fetchall(), repeat)
+                line += f', duckdb {duckdb_seconds * 1000:.1f}ms ({sqlite_seconds / duckdb_seconds:.1f}x)'
+                if same_results(expected, actual):
+                    self.stdout.write(self.style.SUCCESS(line))
+                else:
+                    self.stdout.write(self.style.ERROR(f'{line} - results differ'))
+        finally:
+            row_store.close()
+            if columnar is not None:
+                columnar.close()
@@ -0,0 +1,23 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from query_engine.analytics import prune_rollups, refresh_rollups
+
+
+class Command(BaseCommand):
+    help = 'Folds newly logged queries into the workload analytics rollups and prunes old rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int,
+                            default=getattr(settings, 'QUERY_ENGINE_ANALYTICS_RETENTION_DAYS', 90),
+                            help='Delete rollups older than this many days (0 keeps everything)')
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        absorbed = refresh_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f'Absorbed {absorbed} query log rows in {(time.perf_counter() - start_time) * 1000:.1f}ms'
+        ))
+        if options['retention_days']:
+            pruned = prune_rollups(options['retention_days'])
+            self.stdout.write(self.style.SUCCESS(f'Pruned {pruned} rollup rows'))
@@ -0,0 +1,39 @@
+import os
+import sqlite3
+import time
+from django.core.management.base import BaseCommand
+from query_engine.database_schemas import DATABASES, get_database_path
+from query_engine.summaries import refresh_summary, summary_specs
+
+
+class Command(BaseCommand):
+    help = 'Folds new fact rows into the summary tables declared for each database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', help='Only refresh this database')
+        parser.add_argument('--full', action='store_true',
+                            help='Rebuild from scratch even if no source row changed')
+
+    def handle(self, *args, **options):
+        databases = [options['database']] if options['database'] else list(DATABASES.keys())
+
+        for database_name in databases:
+            specs = summary_specs(database_name)
+            if not specs:
+                continue
+            db_path = get_database_path(database_name)
+            if not db_path or not os.path.exists(db_path):
+                self.stdout.write(self.style.WARNING(f'Skipping {database_name}: database file not found'))
+                continue
+
+            conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+            try:
+                for name, spec in specs.items():
+                    start_time = time.perf_counter()
+                    absorbed = refresh_summary(conn, name, spec, full=options['full'])
+                    self.stdout.write(self.style.SUCCESS(
+                        f'{database_name}: {name} absorbed {absorbed} rows '
+                        f'in {(time.perf_counter() - start_time) * 1000:.1f}ms'
+                    ))
+            finally:
+                conn.close()
@@ -0,0 +1,84 @@
+import os
+import re
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Loads the WSGI application and the URLconf, which is what a worker does before its first request
+BOOT_SCRIPT = (
+    "import {wsgi_module}; "
+    "from django.urls import get_resolver; "
+    "get_resolver().url_patterns"
+)
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| *(\S+)$')
+
+
+class Command(BaseCommand):
+    help = 'Measures cold-start import cost of a worker with python -X importtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15,
+                            help='Number of modules and packages to list')
+        parser.add_argument('--import', dest='extra_imports', action='append', default=[],
+                            help='Additional module to import after boot (repeatable)')
+
+    def handle(self, *args, **options):
+        wsgi_module = settings.WSGI_APPLICATION.rsplit('.', 1)[0]
+        script = BOOT_SCRIPT.format(wsgi_module=wsgi_module)
+        for module in options['extra_imports']:
+            script += f"; import {module}"
+
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get(
+            'DJANGO_SETTINGS_MODULE', 'sql_generator.settings'
+        ))
+        start_time = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True
+        )
+        wall_time = time.perf_counter() - start_time
+
+        if process.returncode != 0:
+            self.stderr.write(process.stderr.splitlines()[-1] if process.stderr else 'Boot failed')
+            return
+
+        modules = []
+        for line in process.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, name = match.groups()
+                modules.append((name, int(self_us), int(cumulative_us)))
+
+        # Self time summed per top-level package shows who really pays for startup
+        packages = {}
+        for name, self_us, _ in modules:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + self_us
+        total_us = sum(packages.values())
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'Worker boot: {wall_time * 1000:.0f}ms wall, {total_us / 1000:.0f}ms importing {len(modules)} modules'
+        ))
+
+        self.stdout.write(self.style.MIGRATE_LABEL('\nSelf time by top-level package:'))
+        for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            share = self_us / total_us * 100 if total_us else 0
+            self.stdout.write(f'  {self_us / 1000:8.1f}ms  {share:5.1f}%  {package}')
+
+        self.stdout.write(self.style.MIGRATE_LABEL('\nSlowest modules (cumulative, including their imports):'))
+        for name, _, cumulative_us in sorted(modules, key=lambda item: -item[2])[:options['top']]:
+            self.stdout.write(f'  {cumulative_us / 1000:8.1f}ms  {name}')
+
+        local_modules = [
+            (name, cumulative_us) for name, _, cumulative_us in modules
+            if name.split('.')[0] in ('query_engine', 'authentication', 'sql_generator')
+        ]
+        self.stdout.write(self.style.MIGRATE_LABEL('\nProject modules (cumulative):'))
+        for name, cumulative_us in sorted(local_modules, key=lambda item: -item[1]):
+            self.stdout.write(f'  {cumulative_us / 1000:8.1f}ms  {name}')
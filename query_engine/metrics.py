@@ -0,0 +1,197 @@
+# Prometheus metrics for the query engine.
+#
+# prometheus_client is imported and the metric objects are created on first
+# use so the import stays out of worker cold start. When the
+# PROMETHEUS_MULTIPROC_DIR environment variable points at a shared directory,
+# every worker process writes its samples there and /metrics aggregates all of
+# them; gunicorn should then call multiprocess.mark_process_dead(worker.pid)
+# from its child_exit hook.
+import os
+import threading
+from contextlib import contextmanager
+
+# Buckets in seconds, covering fast sqlite lookups up to slow LLM completions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+class _Metrics:
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.llm_latency = Histogram(
+            'query_engine_llm_seconds', 'Latency of LLM SQL generation calls',
+            ['database', 'outcome', 'tier'], buckets=LATENCY_BUCKETS
+        )
+        self.llm_cost = Counter(
+            'query_engine_llm_cost_usd_total', 'Estimated LLM spend from configured token prices',
+            ['model', 'tier']
+        )
+        self.llm_retries = Counter(
+            'query_engine_llm_retries_total', 'LLM retries, hedged duplicates and calls refused by the open circuit',
+            ['reason']
+        )
+        self.llm_escalations = Counter(
+            'query_engine_llm_escalations_total', 'Fast-tier generations that failed validation and were retried',
+            ['database']
+        )
+        self.sql_latency = Histogram(
+            'query_engine_sql_seconds', 'Latency of SQL execution against target databases',
+            ['database', 'outcome', 'engine'], buckets=LATENCY_BUCKETS
+        )
+        self.engine_fallbacks = Counter(
+            'query_engine_engine_fallbacks_total', 'Statements routed to another engine that ran on SQLite instead',
+            ['engine', 'reason']
+        )
+        self.request_latency = Histogram(
+            'query_engine_request_seconds', 'End-to-end latency of execute requests',
+            ['database', 'outcome'], buckets=LATENCY_BUCKETS
+        )
+        self.sql_validations = Counter(
+            'query_engine_sql_validations_total', 'Generated SQL checked against the schema clone before execution',
+            ['database', 'outcome']
+        )
+        self.cache_lookups = Counter(
+            'query_engine_cache_lookups_total', 'Cache lookups by cache and result',
+            ['cache', 'result']
+        )
+        self.budget_kills = Counter(
+            'query_engine_budget_kills_total', 'Statements interrupted for exceeding the time budget',
+            ['database']
+        )
+        self.permission_denials = Counter(
+            'query_engine_permission_denials_total', 'Requests rejected by the database access check',
+            ['database']
+        )
+        self.throttled = Counter(
+            'query_engine_throttled_total', 'Execute requests rejected by admission control',
+            ['reason']
+        )
+        self.llm_tokens = Counter(
+            'query_engine_llm_tokens_total', 'LLM tokens used',
+            ['model', 'kind']
+        )
+        self.pool_utilization = Gauge(
+            'query_engine_pool_utilization', 'Fraction of pooled connections in use',
+            ['database'], multiprocess_mode='livemax'
+        )
+        self.memory_copy_bytes = Gauge(
+            'query_engine_memory_copy_bytes', 'Size of in-memory copies of target databases',
+            ['database'], multiprocess_mode='livesum'
+        )
+        self.in_flight = Gauge(
+            'query_engine_in_flight_requests', 'Execute requests currently being processed',
+            multiprocess_mode='livesum'
+        )
+
+
+def _get():
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = _Metrics()
+    return _metrics
+
+
+def database_label(database_name):
+    """Only known databases become label values, so user input can't explode cardinality"""
+    from .database_schemas import DATABASES
+    return database_name if database_name in DATABASES else 'unknown'
+
+
+def observe_llm(database_name, outcome, seconds, model=None, usage=None, tier='strong', cost=None):
+    metrics = _get()
+    metrics.llm_latency.labels(database_label(database_name), outcome, tier).observe(seconds)
+    if model and usage:
+        metrics.llm_tokens.labels(model, 'prompt').inc(usage.get('prompt_tokens') or 0)
+        metrics.llm_tokens.labels(model, 'completion').inc(usage.get('completion_tokens') or 0)
+    if model and cost:
+        metrics.llm_cost.labels(model, tier).inc(cost)
+
+
+def count_llm_retry(reason):
+    _get().llm_retries.labels(reason).inc()
+
+
+def count_escalation(database_name):
+    _get().llm_escalations.labels(database_label(database_name)).inc()
+
+
+def count_validation(database_name, outcome):
+    _get().sql_validations.labels(database_label(database_name), outcome).inc()
+
+
+def observe_sql(database_name, outcome, seconds, engine='sqlite'):
+    _get().sql_latency.labels(database_label(database_name), outcome, engine).observe(seconds)
+
+
+def count_engine_fallback(engine, reason):
+    _get().engine_fallbacks.labels(engine, reason).inc()
+
+
+def observe_request(database_name, outcome, seconds):
+    _get().request_latency.labels(database_label(database_name), outcome).observe(seconds)
+
+
+def count_cache(cache, hit):
+    _get().cache_lookups.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def count_budget_kill(database_name):
+    _get().budget_kills.labels(database_label(database_name)).inc()
+
+
+def count_permission_denial(database_name):
+    _get().permission_denials.labels(database_label(database_name)).inc()
+
+
+def count_throttle(reason):
+    _get().throttled.labels(reason).inc()
+
+
+def set_pool_utilization(database_name, value):
+    _get().pool_utilization.labels(database_label(database_name)).set(value)
+
+
+def set_memory_copy_bytes(database_name, value):
+    _get().memory_copy_bytes.labels(database_label(database_name)).set(value)
+
+
+@contextmanager
+def track_in_flight():
+    gauge = _get().in_flight
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
+
+
+def outcome_for_status(status_code):
+    if status_code < 400:
+        return 'success'
+    if status_code == 403:
+        return 'denied'
+    if status_code == 429:
+        return 'throttled'
+    if status_code < 500:
+        return 'error'
+    return 'exception'
+
+
+def render_latest():
+    """Return (body, content_type) in the Prometheus text exposition format"""
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, REGISTRY, generate_latest
+
+    _get()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
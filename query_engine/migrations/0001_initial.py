@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-19 06:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database_name', models.CharField(max_length=50)),
+                ('schema_hash', models.CharField(max_length=40)),
+                ('skeleton', models.TextField()),
+                ('skeleton_hash', models.CharField(max_length=40)),
+                ('sql_template', models.TextField()),
+                ('parameters', models.JSONField(default=list)),
+                ('explanation', models.TextField(blank=True)),
+                ('example_question', models.TextField()),
+                ('hit_count', models.IntegerField(default=0)),
+                ('last_used_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-hit_count', '-created_at'],
+                'unique_together': {('database_name', 'schema_hash', 'skeleton_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.7 on 2026-10-19 06:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('query_engine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatementRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('database_name', models.CharField(max_length=50)),
+                ('sql_hash', models.CharField(max_length=64)),
+                ('sql', models.TextField()),
+                ('sample_question', models.TextField()),
+                ('queries', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+                ('timed_queries', models.IntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+                ('max_time', models.FloatField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('last_seen_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day'], name='query_engin_day_e2b9d7_idx')],
+                'unique_together': {('day', 'database_name', 'sql_hash')},
+            },
+        ),
+        migrations.CreateModel(
+            name='QueryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('database_name', models.CharField(max_length=50)),
+                ('queries', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('total_time', models.FloatField(default=0)),
+                ('max_time', models.FloatField(default=0)),
+                ('latency_histogram', models.JSONField(default=list)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='query_engin_bucket_11f91f_idx')],
+                'unique_together': {('bucket', 'database_name', 'user')},
+            },
+        ),
+    ]
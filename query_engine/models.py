@@ -1,3 +1,90 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class QueryTemplate(models.Model):
+    """
+    Generated SQL with its literals lifted into ? placeholders
+
+    skeleton is the normalized question with each parameterized literal
+    replaced by {0}, {1}, ...; parameters describe, per placeholder in
+    sql_template, which slot fills it and how the captured text is bound.
+    """
+    database_name = models.CharField(max_length=50)
+    schema_hash = models.CharField(max_length=40)
+    skeleton = models.TextField()
+    skeleton_hash = models.CharField(max_length=40)
+    sql_template = models.TextField()
+    parameters = models.JSONField(default=list)
+    explanation = models.TextField(blank=True)
+    example_question = models.TextField()
+    hit_count = models.IntegerField(default=0)
+    last_used_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['database_name', 'schema_hash', 'skeleton_hash']
+        ordering = ['-hit_count', '-created_at']
+    
+    def __str__(self):
+        return f"{self.database_name}: {self.skeleton}"
+
+
+class QueryRollup(models.Model):
+    """
+    QueryLog totals per hour, database and user, maintained incrementally
+    by query_engine.analytics
+
+    latency_histogram counts the timed queries per metrics.LATENCY_BUCKETS
+    bucket (plus one overflow bucket), so percentiles can be estimated for
+    any range of hours.
+    """
+    bucket = models.DateTimeField()
+    database_name = models.CharField(max_length=50)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    queries = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    rows = models.BigIntegerField(default=0)
+    total_time = models.FloatField(default=0)
+    max_time = models.FloatField(default=0)
+    latency_histogram = models.JSONField(default=list)
+    
+    class Meta:
+        unique_together = ['bucket', 'database_name', 'user']
+        indexes = [models.Index(fields=['bucket'])]
+    
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H}:00 {self.database_name} {self.user_id}: {self.queries}"
+
+
+class StatementRollup(models.Model):
+    """QueryLog totals per day and distinct generated SQL statement"""
+    day = models.DateField()
+    database_name = models.CharField(max_length=50)
+    sql_hash = models.CharField(max_length=64)
+    sql = models.TextField()
+    sample_question = models.TextField()
+    queries = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    timed_queries = models.IntegerField(default=0)
+    total_time = models.FloatField(default=0)
+    max_time = models.FloatField(default=0)
+    last_error = models.TextField(blank=True)
+    last_seen_at = models.DateTimeField()
+    
+    class Meta:
+        unique_together = ['day', 'database_name', 'sql_hash']
+        indexes = [models.Index(fields=['day'])]
+    
+    def __str__(self):
+        return f"{self.day} {self.database_name}: {self.sql[:60]}"
+
+
+class RollupState(models.Model):
+    """The id of the last QueryLog row folded into the rollups"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
@@ -0,0 +1,147 @@
+import marshal
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from .connections import BudgetExceeded, time_budget
+from .database_schemas import DATABASES, get_database_path
+
+# Worker process state. Workers are spawned, not forked, so nothing below is
+# shared with the web process; Django is never set up in a worker.
+_db_paths = {}
+_connections = {}
+
+
+def _connect(database_name):
+    conn = sqlite3.connect(f"file:{_db_paths[database_name]}?mode=ro", uri=True)
+    # Load the schema now so the first real query doesn't pay for it
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    _connections[database_name] = conn
+    return conn
+
+
+def _init_worker(db_paths):
+    _db_paths.update(db_paths)
+    for database_name, db_path in db_paths.items():
+        if os.path.exists(db_path):
+            _connect(database_name)
+
+
+def _ping(hold):
+    # Holding briefly keeps one fast-starting worker from answering every ping
+    time.sleep(hold)
+    return os.getpid()
+
+
+def _execute(database_name, sql_query, params, budget):
+    """
+    Run one statement in a worker process
+
+    Returns:
+        marshal bytes of (columns, rows); sqlite values (int, float, str,
+        bytes, None) are all marshal-native, so this is far cheaper than
+        pickling the row list
+    """
+    conn = _connections.get(database_name)
+    if conn is None:
+        if database_name not in _db_paths:
+            raise sqlite3.OperationalError(f"Unknown database: {database_name}")
+        conn = _connect(database_name)
+
+    with time_budget(conn, budget):
+        cursor = conn.execute(sql_query, params)
+        columns = [description[0] for description in cursor.description or []]
+        rows = cursor.fetchall()
+    return marshal.dumps((columns, rows))
+
+
+class ProcessExecutionBackend:
+    """
+    Runs SQL in a pool of pre-warmed worker processes
+
+    Each worker holds its own read-only connection per target database, so
+    CPU-heavy statements run on other cores instead of holding this
+    process's GIL. Workers are replaced after max_tasks_per_child tasks.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                db_paths = {name: get_database_path(name) for name in DATABASES}
+                self._executor = ProcessPoolExecutor(
+                    max_workers=getattr(settings, 'QUERY_ENGINE_PROCESS_POOL_SIZE', 2),
+                    # Forking a multi-threaded web worker is unsafe
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(db_paths,),
+                    max_tasks_per_child=getattr(settings, 'QUERY_ENGINE_PROCESS_MAX_TASKS_PER_CHILD', None)
+                )
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm(self, rounds=5):
+        """
+        Start every worker process now rather than on the first queries
+
+        Returns:
+            Set of worker pids that answered
+        """
+        executor = self._get_executor()
+        size = getattr(settings, 'QUERY_ENGINE_PROCESS_POOL_SIZE', 2)
+        pids = set()
+        for _ in range(rounds):
+            futures = [executor.submit(_ping, 0.1) for _ in range(size)]
+            pids.update(future.result() for future in futures)
+            if len(pids) >= size:
+                break
+        return pids
+
+    def execute(self, sql_query, database_name, params=()):
+        """
+        Returns:
+            Tuple of (columns, rows)
+
+        Raises:
+            BudgetExceeded: if the statement outlives the per-task timeout
+        """
+        timeout = getattr(
+            settings, 'QUERY_ENGINE_PROCESS_TASK_TIMEOUT',
+            getattr(settings, 'QUERY_ENGINE_SQL_TIME_BUDGET', None)
+        )
+        executor = self._get_executor()
+        # The worker enforces the same limit with its own time budget
+        future = executor.submit(_execute, database_name, sql_query, params, timeout)
+        try:
+            payload = future.result(timeout=timeout)
+        except FutureTimeout:
+            # Queueing counts against the timeout too; drop the task if it hasn't started
+            future.cancel()
+            raise BudgetExceeded(f"Query exceeded the {timeout}s execution time budget")
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            self._reset(executor)
+            raise
+        columns, rows = marshal.loads(payload)
+        return columns, rows
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+process_backend = ProcessExecutionBackend()
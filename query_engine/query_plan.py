@@ -0,0 +1,241 @@
+import re
+import sqlite3
+
+# Keywords that can follow a table name in FROM/JOIN and must not be mistaken for an alias
+SQL_KEYWORDS = {
+    'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural',
+    'on', 'using', 'group', 'order', 'having', 'limit', 'union', 'except', 'intersect',
+    'window', 'as', 'select', 'from', 'and', 'or', 'not'
+}
+
+# The alias is captured in a lookahead so a following JOIN keyword is not consumed
+TABLE_REFERENCE_PATTERN = re.compile(
+    r'\b(?:from|join)\s+([A-Za-z_]\w*)(?=(?:\s+(?:as\s+)?([A-Za-z_]\w*))?)',
+    re.IGNORECASE
+)
+
+CLAUSE_PATTERN = re.compile(
+    r'\b(select|from|where|join|on|group\s+by|order\s+by|having|limit|union)\b',
+    re.IGNORECASE
+)
+
+# String literals, quoted identifiers and comments, which may contain ';' or keywords
+QUOTED_OR_COMMENT_PATTERN = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\]|--[^\n]*|/\*.*?(?:\*/|\Z)""",
+    re.DOTALL
+)
+
+# What the model is told to answer with when a request doesn't fit the schema
+REFUSAL_SENTINEL = 'saeed'
+
+# Clauses whose column references can be served by an index
+PREDICATE_CLAUSES = {'where', 'on', 'group by', 'order by', 'having'}
+
+
+def explain_query_plan(conn, sql_query):
+    """Run EXPLAIN QUERY PLAN and return the plan as a list of dicts"""
+    cursor = conn.execute(f"EXPLAIN QUERY PLAN {sql_query}")
+    return [
+        {'id': row[0], 'parent': row[1], 'detail': row[3]}
+        for row in cursor.fetchall()
+    ]
+
+
+def table_aliases(sql_query):
+    """Map every alias (and bare table name) in FROM/JOIN clauses to its table"""
+    aliases = {}
+    for table, alias in TABLE_REFERENCE_PATTERN.findall(sql_query):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def parse_plan_step(detail):
+    """
+    Split a plan detail line into its parts
+
+    Returns:
+        Tuple of (operation, name, index) where operation is SCAN or SEARCH,
+        name is the table or alias as printed by SQLite and index is the index
+        used, if any. Returns (None, None, None) for other steps.
+    """
+    match = re.match(r'(SCAN|SEARCH) (\S+)(?: USING (?:COVERING )?INDEX (\S+))?', detail)
+    if not match:
+        return None, None, None
+    return match.group(1), match.group(2), match.group(3)
+
+
+def full_scans(plan, sql_query):
+    """Return the tables that the plan reads with a full table scan"""
+    aliases = table_aliases(sql_query)
+    tables = []
+    for step in plan:
+        operation, name, index = parse_plan_step(step['detail'])
+        if operation == 'SCAN' and ' USING ' not in step['detail']:
+            table = aliases.get(name.lower())
+            if table and table not in tables:
+                tables.append(table)
+    return tables
+
+
+def predicate_columns(sql_query, table_name, table_columns):
+    """
+    Find columns of a table referenced by WHERE, ON, GROUP BY, ORDER BY or HAVING
+
+    Qualified references are matched through the query's aliases. Bare column
+    names are only attributed to the table when it is the only one in the query.
+    """
+    # Literals may contain words that look like column names
+    sql_query = re.sub(r"'(?:[^']|'')*'", "''", sql_query)
+    aliases = table_aliases(sql_query)
+    own_aliases = {alias for alias, table in aliases.items() if table == table_name}
+    single_table = set(aliases.values()) == {table_name}
+    known = {column.lower() for column in table_columns}
+
+    parts = CLAUSE_PATTERN.split(sql_query)
+    columns = []
+    # re.split with a capturing group alternates text and the matched keyword
+    for i in range(1, len(parts) - 1, 2):
+        clause = ' '.join(parts[i].lower().split())
+        if clause not in PREDICATE_CLAUSES:
+            continue
+        text = parts[i + 1]
+        for qualifier, column in re.findall(r'(?:([A-Za-z_]\w*)\.)?([A-Za-z_]\w*)', text):
+            column = column.lower()
+            if column not in known or column in columns:
+                continue
+            if qualifier and qualifier.lower() in own_aliases:
+                columns.append(column)
+            elif not qualifier and single_table:
+                columns.append(column)
+    return columns
+
+
+def check_generated_sql(sql_query):
+    """
+    Cheap sanity checks on generated SQL that need no database access
+
+    Returns:
+        An error message, or None if the statement is worth planning
+    """
+    if not sql_query or not sql_query.strip():
+        return 'No SQL query was generated'
+
+    if sql_query.strip().lower() == REFUSAL_SENTINEL:
+        return 'The request is not valid for the selected database schema'
+
+    statement = QUOTED_OR_COMMENT_PATTERN.sub(
+        lambda match: ' ' if match.group()[0] in '-/' else "''", sql_query
+    ).strip().rstrip(';').strip()
+    if ';' in statement:
+        return 'Only a single SQL statement is allowed'
+
+    if not re.match(r'(select|with)\b', statement, re.IGNORECASE):
+        return 'Only SELECT statements are allowed'
+
+    return None
+
+
+def load_statistics(conn):
+    """Read sqlite_stat1 into {table: {'rows': n, 'indexes': {index: [n, avg1, avg2, ...]}}}"""
+    stats = {}
+    try:
+        rows = conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1").fetchall()
+    except sqlite3.OperationalError:
+        # ANALYZE has never been run on this database
+        return stats
+
+    for table, index, stat in rows:
+        numbers = [int(value) for value in stat.split() if value.isdigit()]
+        if not numbers:
+            continue
+        entry = stats.setdefault(table.lower(), {'rows': numbers[0], 'indexes': {}})
+        if index:
+            entry['indexes'][index] = numbers
+    return stats
+
+
+def estimate_step_rows(detail, table_stats):
+    """Estimate the rows one plan step visits from sqlite_stat1, or None if unknown"""
+    if not table_stats:
+        return None
+
+    operation, _, index = parse_plan_step(detail)
+    total = table_stats['rows']
+    if operation == 'SCAN':
+        return total
+
+    constraint = re.search(r'\((.*)\)$', detail)
+    terms = constraint.group(1).split(' AND ') if constraint else []
+    equalities = sum(1 for term in terms if term.endswith('=?'))
+    has_range = len(terms) > equalities
+
+    if 'PRIMARY KEY' in detail:
+        rows = 1 if equalities else total
+    elif index and index in table_stats['indexes'] and equalities:
+        averages = table_stats['indexes'][index]
+        rows = averages[min(equalities, len(averages) - 1)]
+    else:
+        rows = total
+
+    # SQLite's own planner assumes a range constraint keeps about a quarter of the rows
+    if has_range:
+        rows = max(1, rows // 4)
+    return rows
+
+
+def plan_query(sql_query, db_path):
+    """
+    Compile a statement with EXPLAIN QUERY PLAN without executing it
+
+    Returns:
+        Dictionary with the plan, the tables read, the indexes used and the
+        estimated number of rows visited by the plan's loops (None when the
+        database has no statistics for a table involved)
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    tables = []
+
+    def authorizer(action, arg1, arg2, db_name, trigger):
+        if action == sqlite3.SQLITE_READ:
+            if arg1 and not arg1.startswith('sqlite_') and arg1 not in tables:
+                tables.append(arg1)
+            return sqlite3.SQLITE_OK
+        if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE):
+            return sqlite3.SQLITE_OK
+        return sqlite3.SQLITE_DENY
+
+    try:
+        conn.set_authorizer(authorizer)
+        plan = explain_query_plan(conn, sql_query)
+        conn.set_authorizer(None)
+        stats = load_statistics(conn)
+    finally:
+        conn.close()
+
+    aliases = table_aliases(sql_query)
+    indexes = []
+    estimated_rows = 1
+    for step in plan:
+        operation, name, index = parse_plan_step(step['detail'])
+        if not operation:
+            continue
+        if index and index not in indexes:
+            indexes.append(index)
+        table = aliases.get(name.lower(), name.lower())
+        if table not in tables:
+            # Subqueries, CTEs and constant rows are not base tables
+            continue
+        rows = estimate_step_rows(step['detail'], stats.get(table))
+        if rows is None or estimated_rows is None:
+            estimated_rows = None
+        else:
+            estimated_rows *= rows
+
+    return {
+        'plan': plan,
+        'tables': tables,
+        'indexes': indexes,
+        'estimated_rows': estimated_rows
+    }
@@ -0,0 +1,275 @@
+import hashlib
+import re
+from functools import lru_cache
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from .database_schemas import get_schema_hash
+from .models import QueryTemplate
+
+# Double-quoted identifiers are matched only so their contents are skipped
+SQL_LITERAL_PATTERN = re.compile(
+    r'"(?:[^"]|"")*"'
+    r"|'(?P<string>(?:[^']|'')*)'"
+    r'|(?<![\w.])(?P<number>\d+(?:\.\d+)?)(?![\w.])'
+)
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+SLOT_PATTERN = re.compile(r'\{(\d+)\}')
+
+# What a slot may capture from a new question. A text slot takes at most
+# as many words as the value it was built from (a country or city name),
+# not a whole clause
+SLOT_REGEX = {
+    'number': r'(\d+(?:\.\d+)?)',
+    'text': r"([\w'&-]+(?: [\w'&-]+){{0,{extra_words}}})",
+}
+
+# Words that turn a captured value into a condition the template can't express,
+# e.g. 'Germany or France' bound into country = ?
+REJECTED_SLOT_WORDS = frozenset(('or', 'and', 'not', 'between'))
+
+# Checked in order, so a value stored as 'Germany' binds 'japan' as 'Japan'
+CASE_TRANSFORMS = {
+    'title': str.title,
+    'upper': str.upper,
+    'lower': str.lower,
+    'as_is': lambda value: value,
+}
+
+# A number right after ORDER BY / GROUP BY (or a comma in that list) is a
+# column ordinal, which must stay in the SQL text
+ORDINAL_CONTEXT_PATTERN = re.compile(r'\b(?:ORDER|GROUP)\s+BY\s+(?:[^;]*?,\s*)?$', re.IGNORECASE)
+
+
+def clean_question(question):
+    """Collapse whitespace and drop trailing punctuation, keeping case for literal binding"""
+    question = ' '.join(question.split())
+    return re.sub(r'[\s?.!]+$', '', question)
+
+
+def sql_literals(sql):
+    """Yield (start, end, value, kind) for each string and number literal in sql"""
+    for match in SQL_LITERAL_PATTERN.finditer(sql):
+        if match.group('string') is not None:
+            yield match.start(), match.end(), match.group('string').replace("''", "'"), 'text'
+        elif match.group('number') is not None:
+            yield match.start(), match.end(), match.group('number'), 'number'
+
+
+def case_transform(sql_value, question_value):
+    for name, transform in CASE_TRANSFORMS.items():
+        if transform(question_value) == sql_value:
+            return name
+    return None
+
+
+def find_once(question, value):
+    """Return the (start, end) of value as a whole word in question if it occurs exactly once"""
+    matches = list(re.finditer(rf'(?<!\w){re.escape(value)}(?!\w)', question, re.IGNORECASE))
+    if len(matches) != 1:
+        return None
+    return matches[0].span()
+
+
+def build_template(question, sql):
+    """
+    Parameterize generated SQL against the question it answered
+
+    A SQL literal becomes a ? placeholder when its value (ignoring LIKE %
+    wildcards and letter case) appears exactly once in the question. That
+    part of the question becomes a slot in the skeleton; everything else
+    must match a future question verbatim.
+
+    Returns:
+        Dict with skeleton, sql_template and parameters, or None if the SQL
+        can't be parameterized safely
+    """
+    question = clean_question(question)
+    if '{' in question or '}' in question:
+        return None
+
+    spans = {}  # (start, end) -> slot index, in order of discovery
+    placeholders = []  # (sql start, sql end, parameter)
+    constants = []
+
+    for start, end, value, kind in sql_literals(sql):
+        core = value.strip('%')
+        if kind == 'number' and ORDINAL_CONTEXT_PATTERN.search(sql, 0, start):
+            constants.append(value)
+            continue
+        span = find_once(question, core) if core else None
+        transform = case_transform(core, question[span[0]:span[1]]) if span else None
+        if span is None or transform is None:
+            constants.append(value)
+            continue
+        slot = spans.setdefault(span, len(spans))
+        placeholders.append((start, end, {
+            'slot': slot,
+            'kind': kind,
+            'case': transform,
+            'prefix': value[:len(value) - len(value.lstrip('%'))],
+            'suffix': value[len(value.rstrip('%')):],
+        }))
+
+    ordered = sorted(spans)
+    for (start, end), (next_start, _) in zip(ordered, ordered[1:]):
+        if end > next_start:
+            return None
+
+    # A literal derived from a slot value (e.g. '2023-01-01' next to '2023')
+    # would not change with the slot, so the template would be wrong
+    for span in spans:
+        slot_value = question[span[0]:span[1]].lower()
+        if any(slot_value in constant.lower() for constant in constants):
+            return None
+
+    skeleton_parts = []
+    slot_kinds = {}
+    slot_words = {}
+    position = 0
+    for start, end in ordered:
+        slot = spans[(start, end)]
+        skeleton_parts.append(question[position:start].lower())
+        skeleton_parts.append(f'{{{slot}}}')
+        slot_kinds[slot] = 'number' if NUMBER_PATTERN.fullmatch(question[start:end]) else 'text'
+        slot_words[slot] = len(question[start:end].split())
+        position = end
+    skeleton_parts.append(question[position:].lower())
+
+    sql_parts = []
+    position = 0
+    for start, end, _ in placeholders:
+        sql_parts.append(sql[position:start])
+        sql_parts.append('?')
+        position = end
+    sql_parts.append(sql[position:])
+
+    parameters = [parameter for _, _, parameter in placeholders]
+    for parameter in parameters:
+        parameter['slot_kind'] = slot_kinds[parameter['slot']]
+        parameter['slot_words'] = slot_words[parameter['slot']]
+
+    return {
+        'skeleton': ''.join(skeleton_parts),
+        'sql_template': ''.join(sql_parts),
+        'parameters': parameters,
+    }
+
+
+@lru_cache(maxsize=2048)
+def skeleton_regex(skeleton, slot_kinds):
+    """
+    Compile a skeleton into a case-insensitive regex with one group per slot
+
+    slot_kinds holds (slot, kind, words) for each slot.
+    """
+    kinds = {slot: (kind, words) for slot, kind, words in slot_kinds}
+    parts = []
+    groups = []
+    position = 0
+    for match in SLOT_PATTERN.finditer(skeleton):
+        parts.append(re.escape(skeleton[position:match.start()]))
+        slot = int(match.group(1))
+        kind, words = kinds[slot]
+        parts.append(SLOT_REGEX[kind].format(extra_words=words - 1))
+        groups.append(slot)
+        position = match.end()
+    parts.append(re.escape(skeleton[position:]))
+    return re.compile(''.join(parts), re.IGNORECASE), tuple(groups)
+
+
+def bind_parameters(parameters, slot_values):
+    values = []
+    for parameter in parameters:
+        captured = CASE_TRANSFORMS[parameter['case']](slot_values[parameter['slot']])
+        if parameter['kind'] == 'number':
+            values.append(float(captured) if '.' in captured else int(captured))
+        else:
+            values.append(f"{parameter['prefix']}{captured}{parameter['suffix']}")
+    return values
+
+
+def render_sql(sql_template, values):
+    """Inline bound values into the template, for display and logging only"""
+    rendered = []
+    values = iter(values)
+    position = 0
+    for match in re.finditer(r"'(?:[^']|'')*'|\?", sql_template):
+        if match.group() != '?':
+            continue
+        value = next(values)
+        rendered.append(sql_template[position:match.start()])
+        rendered.append(str(value) if isinstance(value, (int, float)) else "'" + value.replace("'", "''") + "'")
+        position = match.end()
+    rendered.append(sql_template[position:])
+    return ''.join(rendered)
+
+
+def _skeleton_hash(skeleton):
+    return hashlib.sha1(skeleton.encode('utf-8')).hexdigest()
+
+
+def match_template(question, database_name):
+    """
+    Find a stored template whose skeleton matches the question and bind its literals
+
+    Returns:
+        A generation result dict (as returned by SQLGenerator.generate_sql,
+        plus the template id, SQL and bound params), or None
+    """
+    question = clean_question(question)
+    templates = QueryTemplate.objects.filter(
+        database_name=database_name,
+        schema_hash=get_schema_hash(database_name)
+    ).values_list('id', 'skeleton', 'sql_template', 'parameters', 'explanation')
+    limit = getattr(settings, 'QUERY_ENGINE_TEMPLATE_SCAN_LIMIT', 500)
+
+    for template_id, skeleton, sql_template, parameters, explanation in templates[:limit]:
+        # Templates stored before slot_words was recorded allow one word
+        slot_kinds = tuple(sorted({(p['slot'], p['slot_kind'], p.get('slot_words', 1)) for p in parameters}))
+        regex, groups = skeleton_regex(skeleton, slot_kinds)
+        match = regex.fullmatch(question)
+        if match is None:
+            continue
+        if any(REJECTED_SLOT_WORDS.intersection(value.lower().split()) for value in match.groups()):
+            # Binding this would silently change the question's meaning; ask the model
+            continue
+
+        slot_values = dict(zip(groups, match.groups()))
+        values = bind_parameters(parameters, slot_values)
+        QueryTemplate.objects.filter(id=template_id).update(
+            hit_count=F('hit_count') + 1,
+            last_used_at=timezone.now()
+        )
+        return {
+            'success': True,
+            'sql_query': render_sql(sql_template, values),
+            'explanation': explanation,
+            'template': {'id': template_id, 'sql': sql_template, 'params': values},
+            'error': None
+        }
+    return None
+
+
+def remember_template(question, database_name, result):
+    """Store a template for SQL that executed successfully; failures are not worth caching"""
+    template = build_template(question, result['sql_query'])
+    if template is None:
+        return None
+    try:
+        return QueryTemplate.objects.get_or_create(
+            database_name=database_name,
+            schema_hash=get_schema_hash(database_name),
+            skeleton_hash=_skeleton_hash(template['skeleton']),
+            defaults={
+                'skeleton': template['skeleton'],
+                'sql_template': template['sql_template'],
+                'parameters': template['parameters'],
+                'explanation': result.get('explanation') or '',
+                'example_question': question,
+            }
+        )[0]
+    except IntegrityError:
+        # Another worker stored the same skeleton first
+        return None
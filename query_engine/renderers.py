@@ -0,0 +1,79 @@
+import base64
+import json
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Responses smaller than this are not worth the gzip framing overhead
+GZIP_MIN_LENGTH = 200
+
+SQLITE_TYPE_NAMES = {
+    int: 'integer',
+    float: 'real',
+    str: 'text',
+    bytes: 'blob',
+}
+
+
+def encode_default(value):
+    """Fallback for values the JSON encoder doesn't know (BLOBs come back from sqlite as bytes)"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return str(value)
+
+
+def dumps(payload):
+    """Serialize a payload to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(payload, default=encode_default)
+    return json.dumps(payload, default=encode_default, separators=(',', ':')).encode('utf-8')
+
+
+def column_types(columns, rows):
+    """
+    Infer a storage type per column from the values sqlite returned
+
+    Columns mixing integers and reals are reported as real, columns with no
+    non-NULL values as null and any other mix as text.
+    """
+    types = []
+    for index in range(len(columns)):
+        seen = {type(row[index]) for row in rows} - {type(None)}
+        if not seen:
+            types.append('null')
+        elif seen == {int, float}:
+            types.append('real')
+        elif len(seen) == 1:
+            types.append(SQLITE_TYPE_NAMES.get(seen.pop(), 'text'))
+        else:
+            types.append('text')
+    return types
+
+
+def columnar_payload(columns, rows):
+    """Build the {columns, types, rows} body straight from cursor tuples"""
+    return {
+        'columns': columns,
+        'types': column_types(columns, rows),
+        'rows': rows,
+    }
+
+
+def json_response(request, payload, status=200):
+    """Render a payload with the fast encoder, gzip-compressed if the client accepts it"""
+    content = dumps(payload)
+    response = HttpResponse(content, status=status, content_type='application/json')
+
+    if len(content) >= GZIP_MIN_LENGTH and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        compressed = compress_string(content)
+        if len(compressed) < len(content):
+            response.content = compressed
+            response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = str(len(response.content))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,209 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from . import metrics
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class LLMTimeout(Exception):
+    pass
+
+
+def is_retryable(error):
+    """Timeouts, connection errors, rate limits and 5xx responses are worth another attempt"""
+    if isinstance(error, (LLMTimeout, TimeoutError)):
+        return True
+    import openai
+
+    # APITimeoutError is a subclass of APIConnectionError
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return status_code in (408, 409) or (status_code is not None and status_code >= 500)
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the provider is down
+
+    Opens after `threshold` consecutive retryable failures. After
+    `reset_after` seconds one probe call is let through (half-open); its
+    outcome closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, threshold, reset_after):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_after:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies, for the hedging delay"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction, min_samples):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[int(fraction * (len(ordered) - 1))]
+
+
+class ResilientCaller:
+    """
+    Wraps provider calls with per-attempt deadlines, jittered exponential
+    retries, optional hedging and a circuit breaker
+
+    call(fn, key) invokes fn(timeout) where timeout is the attempt's
+    deadline in seconds; key (e.g. the model name) selects the latency
+    window used for hedging.
+    """
+
+    def __init__(self):
+        self._breaker = None
+        self._trackers = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _setting(self, name, default):
+        return getattr(settings, name, default)
+
+    @property
+    def breaker(self):
+        with self._lock:
+            if self._breaker is None:
+                self._breaker = CircuitBreaker(
+                    self._setting('QUERY_ENGINE_LLM_BREAKER_THRESHOLD', 5),
+                    self._setting('QUERY_ENGINE_LLM_BREAKER_RESET', 30)
+                )
+            return self._breaker
+
+    def tracker(self, key):
+        with self._lock:
+            return self._trackers.setdefault(key, LatencyTracker())
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._setting('QUERY_ENGINE_LLM_HEDGE_WORKERS', 8),
+                    thread_name_prefix='llm-hedge'
+                )
+            return self._executor
+
+    def _hedge_delay(self, key):
+        if not self._setting('QUERY_ENGINE_LLM_HEDGE', False):
+            return None
+        return self.tracker(key).percentile(0.95, self._setting('QUERY_ENGINE_LLM_HEDGE_MIN_SAMPLES', 20))
+
+    def _attempt(self, fn, timeout, key):
+        hedge_after = self._hedge_delay(key)
+        if hedge_after is None or hedge_after >= timeout:
+            return fn(timeout)
+
+        started = time.monotonic()
+        executor = self._get_executor()
+        pending = {executor.submit(fn, timeout)}
+        done, pending = wait(pending, timeout=hedge_after)
+        if not done:
+            # The first request is slower than usual; race a duplicate against it
+            metrics.count_llm_retry('hedge')
+            pending.add(executor.submit(fn, timeout - (time.monotonic() - started)))
+
+        error = None
+        while True:
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            if not pending:
+                raise error
+            remaining = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                raise LLMTimeout(f"LLM call exceeded the {timeout:.1f}s attempt deadline")
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+
+    def call(self, fn, key):
+        breaker = self.breaker
+        if not breaker.allow():
+            metrics.count_llm_retry('circuit_open')
+            raise CircuitOpen("The language model service is unavailable; please retry shortly")
+
+        attempt_timeout = self._setting('QUERY_ENGINE_LLM_ATTEMPT_TIMEOUT', 30)
+        deadline = time.monotonic() + self._setting('QUERY_ENGINE_LLM_TOTAL_TIMEOUT', 60)
+        max_retries = self._setting('QUERY_ENGINE_LLM_MAX_RETRIES', 2)
+        attempt = 0
+        while True:
+            timeout = min(attempt_timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise LLMTimeout("LLM call exceeded its overall deadline")
+            started = time.monotonic()
+            try:
+                result = self._attempt(fn, timeout, key)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The provider answered, so it is up even though the request was bad
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                # Full jitter keeps retries from many workers from arriving together
+                delay = random.uniform(0, min(
+                    self._setting('QUERY_ENGINE_LLM_BACKOFF_MAX', 8),
+                    self._setting('QUERY_ENGINE_LLM_BACKOFF_BASE', 0.5) * 2 ** attempt
+                ))
+                if attempt >= max_retries or time.monotonic() + delay >= deadline or not breaker.allow():
+                    raise
+                metrics.count_llm_retry('retry')
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            self.tracker(key).add(time.monotonic() - started)
+            return result
+
+
+llm_caller = ResilientCaller()
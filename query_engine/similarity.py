@@ -0,0 +1,205 @@
+import math
+import re
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from .query_templates import find_once, sql_literals
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+NUMBER_PATTERN = re.compile(r'\d+(?:\.\d+)?')
+
+STOPWORDS = frozenset("""
+a an the of in on at to for from by with and or is are was were be been do does did
+me my i we our you your show list give get find tell what which who whom whose how
+that this these those all each per there their it its please can could would
+""".split())
+
+
+def stem(token):
+    """Crude suffix stripping; enough for 'customers'/'customer' and 'living'/'lives'/'live'"""
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if len(token) - len(suffix) >= 3 and token.endswith(suffix):
+            token = token[:-len(suffix)]
+            break
+    if len(token) > 3 and token.endswith('e'):
+        token = token[:-1]
+    return token
+
+
+def tokenize(question):
+    return [stem(token) for token in TOKEN_PATTERN.findall(question.lower()) if token not in STOPWORDS]
+
+
+def question_words(question):
+    """Every stemmed word of a question, stopwords included"""
+    return {stem(token) for token in TOKEN_PATTERN.findall(question.lower())}
+
+
+def literals_compatible(old_question, old_sql, new_question):
+    """
+    True if the stored SQL can answer the new question as it is
+
+    The numbers in both questions must be identical, and every SQL string
+    literal that came from the old question must also be in the new one.
+    """
+    if set(NUMBER_PATTERN.findall(old_question)) != set(NUMBER_PATTERN.findall(new_question)):
+        return False
+    for _, _, value, kind in sql_literals(old_sql):
+        core = value.strip('%')
+        if kind == 'text' and core and find_once(old_question, core) and not find_once(new_question, core):
+            return False
+    return True
+
+
+class SimilarityIndex:
+    """
+    TF-IDF index over the successful questions logged for one database
+
+    Documents are added incrementally from QueryLog (by increasing id), and
+    document norms are recomputed lazily after the vocabulary changes.
+    """
+
+    def __init__(self, database_name, max_entries):
+        self.database_name = database_name
+        self.max_entries = max_entries
+        self.last_id = 0
+        self.refreshed_at = 0.0
+        self.documents = {}  # query id -> (question, sql, term counts)
+        self.by_question = {}  # normalized question -> query id
+        self.postings = {}  # term -> set of query ids
+        self.norms = None
+        self._lock = threading.Lock()
+
+    def _idf(self, term):
+        return math.log((1 + len(self.documents)) / (1 + len(self.postings.get(term, ()))) + 1)
+
+    def add(self, query_id, question, sql):
+        key = ' '.join(question.lower().split())
+        previous = self.by_question.get(key)
+        if previous is not None:
+            self._remove(previous)
+        terms = Counter(tokenize(question))
+        if not terms:
+            return
+        self.documents[query_id] = (question, sql, terms)
+        self.by_question[key] = query_id
+        for term in terms:
+            self.postings.setdefault(term, set()).add(query_id)
+        self.norms = None
+        if len(self.documents) > self.max_entries:
+            self._remove(min(self.documents))
+
+    def _remove(self, query_id):
+        question, _, terms = self.documents.pop(query_id)
+        self.by_question.pop(' '.join(question.lower().split()), None)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.discard(query_id)
+                if not postings:
+                    del self.postings[term]
+        self.norms = None
+
+    def refresh(self, interval):
+        """Pull newly logged successful queries; at most once per interval seconds"""
+        now = time.monotonic()
+        if now - self.refreshed_at < interval:
+            return
+        from authentication.models import QueryLog
+
+        rows = (
+            QueryLog.objects
+            .filter(database_name=self.database_name, success=True, id__gt=self.last_id)
+            .exclude(generated_sql='')
+            .order_by('-id')
+            .values_list('id', 'natural_language_query', 'generated_sql')[:self.max_entries]
+        )
+        with self._lock:
+            for query_id, question, sql in reversed(list(rows)):
+                # Another thread may have refreshed while this one queried
+                if query_id <= self.last_id:
+                    continue
+                self.add(query_id, question, sql)
+                self.last_id = max(self.last_id, query_id)
+            self.refreshed_at = now
+
+    def _compute_norms(self):
+        self.norms = {
+            query_id: math.sqrt(sum((count * self._idf(term)) ** 2 for term, count in terms.items()))
+            for query_id, (_, _, terms) in self.documents.items()
+        }
+
+    def search(self, question, limit=3):
+        """
+        Returns:
+            List of (score, query_id, question, sql), best first
+        """
+        terms = Counter(tokenize(question))
+        if not terms:
+            return []
+        with self._lock:
+            if self.norms is None:
+                self._compute_norms()
+            weights = {term: count * self._idf(term) for term, count in terms.items()}
+            query_norm = math.sqrt(sum(weight ** 2 for weight in weights.values()))
+            scores = Counter()
+            for term, weight in weights.items():
+                idf = self._idf(term)
+                for query_id in self.postings.get(term, ()):
+                    scores[query_id] += weight * self.documents[query_id][2][term] * idf
+            cosines = Counter({
+                query_id: dot / (query_norm * self.norms[query_id])
+                for query_id, dot in scores.items() if self.norms[query_id]
+            })
+            results = []
+            for query_id, score in cosines.most_common(limit):
+                old_question, sql, _ = self.documents[query_id]
+                results.append((score, query_id, old_question, sql))
+        return results
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(database_name):
+    index = _indexes.get(database_name)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(
+                database_name,
+                SimilarityIndex(database_name, getattr(settings, 'QUERY_ENGINE_SIMILARITY_MAX_ENTRIES', 2000))
+            )
+    index.refresh(getattr(settings, 'QUERY_ENGINE_SIMILARITY_REFRESH', 5))
+    return index
+
+
+def find_similar(question, database_name):
+    """
+    Look up prior generations for a question
+
+    Reuse is opt-in (QUERY_ENGINE_SIMILARITY_REUSE): a high cosine alone
+    can't tell 'highest' from 'lowest', so a match is only reused when the
+    two questions also have the same words, stopwords included, up to
+    order and word endings.
+
+    Returns:
+        Tuple of (reuse, examples). reuse is a (score, query_id, question,
+        sql) match whose SQL can be run as is, or None; examples are
+        matches close enough to show the model as few-shot hints.
+    """
+    matches = get_index(database_name).search(
+        question, limit=getattr(settings, 'QUERY_ENGINE_SIMILARITY_EXAMPLES', 3)
+    )
+    reuse_threshold = getattr(settings, 'QUERY_ENGINE_SIMILARITY_REUSE_THRESHOLD', 0.9)
+    hint_threshold = getattr(settings, 'QUERY_ENGINE_SIMILARITY_HINT_THRESHOLD', 0.3)
+
+    if getattr(settings, 'QUERY_ENGINE_SIMILARITY_REUSE', False):
+        words = question_words(question)
+        for match in matches:
+            score, _, old_question, sql = match
+            if score >= reuse_threshold and question_words(old_question) == words \
+                    and literals_compatible(old_question, sql, question):
+                return match, []
+    return None, [match for match in matches if match[0] >= hint_threshold]
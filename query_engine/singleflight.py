@@ -0,0 +1,115 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from django.conf import settings
+from .cache import get_cache
+from .database_schemas import get_schema_hash
+
+
+def normalize_question(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    question = ' '.join(question.lower().split())
+    return re.sub(r'[\s?.!]+$', '', question)
+
+
+def coalesce_key(question, database_name):
+    raw = '\x1f'.join([normalize_question(question), database_name, get_schema_hash(database_name)])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Run a function once for all concurrent callers that share a key
+
+    Within a process, followers block on the leader's event. Across worker
+    processes, the leader holds a lock entry in the 'singleflight' cache
+    namespace and publishes its result there for a short time, so followers
+    in other workers (and callers arriving just after it finished) reuse it.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, private_errors=()):
+        """
+        private_errors are exception types that concern only the caller that
+        raised them (e.g. its own rate limit); followers of a leader that
+        raised one do the work themselves instead of sharing the error.
+
+        Returns:
+            Tuple of (value, shared) where shared is True when the value was
+            produced by another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if call.done.wait(self._setting('QUERY_ENGINE_COALESCE_WAIT', 120)):
+                if call.error is None:
+                    return call.value, True
+                if not isinstance(call.error, private_errors):
+                    raise call.error
+                return fn(), False
+            # The leader is taking too long; stop waiting and do the work
+            return fn(), False
+
+        try:
+            call.value, shared = self._run_across_workers(key, fn)
+            return call.value, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_across_workers(self, key, fn):
+        cache = get_cache('singleflight')
+        lock_key = f'lock:{key}'
+        result_key = f'result:{key}'
+        wait = self._setting('QUERY_ENGINE_COALESCE_WAIT', 120)
+
+        value = cache.get(result_key, record=False)
+        if value is not None:
+            return value, True
+
+        # add is atomic: only one worker creates the lock entry
+        if cache.add(lock_key, os.getpid(), ttl=wait):
+            try:
+                value = fn()
+                cache.set(result_key, value, ttl=self._setting('QUERY_ENGINE_COALESCE_RESULT_TTL', 2))
+                return value, False
+            finally:
+                cache.delete(lock_key)
+
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(result_key, record=False)
+            if value is not None:
+                return value, True
+            if cache.get(lock_key, record=False) is None:
+                # The leader failed or its lock expired without publishing a result
+                break
+        return fn(), False
+
+    def _setting(self, name, default):
+        return getattr(settings, name, default)
+
+
+coalescer = SingleFlight()
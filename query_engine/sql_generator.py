@@ -1,27 +1,180 @@
-import openai
 from typing import Optional
+import json
 import os
-from dotenv import load_dotenv
 import re
+import threading
+import time
+from django.conf import settings
+from . import metrics
+from .resilience import llm_caller
 
-load_dotenv()
+# The OpenAI SDK is slow to import and its client holds an HTTP connection
+# pool, so both are deferred to the first generation and then shared.
+_client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import openai
+                # Retries and timeouts are handled by resilience.llm_caller
+                _client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+# Question words that usually mean joins, grouping or ranking
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"\b(per|each|average|avg|mean|median|group(?:ed)?|compare[ds]?|comparison|ratio|percent(?:age)?"
+    r"|rank(?:ing)?|trend|growth|monthly|weekly|yearly|most|least|highest|lowest|top|bottom"
+    r"|more than|less than|at least|at most|without|never|versus|vs|distribution|cumulative"
+    r"|running|previous|change|both|either|except|only)\b",
+    re.IGNORECASE
+)
+
+DEFAULT_MODEL_TIERS = {
+    "fast": {"model": "gpt-4o-mini", "max_tokens": 500},
+    "strong": {"model": "gpt-4o", "max_tokens": 1000},
+}
+
+
+def model_tiers():
+    return getattr(settings, 'QUERY_ENGINE_MODEL_TIERS', DEFAULT_MODEL_TIERS)
+
+
+def referenced_tables(question: str, table_names) -> list:
+    """Tables whose name (or singular, with underscores as spaces) appears in the question"""
+    text = question.lower()
+    found = []
+    for table_name in table_names:
+        name = table_name.lower().replace('_', ' ')
+        forms = {name, name[:-1] if name.endswith('s') else name}
+        if any(re.search(rf"\b{re.escape(form)}", text) for form in forms):
+            found.append(table_name)
+    return found
+
+
+def routing_key(question: str, database_name: str) -> str:
+    from .similarity import tokenize
+    return f"{database_name}:{' '.join(sorted(set(tokenize(question))))}"
+
+
+def choose_tier(question: str, database_name: str) -> str:
+    """
+    Route a question to the 'fast' or 'strong' tier with local heuristics
+
+    Fast only when the question names exactly one table, has no join,
+    grouping or ranking words, is short, and the fast tier has not failed
+    validation on the same question before.
+    """
+    from .cache import get_cache
+    from .database_schemas import DATABASES
+    
+    if 'fast' not in model_tiers():
+        return 'strong'
+    tables = referenced_tables(question, DATABASES.get(database_name, {}).get('tables', {}))
+    if len(tables) != 1 or COMPLEX_QUESTION_PATTERN.search(question) or len(question.split()) > 15:
+        return 'strong'
+    if get_cache('routing').get(routing_key(question, database_name)):
+        return 'strong'
+    return 'fast'
+
+
+def validate_generated_sql(sql_query: str, database_name: str) -> Optional[str]:
+    """Return an error if the SQL is unusable or doesn't compile against the database's schema"""
+    from .validation import validate_sql
+    return validate_sql(sql_query, database_name)
+
+
+def is_refusal(sql_query: Optional[str]) -> bool:
+    from .query_plan import REFUSAL_SENTINEL
+    return (sql_query or '').strip().lower() == REFUSAL_SENTINEL
+
+
+def parse_response(content: str) -> tuple:
+    """Split a model response into (sql_query, explanation)"""
+    sql_query = ""
+    explanation = ""
+    
+    # Split by SQL_QUERY and EXPLANATION markers
+    if "SQL_QUERY:" in content:
+        parts = content.split("SQL_QUERY:")
+        if len(parts) > 1:
+            remaining = parts[1]
+            
+            if "EXPLANATION:" in remaining:
+                sql_parts = remaining.split("EXPLANATION:")
+                sql_query = sql_parts[0].strip()
+                if len(sql_parts) > 1:
+                    explanation = sql_parts[1].strip()
+            else:
+                sql_query = remaining.strip()
+    else:
+        # If no markers, assume the entire response is SQL
+        sql_query = content.strip()
+    
+    # Clean up SQL query - remove any markdown code blocks
+    sql_query = re.sub(r'^```sql\s*', '', sql_query)
+    sql_query = re.sub(r'^```\s*', '', sql_query)
+    sql_query = re.sub(r'\s*```$', '', sql_query)
+    return sql_query.strip(), explanation
+
+
+def parse_json_response(content: str) -> str:
+    """Extract the SQL from a JSON-mode response, tolerating a model that ignored the format"""
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return parse_response(content)[0]
+    sql_query = data.get("sql") if isinstance(data, dict) else None
+    if not isinstance(sql_query, str):
+        return parse_response(content)[0]
+    return parse_response(sql_query)[0]
+
+
+def sql_hash(sql_query: str, database_name: str) -> str:
+    """Cache key for an explanation; whitespace and letter case don't change the meaning"""
+    import hashlib
+    normalized = ' '.join(sql_query.split()).rstrip(';').lower()
+    return hashlib.sha256(f"{database_name}\x1f{normalized}".encode('utf-8')).hexdigest()
+
+
+def usage_cost(tier_config: dict, usage: Optional[dict]) -> Optional[float]:
+    """USD cost of one call from the tier's per-million-token prices, if configured"""
+    if not usage or 'prompt_cost' not in tier_config:
+        return None
+    return (
+        usage['prompt_tokens'] * tier_config['prompt_cost']
+        + usage['completion_tokens'] * tier_config.get('completion_cost', 0)
+    ) / 1_000_000
 
 class SQLGenerator:
     def __init__(self):
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = get_openai_client()
         
-    def generate_sql(self, natural_language_query: str, schema: str, database_name: str) -> dict:
+    def generate_sql(self, natural_language_query: str, schema: str, database_name: str,
+                     examples: Optional[list] = None) -> dict:
         """
         Generate SQL query from natural language using OpenAI API
         
+        Simple questions go to the fast model tier; if its SQL fails
+        validation the question is escalated to the strong tier. SQL that
+        still fails validation is sent back to the strong tier with the
+        error, up to QUERY_ENGINE_SQL_REPAIR_ATTEMPTS times. With
+        QUERY_ENGINE_SQL_ONLY the model returns JSON with the SQL alone and
+        the explanation is left to explain_sql().
+        
         Args:
             natural_language_query: The user's natural language question
             schema: The database schema information
             database_name: Name of the selected database
+            examples: Optional (question, sql) pairs that worked before, used as few-shot hints
             
         Returns:
-            Dictionary with SQL query and explanation
+            Dictionary with SQL query and explanation (None in SQL-only mode);
+            validation_error is set if no attempt produced valid SQL
         """
+        sql_only = getattr(settings, 'QUERY_ENGINE_SQL_ONLY', False)
         
         system_prompt = f"""You are an expert SQL developer. Your task is to convert natural language queries into SQL queries.
         
@@ -35,10 +188,15 @@ Rules:
 3. Include appropriate JOINs when needed
 4. Use meaningful table aliases
 5. Format the SQL query for readability
-6. Provide a brief explanation of what the query does
-7. If the query is ambiguous, make reasonable assumptions
-8. Always return valid SQL that can be executed using Python's `sqlite3` module
-9. If the user requests something that is not valid for the schema, return "saeed"
+6. If the query is ambiguous, make reasonable assumptions
+7. Always return valid SQL that can be executed using Python's `sqlite3` module
+8. If the user requests something that is not valid for the schema, return "saeed"
+"""
+        if sql_only:
+            system_prompt += """
+Return only a JSON object of the form {"sql": "<your SQL query>"}, with no explanation."""
+        else:
+            system_prompt += """9. Provide a brief explanation of what the query does
 
 Return your response in the following format:
 SQL_QUERY:
@@ -47,60 +205,185 @@ SQL_QUERY:
 EXPLANATION:
 [Brief explanation of what the query does]"""
 
+        if examples:
+            shown = "\n\n".join(f"Question: {question}\nSQL_QUERY:\n{sql}" for question, sql in examples)
+            system_prompt += f"""
+
+These similar questions were answered correctly before; adapt them where they fit:
+
+{shown}"""
+        
         user_prompt = f"Convert this to SQL: {natural_language_query}"
         
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
+        tier = choose_tier(natural_language_query, database_name) \
+            if getattr(settings, 'QUERY_ENGINE_MODEL_ROUTING', True) else 'strong'
+        result = self._complete(tier, system_prompt, user_prompt, database_name, sql_only)
+        if not result['success']:
+            return result
+        
+        error = validate_generated_sql(result['sql_query'], database_name)
+        if error is not None and tier == 'fast':
+            # Remember the miss so this question goes straight to the strong tier next time
+            from .cache import get_cache
+            get_cache('routing').set(routing_key(natural_language_query, database_name), True)
+            metrics.count_escalation(database_name)
+            
+            strong = self._complete('strong', system_prompt, user_prompt, database_name, sql_only)
+            strong['escalated_from'] = {'model': result['model'], 'error': error}
+            result = self._add_cost(strong, result)
+            if not result['success']:
+                return result
+            error = validate_generated_sql(result['sql_query'], database_name)
+        
+        repairs = 0
+        while error is not None and not is_refusal(result['sql_query']) \
+                and repairs < getattr(settings, 'QUERY_ENGINE_SQL_REPAIR_ATTEMPTS', 1):
+            repairs += 1
+            repair_prompt = f"""{user_prompt}
+
+This SQL was rejected before execution:
+{result['sql_query']}
+
+Error: {error}
+
+Return a corrected query."""
+            repaired = self._complete('strong', system_prompt, repair_prompt, database_name, sql_only)
+            if not repaired['success']:
+                break
+            repaired['escalated_from'] = result.get('escalated_from')
+            result = self._add_cost(repaired, result)
+            error = validate_generated_sql(result['sql_query'], database_name)
+        
+        metrics.count_validation(
+            database_name,
+            'rejected' if error is not None else 'repaired' if repairs else 'valid'
+        )
+        result['repairs'] = repairs
+        result['validation_error'] = error
+        return result
+    
+    @staticmethod
+    def _add_cost(result: dict, previous: dict) -> dict:
+        """Carry the cost of earlier attempts into the result that replaces them"""
+        if result['cost'] is not None and previous['cost'] is not None:
+            result['cost'] += previous['cost']
+        return result
+    
+    def _chat(self, tier_config: dict, system_prompt: str, user_prompt: str, max_tokens: int,
+              json_mode: bool = False):
+        """One chat completion through the resilient caller"""
+        model = tier_config["model"]
+        options = {"response_format": {"type": "json_object"}} if json_mode else {}
+        return llm_caller.call(
+            lambda timeout: self.client.chat.completions.create(
+                model=model,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
                 temperature=0.1,
-                max_tokens=1000
-            )
+                max_tokens=max_tokens,
+                timeout=timeout,
+                **options
+            ),
+            model
+        )
+    
+    def _complete(self, tier: str, system_prompt: str, user_prompt: str, database_name: str,
+                  sql_only: bool = False) -> dict:
+        """Make one chat completion with the tier's model and parse it"""
+        tier_config = model_tiers()[tier]
+        model = tier_config["model"]
+        max_tokens = tier_config.get("max_tokens", 1000)
+        if sql_only:
+            # Without the prose section the SQL is all the model has to write
+            max_tokens = min(max_tokens, getattr(settings, 'QUERY_ENGINE_SQL_ONLY_MAX_TOKENS', 400))
+        start_time = time.perf_counter()
+        try:
+            response = self._chat(tier_config, system_prompt, user_prompt, max_tokens, json_mode=sql_only)
             
             content = response.choices[0].message.content
-            
-            # Parse the response more robustly
-            sql_query = ""
-            explanation = ""
-            
-            # Split by SQL_QUERY and EXPLANATION markers
-            if "SQL_QUERY:" in content:
-                parts = content.split("SQL_QUERY:")
-                if len(parts) > 1:
-                    remaining = parts[1]
-                    
-                    if "EXPLANATION:" in remaining:
-                        sql_parts = remaining.split("EXPLANATION:")
-                        sql_query = sql_parts[0].strip()
-                        if len(sql_parts) > 1:
-                            explanation = sql_parts[1].strip()
-                    else:
-                        sql_query = remaining.strip()
+            if sql_only:
+                sql_query, explanation = parse_json_response(content), None
             else:
-                # If no markers, assume the entire response is SQL
-                sql_query = content.strip()
+                sql_query, explanation = parse_response(content)
             
-            # Clean up SQL query - remove any markdown code blocks
-            sql_query = re.sub(r'^```sql\s*', '', sql_query)
-            sql_query = re.sub(r'^```\s*', '', sql_query)
-            sql_query = re.sub(r'\s*```$', '', sql_query)
-            sql_query = sql_query.strip()
+            usage = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens
+            } if response.usage else None
+            cost = usage_cost(tier_config, usage)
+            metrics.observe_llm(database_name, 'success', time.perf_counter() - start_time, model, usage, tier, cost)
             
             return {
                 "success": True,
                 "sql_query": sql_query,
                 "explanation": explanation,
+                "model": model,
+                "tier": tier,
+                "usage": usage,
+                "cost": cost,
                 "error": None
             }
             
         except Exception as e:
+            metrics.observe_llm(database_name, 'error', time.perf_counter() - start_time, tier=tier)
             return {
                 "success": False,
                 "sql_query": None,
                 "explanation": None,
+                "tier": tier,
+                "cost": None,
+                "error": str(e)
+            }
+    
+    def explain_sql(self, sql_query: str, schema: str, database_name: str,
+                    natural_language_query: Optional[str] = None) -> dict:
+        """
+        Explain what a SQL query does in a few plain sentences
+        
+        Returns:
+            Dictionary with success, explanation and error
+        """
+        tiers = model_tiers()
+        tier = getattr(settings, 'QUERY_ENGINE_EXPLAIN_TIER', 'fast')
+        if tier not in tiers:
+            tier = 'strong'
+        tier_config = tiers[tier]
+        
+        system_prompt = f"""You are an expert SQL developer. Explain to a non-technical user what a SQL query does, in two or three plain sentences. Do not repeat the SQL.
+
+The query runs against a {database_name} database with the following schema:
+
+{schema}"""
+        user_prompt = f"SQL query:\n{sql_query}"
+        if natural_language_query:
+            user_prompt = f"Question: {natural_language_query}\n\n{user_prompt}"
+        
+        start_time = time.perf_counter()
+        try:
+            response = self._chat(
+                tier_config, system_prompt, user_prompt,
+                getattr(settings, 'QUERY_ENGINE_EXPLAIN_MAX_TOKENS', 200)
+            )
+            usage = {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens
+            } if response.usage else None
+            metrics.observe_llm(
+                database_name, 'success', time.perf_counter() - start_time, tier_config["model"], usage, tier,
+                usage_cost(tier_config, usage)
+            )
+            return {
+                "success": True,
+                "explanation": response.choices[0].message.content.strip(),
+                "error": None
+            }
+        except Exception as e:
+            metrics.observe_llm(database_name, 'error', time.perf_counter() - start_time, tier=tier)
+            return {
+                "success": False,
+                "explanation": None,
                 "error": str(e)
             }
     
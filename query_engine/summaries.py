@@ -0,0 +1,586 @@
+import hashlib
+import json
+import re
+import sqlite3
+from functools import lru_cache
+from .database_schemas import DATABASES
+
+WATERMARK_TABLE = 'summary_watermarks'
+
+TOKEN_PATTERN = re.compile(r"""
+    '(?:[^']|'')*'
+  | "(?:[^"]|"")*"
+  | [A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?
+  | \d+(?:\.\d+)?
+  | <=|>=|<>|!=|==|\|\|
+  | \S
+""", re.VERBOSE)
+
+CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group by', 'having', 'order by', 'limit')
+
+# Words that are never column references
+SQL_WORDS = frozenset("""
+as and or not is null in like glob between case when then else end distinct asc desc
+collate escape exists cast true false
+""".split())
+
+AGGREGATES = frozenset(('sum', 'total', 'count', 'avg', 'min', 'max', 'group_concat'))
+
+# Constructs whose meaning can change when rows are pre-aggregated
+UNSUPPORTED_WORDS = frozenset(('union', 'intersect', 'except', 'over', 'with', 'window', 'distinct'))
+
+
+class NoMatch(Exception):
+    pass
+
+
+def summary_specs(database_name):
+    return DATABASES.get(database_name, {}).get('summaries', {})
+
+
+def definition_hash(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def measure_kind(expression):
+    return expression.split('(', 1)[0].strip().lower()
+
+
+def tokenize(sql, spans=None):
+    """Split SQL into tokens; spans, if given, receives each token's (start, end)"""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        token = match.group()
+        if token.startswith('"'):
+            token = token[1:-1]
+            if not re.fullmatch(r'[A-Za-z_]\w*', token):
+                raise NoMatch(f"Unsupported quoted identifier {match.group()}")
+        tokens.append(token)
+        if spans is not None:
+            spans.append(match.span())
+    return tokens
+
+
+def render(tokens):
+    """Join tokens back into SQL text, with keywords and function names in upper case"""
+    text = []
+    for i, token in enumerate(tokens):
+        previous = tokens[i - 1] if i else None
+        is_function = i + 1 < len(tokens) and tokens[i + 1] == '(' and re.fullmatch(r'[a-z_]\w*', token)
+        if is_function or token in SQL_WORDS:
+            token = token.upper()
+        if previous is not None and token not in (',', ')') and previous != '(' \
+                and not (token == '(' and re.fullmatch(r'[A-Za-z_]\w*', previous) and previous not in SQL_WORDS):
+            text.append(' ')
+        text.append(token)
+    return ''.join(text)
+
+
+def split_top_level(tokens, separator=','):
+    return [tokens[start:end] for start, end in top_level_ranges(tokens, separator)]
+
+
+def top_level_ranges(tokens, separator=','):
+    """(start, end) index ranges of the parts of tokens between separators at depth 0"""
+    ranges, start, depth = [], 0, 0
+    for i, token in enumerate(tokens):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token == separator and depth == 0:
+            ranges.append((start, i))
+            start = i + 1
+    ranges.append((start, len(tokens)))
+    return ranges
+
+
+def split_clauses(tokens):
+    """Split a statement's tokens into {clause: tokens} at parenthesis depth 0"""
+    clauses = {}
+    current = None
+    depth = 0
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        low = token.lower()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        if depth == 0:
+            two = f"{low} {tokens[i + 1].lower()}" if i + 1 < len(tokens) else None
+            keyword = two if two in CLAUSE_KEYWORDS else low if low in CLAUSE_KEYWORDS else None
+            if keyword:
+                if keyword in clauses:
+                    raise NoMatch(f"Repeated {keyword.upper()} clause")
+                clauses[keyword] = []
+                current = keyword
+                i += 2 if ' ' in keyword else 1
+                continue
+        if current is None:
+            raise NoMatch("Statement does not start with SELECT")
+        clauses[current].append(token)
+        i += 1
+    return clauses
+
+
+class Context:
+    """How identifiers in one statement resolve to canonical table.column names"""
+
+    def __init__(self, aliases, columns, equivalences=None, keep=()):
+        self.aliases = aliases  # alias or table name -> table
+        self.columns = columns  # column name -> set of tables that have it
+        self.equivalences = equivalences or {}
+        self.keep = set(keep)
+
+    def canonical(self, tokens):
+        result = []
+        for i, token in enumerate(tokens):
+            low = token.lower()
+            if not re.match(r'[a-z_]', low):
+                result.append(token if token.startswith("'") else low)
+                continue
+            if i + 1 < len(tokens) and tokens[i + 1] == '(':
+                # Function name
+                result.append(low)
+                continue
+            if '.' in low:
+                qualifier, column = low.split('.')
+                table = self.aliases.get(qualifier)
+                if table is None:
+                    raise NoMatch(f"Unknown qualifier {qualifier}")
+                name = f"{table}.{column}"
+            elif low in SQL_WORDS or low in self.keep:
+                result.append(low)
+                continue
+            else:
+                tables = self.columns.get(low, ())
+                if len(tables) > 1:
+                    raise NoMatch(f"Ambiguous column {low}")
+                if not tables:
+                    result.append(low)
+                    continue
+                name = f"{next(iter(tables))}.{low}"
+            result.append(self.equivalences.get(name, name))
+        return result
+
+
+def table_columns(tables, database_name):
+    columns = {}
+    table_defs = DATABASES[database_name]['tables']
+    for table in tables:
+        for definition in table_defs.get(table, {}).get('columns', []):
+            columns.setdefault(definition.split()[0].lower(), set()).add(table)
+    return columns
+
+
+def parse_from(tokens, database_name):
+    """
+    Parse 'table [AS] alias [INNER] JOIN table [AS] alias ON a.x = b.y ...'
+
+    Returns:
+        Tuple of (aliases, tables, join conditions as (left, right) token lists)
+    """
+    known = DATABASES[database_name]['tables']
+    segments = []
+    current = []
+    i = 0
+    while i < len(tokens):
+        low = tokens[i].lower()
+        if low in ('left', 'right', 'full', 'cross', 'natural', 'outer', 'using', ','):
+            raise NoMatch("Only inner joins can be answered from a summary")
+        if low == 'inner' and i + 1 < len(tokens) and tokens[i + 1].lower() == 'join':
+            i += 1
+            low = 'join'
+        if low == 'join':
+            segments.append(current)
+            current = []
+        else:
+            current.append(tokens[i])
+        i += 1
+    segments.append(current)
+
+    aliases, tables, conditions = {}, [], []
+    for position, segment in enumerate(segments):
+        if 'on' in [token.lower() for token in segment]:
+            on = [token.lower() for token in segment].index('on')
+            head, condition = segment[:on], segment[on + 1:]
+        else:
+            head, condition = segment, None
+        if (position == 0) != (condition is None):
+            raise NoMatch("Every join needs an ON condition")
+        if len(head) == 3 and head[1].lower() == 'as':
+            head = [head[0], head[2]]
+        if not 1 <= len(head) <= 2:
+            raise NoMatch("Unsupported table reference")
+        table = head[0].lower()
+        if table not in known or table in tables:
+            raise NoMatch(f"Unsupported table {table}")
+        tables.append(table)
+        aliases[table] = table
+        if len(head) == 2:
+            aliases[head[1].lower()] = table
+        if condition is not None:
+            sides = split_top_level(condition, '=')
+            if len(sides) != 2 or len(sides[0]) != 1 or len(sides[1]) != 1:
+                raise NoMatch("Join conditions must equate two columns")
+            conditions.append((sides[0], sides[1]))
+    return aliases, tables, conditions
+
+
+class CompiledSummary:
+    """A summary definition with its expressions in canonical token form"""
+
+    def __init__(self, name, spec, database_name):
+        self.name = name
+        self.spec = spec
+        self.fact = spec['fact']
+        self.tables = {self.fact, *spec.get('joins', {})}
+        aliases = {table: table for table in self.tables}
+        columns = table_columns(self.tables, database_name)
+        plain = Context(aliases, columns)
+
+        self.conditions = set()
+        self.equivalences = {}
+        for table, condition in spec.get('joins', {}).items():
+            left, right = (plain.canonical(tokenize(side))[0] for side in condition.split('='))
+            self.conditions.add(frozenset((left, right)))
+            # A joined table's key is the same value as the column it joins to
+            if left.startswith(f"{table}."):
+                self.equivalences[left] = right
+            else:
+                self.equivalences[right] = left
+
+        context = Context(aliases, columns, self.equivalences)
+        self.dimensions = [
+            (name, context.canonical(tokenize(expression)))
+            for name, expression in spec['dimensions'].items()
+        ]
+        # Longest first, so 'strftime(..., x)' is replaced before a bare 'x'
+        self.dimensions.sort(key=lambda item: -len(item[1]))
+        self.measures = {}
+        for name, expression in spec['measures'].items():
+            self.measures[tuple(context.canonical(tokenize(expression)))] = name
+        self.watermark = f"{self.fact}.{spec['watermark']}"
+
+
+@lru_cache(maxsize=None)
+def compiled_summaries(database_name):
+    return [CompiledSummary(name, spec, database_name) for name, spec in summary_specs(database_name).items()]
+
+
+def find_call_end(tokens, start):
+    """Index of the ')' closing the '(' at tokens[start]"""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i] == '(':
+            depth += 1
+        elif tokens[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+    raise NoMatch("Unbalanced parentheses")
+
+
+def sorted_product(tokens):
+    """'b * a' and 'a * b' compare equal"""
+    factors = split_top_level(tokens, '*')
+    if len(factors) > 1 and all(len(factor) == 1 for factor in factors):
+        return sorted(factor[0] for factor in factors)
+    return tokens
+
+
+def substitute(tokens, summary, allow_aggregates):
+    """Rewrite canonical tokens over the summary's columns, or raise NoMatch"""
+    result = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in AGGREGATES and i + 1 < len(tokens) and tokens[i + 1] == '(':
+            if not allow_aggregates:
+                raise NoMatch("Aggregate outside SELECT/HAVING/ORDER BY")
+            end = find_call_end(tokens, i + 1)
+            result.extend(rollup(token, tokens[i + 2:end], summary))
+            i = end + 1
+            continue
+        for name, expression in summary.dimensions:
+            if tokens[i:i + len(expression)] == expression:
+                result.append(name)
+                i += len(expression)
+                break
+        else:
+            if '.' in token and re.match(r'[a-z_]', token):
+                raise NoMatch(f"{token} is not a dimension of {summary.name}")
+            result.append(token)
+            i += 1
+    return result
+
+
+def rollup(function, argument, summary):
+    """Re-aggregate one aggregate call from the summary's pre-aggregated measures"""
+    if argument == [summary.watermark] and function == 'count':
+        # The fact's primary key is never NULL, so this counts rows
+        argument = ['*']
+    key_argument = sorted_product(argument)
+    for expression, name in summary.measures.items():
+        kind = expression[0]
+        if expression[1] != '(' or expression[-1] != ')':
+            continue
+        if sorted_product(list(expression[2:-1])) != key_argument:
+            continue
+        if function == kind and kind in ('sum', 'total', 'min', 'max'):
+            return [function, '(', name, ')']
+        if function == 'count' and kind == 'count':
+            # COUNT is 0, not NULL, when no summary row matches
+            return ['coalesce', '(', 'sum', '(', name, ')', ',', '0', ')']
+    raise NoMatch(f"No measure for {function}({render(argument)})")
+
+
+def is_name(token):
+    return bool(re.fullmatch(r'[A-Za-z_]\w*', token)) and token.lower() not in SQL_WORDS
+
+
+def select_item_label(item):
+    """
+    Returns:
+        Tuple of (expression tokens, label, explicit). label is the alias,
+        the column name SQLite gives a bare column, or None.
+    """
+    if len(item) >= 3 and item[-2].lower() == 'as' and is_name(item[-1]):
+        return item[:-2], item[-1], True
+    # An alias without AS follows a complete operand
+    if len(item) >= 2 and is_name(item[-1]) and (
+        item[-2] == ')' or item[-2].startswith("'") or item[-2].lower() == 'end'
+        or re.fullmatch(r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?', item[-2]) and item[-2].lower() not in SQL_WORDS
+    ):
+        return item[:-1], item[-1], True
+    if len(item) == 1 and re.fullmatch(r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?', item[0]):
+        return item, item[0].split('.')[-1], False
+    return item, None, False
+
+
+def plan_rewrite_for(sql_query, database_name, summary):
+    sql_query = sql_query.strip().rstrip(';')
+    spans = []
+    tokens = tokenize(sql_query, spans)
+    if any(token.lower() in UNSUPPORTED_WORDS for token in tokens) or ';' in tokens:
+        raise NoMatch("Unsupported construct")
+    if sum(1 for token in tokens if token.lower() == 'select') != 1:
+        raise NoMatch("Subqueries are not rewritten")
+    clauses = split_clauses(tokens)
+    if 'select' not in clauses or 'from' not in clauses:
+        raise NoMatch("Not a SELECT ... FROM statement")
+
+    aliases, tables, conditions = parse_from(clauses['from'], database_name)
+    if set(tables) != summary.tables:
+        raise NoMatch("Different tables")
+    plain = Context(aliases, table_columns(tables, database_name))
+    query_conditions = {
+        frozenset((plain.canonical(left)[0], plain.canonical(right)[0])) for left, right in conditions
+    }
+    if query_conditions != summary.conditions:
+        raise NoMatch("Different join conditions")
+
+    # SELECT is the first token, so the select list starts at index 1
+    items = []
+    for start, end in top_level_ranges(clauses['select']):
+        expression, label, explicit = select_item_label(clauses['select'][start:end])
+        if label is None and expression:
+            # SQLite names the column after the expression exactly as written
+            text = sql_query[spans[start + 1][0]:spans[start + len(expression)][1]]
+            label = '"' + text.replace('"', '""') + '"'
+        items.append((expression, label, explicit))
+    labels = {label.lower() for _, label, explicit in items if explicit}
+    context = Context(aliases, plain.columns, summary.equivalences)
+    alias_context = Context(aliases, plain.columns, summary.equivalences, keep=labels)
+
+    select = []
+    rewritten_aliases = {}
+    for expression, label, explicit in items:
+        if expression == ['*']:
+            raise NoMatch("SELECT * is not rewritten")
+        rewritten = substitute(context.canonical(expression), summary, allow_aggregates=True)
+        if explicit:
+            rewritten_aliases[label.lower()] = rewritten
+        if explicit or rewritten != [label]:
+            rewritten = rewritten + ['AS', label]
+        select.append(render(rewritten))
+
+    parts = [f"SELECT {', '.join(select)}", f"FROM {summary.name}"]
+    if 'where' in clauses:
+        parts.append('WHERE ' + render(substitute(context.canonical(clauses['where']), summary, False)))
+    summary_columns = {name for name, _ in summary.dimensions} | set(summary.measures.values())
+
+    def with_aliases(tokens, allow_aggregates):
+        rewritten = substitute(alias_context.canonical(tokens), summary, allow_aggregates)
+        # An alias named like a summary column (e.g. SUM(...) AS revenue) would
+        # resolve to that column in the summary query, so inline its expression
+        expanded = []
+        for token in rewritten:
+            if token in rewritten_aliases and token in summary_columns and rewritten_aliases[token] != [token]:
+                expanded.extend(['(', *rewritten_aliases[token], ')'])
+            else:
+                expanded.append(token)
+        return render(expanded)
+
+    if 'group by' in clauses:
+        keys = [with_aliases(key, False) for key in split_top_level(clauses['group by'])]
+        parts.append('GROUP BY ' + ', '.join(keys))
+    if 'having' in clauses:
+        parts.append('HAVING ' + with_aliases(clauses['having'], True))
+    if 'order by' in clauses:
+        keys = [with_aliases(key, True) for key in split_top_level(clauses['order by'])]
+        parts.append('ORDER BY ' + ', '.join(keys))
+    if 'limit' in clauses:
+        parts.append('LIMIT ' + render(clauses['limit']))
+    return ' '.join(parts)
+
+
+@lru_cache(maxsize=2048)
+def plan_rewrite(sql_query, database_name):
+    """
+    Rewrite an aggregate query to read a summary table instead of its sources
+
+    Matches statements over exactly a summary's tables and join conditions
+    whose grouping keys, filters and non-aggregated columns are all
+    dimensions and whose aggregates are SUM/TOTAL/COUNT/MIN/MAX of measures.
+
+    Returns:
+        Tuple of (summary name, rewritten SQL), or None
+    """
+    for summary in compiled_summaries(database_name):
+        try:
+            return summary.name, plan_rewrite_for(sql_query, database_name, summary)
+        except NoMatch:
+            continue
+    return None
+
+
+def summary_is_fresh(conn, database_name, name):
+    """
+    True if the summary has absorbed every row of its fact table
+
+    Updates and deletes of the source columns a summary reads clear its
+    definition hash through the triggers refresh_summary installs, so a
+    changed order status or product category also makes it stale.
+    """
+    spec = summary_specs(database_name)[name]
+    try:
+        row = conn.execute(
+            f"SELECT watermark, definition_hash FROM {WATERMARK_TABLE} WHERE summary = ?", (name,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # Summaries have never been refreshed for this database
+        return False
+    if row is None or row[1] != definition_hash(spec):
+        return False
+    latest = conn.execute(f"SELECT MAX({spec['watermark']}) FROM {spec['fact']}").fetchone()[0]
+    return latest is None or (row[0] is not None and latest <= row[0])
+
+
+def source_columns(spec):
+    """{table: columns} of every qualified column a summary definition reads"""
+    tables = {spec['fact'], *spec.get('joins', {})}
+    columns = {table: set() for table in tables}
+    columns[spec['fact']].add(spec['watermark'])
+    expressions = [*spec.get('joins', {}).values(), *spec['dimensions'].values(), *spec['measures'].values()]
+    for expression in expressions:
+        for token in tokenize(expression):
+            table, _, column = token.partition('.')
+            if column and table in columns:
+                columns[table].add(column)
+    return columns
+
+
+def install_stale_triggers(conn, name, spec):
+    """
+    Clear the summary's definition hash when a row it was built from changes
+
+    Appends are absorbed incrementally; an update of a column the summary
+    reads, or a delete, in the fact or a joined table can only be handled
+    by a rebuild, which the cleared hash forces on the next refresh.
+    """
+    for table, columns in source_columns(spec).items():
+        for event in (f"UPDATE OF {', '.join(sorted(columns))}", "DELETE"):
+            trigger = f"{name}_stale_{table}_{event.split()[0].lower()}"
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            conn.execute(
+                f"CREATE TRIGGER {trigger} AFTER {event} ON {table} BEGIN"
+                f" UPDATE {WATERMARK_TABLE} SET definition_hash = NULL WHERE summary = '{name}'; END"
+            )
+
+
+def refresh_summary(conn, name, spec, full=False):
+    """
+    Fold fact rows newer than the stored watermark into a summary table
+
+    New fact rows are absorbed incrementally. Updated or deleted source
+    rows mark the summary stale (see install_stale_triggers) and it is
+    rebuilt from scratch.
+
+    Returns:
+        Number of new fact rows absorbed
+    """
+    fact, watermark = spec['fact'], spec['watermark']
+    dimensions, measures = spec['dimensions'], spec['measures']
+    digest = definition_hash(spec)
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} ("
+            " summary TEXT PRIMARY KEY, watermark INTEGER, definition_hash TEXT, refreshed_at TEXT)"
+        )
+        row = conn.execute(
+            f"SELECT watermark, definition_hash FROM {WATERMARK_TABLE} WHERE summary = ?", (name,)
+        ).fetchone()
+        if full or row is None or row[1] != digest:
+            conn.execute(f"DROP TABLE IF EXISTS {name}")
+            last = None
+        else:
+            last = row[0]
+
+        columns = ', '.join([*dimensions, *measures])
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} ({columns}, UNIQUE ({', '.join(dimensions)}))"
+        )
+        latest = conn.execute(f"SELECT MAX({watermark}) FROM {fact}").fetchone()[0]
+        absorbed = 0
+        if latest is not None and (last is None or latest > last):
+            joins = ''.join(f" JOIN {table} ON {condition}" for table, condition in spec.get('joins', {}).items())
+            bounds = f"{fact}.{watermark} <= ?" + (f" AND {fact}.{watermark} > ?" if last is not None else "")
+            params = (latest, last) if last is not None else (latest,)
+            absorbed = conn.execute(
+                f"SELECT COUNT(*) FROM {fact}{joins} WHERE {bounds}", params
+            ).fetchone()[0]
+            updates = ', '.join(merge_expression(measure, expression) for measure, expression in measures.items())
+            conn.execute(
+                f"INSERT INTO {name} ({columns})"
+                f" SELECT {', '.join([*dimensions.values(), *measures.values()])}"
+                f" FROM {fact}{joins} WHERE {bounds}"
+                f" GROUP BY {', '.join(dimensions.values())}"
+                f" ON CONFLICT ({', '.join(dimensions)}) DO UPDATE SET {updates}",
+                params
+            )
+        install_stale_triggers(conn, name, spec)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {WATERMARK_TABLE} (summary, watermark, definition_hash, refreshed_at)"
+            " VALUES (?, ?, ?, datetime('now'))",
+            (name, latest if latest is not None else last, digest)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return absorbed
+
+
+def merge_expression(measure, expression):
+    """How a stored measure absorbs the same measure over new rows"""
+    kind = measure_kind(expression)
+    new = f"excluded.{measure}"
+    if kind in ('min', 'max'):
+        return f"{measure} = COALESCE({kind.upper()}({measure}, {new}), {measure}, {new})"
+    # SUM over only NULLs is NULL, so either side may be missing
+    return f"{measure} = CASE WHEN {measure} IS NULL THEN {new} WHEN {new} IS NULL THEN {measure} ELSE {measure} + {new} END"
@@ -1,3 +1,565 @@
-from django.test import TestCase
+import importlib.util
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from django.db import connection, models
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from authentication.models import DatabasePermission, QueryLog, Role, User
+from query_engine import cache, singleflight, views
+from query_engine.admission import AdmissionController, Throttled
+from query_engine.connections import BudgetExceeded
+from query_engine.database_schemas import get_public_schema
+from query_engine.engines import (
+    DuckDBEngine, Snapshot, build_snapshot, has_engine_defined_order, sqlite_value, to_duckdb_sql
+)
+from query_engine.exporters import stream_export
+from query_engine.history import ensure_search_index, missing_search_triggers, search_history
+from query_engine.jobs import DEADLINE_ERROR, JobManager, JobStore
+from query_engine.query_plan import check_generated_sql
+from query_engine.query_templates import match_template, remember_template
+from query_engine.similarity import _indexes, find_similar
+from query_engine.summaries import NoMatch, plan_rewrite, refresh_summary, summary_is_fresh, summary_specs
+
+
+def export_table(conn, sql_query, batch_size=2):
+    import pyarrow as pa
+
+    data = b''.join(stream_export(conn, sql_query, 'arrow', batch_size=batch_size))
+    return pa.ipc.open_stream(io.BytesIO(data)).read_all()
+
+
+class ExportTypingTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.executescript("""
+            CREATE TABLE orders (order_id INTEGER, shipped BOOLEAN, placed DATE, note TEXT, amount DECIMAL(10, 2));
+            INSERT INTO orders VALUES (1, 1, '2023-06-25', 'a', 10);
+            INSERT INTO orders VALUES (2, 0, '2023-06-26', 'b', 10.5);
+            INSERT INTO orders VALUES (3, NULL, '2023-06-27 07:00:00', 'c', NULL);
+            INSERT INTO orders VALUES (4, 1, NULL, 'd', 12);
+        """)
+
+    def test_expression_widens_when_later_batches_hold_reals(self):
+        table = export_table(self.conn, "SELECT CASE WHEN order_id < 3 THEN 1 ELSE 1.5 END AS x FROM orders")
+        self.assertEqual(str(table.schema.field('x').type), 'double')
+        self.assertEqual(table.column('x').to_pylist(), [1, 1, 1.5, 1.5])
+
+    def test_expression_mixing_numbers_and_text_is_a_string(self):
+        table = export_table(self.conn, "SELECT CASE WHEN order_id < 3 THEN order_id ELSE note END AS x FROM orders")
+        self.assertEqual(str(table.schema.field('x').type), 'string')
+        self.assertEqual(table.column('x').to_pylist(), ['1', '2', 'c', 'd'])
+
+    def test_expression_that_is_null_in_the_first_batch(self):
+        table = export_table(self.conn, "SELECT CASE WHEN order_id > 2 THEN order_id END AS x FROM orders")
+        self.assertEqual(str(table.schema.field('x').type), 'int64')
+        self.assertEqual(table.column('x').to_pylist(), [None, None, 3, 4])
+
+    def test_declared_types(self):
+        table = export_table(self.conn, "SELECT order_id, shipped, amount FROM orders")
+        self.assertEqual([str(field.type) for field in table.schema], ['int64', 'bool', 'double'])
+        self.assertEqual(table.column('shipped').to_pylist(), [True, False, None, True])
+
+    def test_date_column_holding_a_timestamp_falls_back_to_string(self):
+        table = export_table(self.conn, "SELECT placed FROM orders")
+        self.assertEqual(str(table.schema.field('placed').type), 'string')
+        self.assertEqual(table.column('placed').to_pylist()[2], '2023-06-27 07:00:00')
+
+    def test_valid_dates_are_typed(self):
+        table = export_table(self.conn, "SELECT placed FROM orders WHERE order_id < 3")
+        self.assertEqual(str(table.schema.field('placed').type), 'date32[day]')
+
+    def test_type_probe_reads_a_bounded_sample(self):
+        calls = []
+        self.conn.create_function('tick', 1, lambda value: calls.append(value) or value)
+        data = b''.join(stream_export(self.conn, "SELECT tick(order_id) AS x FROM orders", 'arrow', sample_rows=1))
+        # One row for the probe, then every row once for the export itself
+        self.assertEqual(calls, [1, 1, 2, 3, 4])
+        self.assertTrue(data)
+
+    def test_export_runs_under_the_time_budget(self):
+        slow = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                "SELECT i FROM n WHERE i < 0")
+        with self.assertRaises(BudgetExceeded):
+            stream_export(self.conn, slow, 'arrow', budget=0.05)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            # The export closed its connection
+            self.conn.execute("SELECT 1")
+
+
+class SummaryRewriteTests(SimpleTestCase):
+    database = 'E-Commerce'
+    summary = 'summary_category_monthly_sales'
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', isolation_level=None)
+        self.conn.executescript("""
+            CREATE TABLE products (product_id INTEGER PRIMARY KEY, category TEXT);
+            CREATE TABLE orders (order_id INTEGER PRIMARY KEY, order_date DATE, status TEXT);
+            CREATE TABLE order_items (order_item_id INTEGER PRIMARY KEY, order_id INTEGER, product_id INTEGER,
+                                      quantity INTEGER, unit_price DECIMAL(10, 2), subtotal DECIMAL(10, 2));
+            INSERT INTO products VALUES (1, 'Books'), (2, 'Toys');
+            INSERT INTO orders VALUES (1, '2023-01-05', 'delivered'), (2, '2023-02-10', 'pending');
+            INSERT INTO order_items VALUES (1, 1, 1, 2, 5.5, 11), (2, 1, 2, 1, 20, 20), (3, 2, 1, 3, 5.5, 16.5);
+        """)
+        refresh_summary(self.conn, self.summary, summary_specs(self.database)[self.summary])
+
+    def assertSameResults(self, sql_query):
+        planned = plan_rewrite(sql_query, self.database)
+        self.assertIsNotNone(planned, sql_query)
+        self.assertEqual(planned[0], self.summary)
+        self.assertEqual(self.conn.execute(planned[1]).fetchall(), self.conn.execute(sql_query).fetchall())
+
+    def test_rewrites_return_the_original_results(self):
+        joins = ("FROM order_items oi JOIN orders o ON o.order_id = oi.order_id "
+                 "JOIN products p ON p.product_id = oi.product_id")
+        for sql_query in [
+            f"SELECT p.category, COUNT(*) AS items, SUM(oi.subtotal) AS total {joins} GROUP BY p.category "
+            f"ORDER BY p.category",
+            f"SELECT o.status, SUM(oi.quantity) {joins} WHERE p.category = 'Books' GROUP BY o.status ORDER BY o.status",
+            f"SELECT COUNT(*), SUM(oi.subtotal), SUM(oi.unit_price * oi.quantity) {joins}"
+            f" WHERE p.category = 'Books'",
+            # Nothing matches: COUNT is still 0 and SUM NULL
+            f"SELECT COUNT(*), SUM(oi.subtotal) {joins} WHERE p.category = 'Garden'",
+            f"SELECT p.category, COUNT(*) {joins} WHERE o.status = 'cancelled' GROUP BY p.category",
+        ]:
+            with self.subTest(sql_query=sql_query):
+                self.assertSameResults(sql_query)
+
+    def test_updated_dimension_makes_the_summary_stale(self):
+        self.assertTrue(summary_is_fresh(self.conn, self.database, self.summary))
+        self.conn.execute("UPDATE orders SET status = 'delivered' WHERE order_id = 2")
+        self.assertFalse(summary_is_fresh(self.conn, self.database, self.summary))
+
+        refresh_summary(self.conn, self.summary, summary_specs(self.database)[self.summary])
+        self.assertTrue(summary_is_fresh(self.conn, self.database, self.summary))
+        self.assertSameResults(
+            "SELECT o.status, COUNT(*) FROM order_items oi JOIN orders o ON o.order_id = oi.order_id "
+            "JOIN products p ON p.product_id = oi.product_id GROUP BY o.status"
+        )
+
+    def test_unrelated_column_update_keeps_the_summary_fresh(self):
+        self.conn.execute("ALTER TABLE orders ADD COLUMN notes TEXT")
+        self.conn.execute("UPDATE orders SET notes = 'gift'")
+        self.assertTrue(summary_is_fresh(self.conn, self.database, self.summary))
+
+    def test_public_schema_hides_engine_config(self):
+        schema = get_public_schema(self.database)
+        self.assertNotIn('summaries', schema)
+        self.assertTrue(all(set(table) == {'columns', 'description'} for table in schema['tables'].values()))
+
+
+class DuckDBTranslationTests(SimpleTestCase):
+    def test_multi_argument_min_and_max_stay_on_sqlite(self):
+        with self.assertRaises(NoMatch):
+            to_duckdb_sql("SELECT max(a, b) FROM t")
+        self.assertEqual(to_duckdb_sql("SELECT max(a) FROM t"), "SELECT max(a) FROM t")
+
+    def test_integer_casts_truncate(self):
+        self.assertEqual(
+            to_duckdb_sql("SELECT CAST(price / 2 AS INT), CAST(name AS TEXT) FROM t WHERE name LIKE 'a%'"),
+            "SELECT CAST(trunc(price / 2) AS BIGINT), CAST(name AS TEXT) FROM t WHERE name ILIKE 'a%'"
+        )
+
+    def test_row_order(self):
+        self.assertTrue(has_engine_defined_order("SELECT a, COUNT(*) FROM t GROUP BY a"))
+        self.assertTrue(has_engine_defined_order("SELECT * FROM a JOIN b ON a.id = b.id"))
+        self.assertTrue(has_engine_defined_order("SELECT DISTINCT a FROM t"))
+        self.assertFalse(has_engine_defined_order("SELECT a, COUNT(*) FROM t GROUP BY a ORDER BY a"))
+        self.assertFalse(has_engine_defined_order("SELECT COUNT(*) FROM a JOIN b ON a.id = b.id"))
+        self.assertFalse(has_engine_defined_order("SELECT a FROM t WHERE b > 1"))
+
+
+class SnapshotLifetimeTests(SimpleTestCase):
+    def test_replaced_snapshot_closes_after_its_last_statement(self):
+        engine = DuckDBEngine()
+        old = Snapshot('old.duckdb', '1', mock.Mock())
+        engine._replace('db', old)
+        old.users += 1
+
+        engine._replace('db', Snapshot('new.duckdb', '2', mock.Mock()))
+        old.conn.close.assert_not_called()
+        engine.release(old)
+        old.conn.close.assert_called_once_with()
+
+    def test_idle_snapshot_closes_when_replaced(self):
+        engine = DuckDBEngine()
+        old = Snapshot('old.duckdb', '1', mock.Mock())
+        engine._replace('db', old)
+        engine._replace('db', Snapshot('new.duckdb', '2', mock.Mock()))
+        old.conn.close.assert_called_once_with()
+
+
+@unittest.skipUnless(importlib.util.find_spec('duckdb'), 'duckdb is not installed')
+class EngineAgreementTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        import duckdb
+
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'shop.db')
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE orders (order_id INTEGER PRIMARY KEY, customer TEXT, status TEXT,
+                                 amount REAL, discount REAL, order_date TEXT);
+            INSERT INTO orders VALUES (1, 'Ann', 'Shipped', 10.7, NULL, '2023-01-05 10:00:00');
+            INSERT INTO orders VALUES (2, 'bob', 'pending', -3.5, 1.2, '2023-02-10');
+            INSERT INTO orders VALUES (3, 'Ann', 'shipped', 2.5, 4.0, '2023-02-11 08:30:00');
+            INSERT INTO orders VALUES (4, 'cy', 'pending', 7.0, NULL, '2023-03-01');
+        """)
+        conn.commit()
+        cls.sqlite = conn
+        build_snapshot(path, path + '.duckdb')
+        cls.duckdb = duckdb.connect(path + '.duckdb', read_only=True, config=dict(DuckDBEngine.CONFIG))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sqlite.close()
+        cls.duckdb.close()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_engines_agree(self):
+        for sql_query in [
+            "SELECT order_id, CAST(amount AS INTEGER), CAST(amount * 2 AS INT) FROM orders ORDER BY order_id",
+            "SELECT customer, COUNT(*), SUM(amount) FROM orders WHERE status LIKE 'ship%' "
+            "GROUP BY customer ORDER BY customer",
+            "SELECT strftime('%Y-%m', order_date) AS month, COUNT(*) FROM orders GROUP BY month ORDER BY month",
+            "SELECT order_id, discount FROM orders ORDER BY discount, order_id",
+            "SELECT COUNT(*), SUM(amount) FROM orders WHERE status = 'cancelled'",
+        ]:
+            with self.subTest(sql_query=sql_query):
+                self.assertFalse(has_engine_defined_order(sql_query))
+                expected = self.sqlite.execute(sql_query).fetchall()
+                actual = [
+                    tuple(sqlite_value(value) for value in row)
+                    for row in self.duckdb.execute(to_duckdb_sql(sql_query)).fetchall()
+                ]
+                self.assertEqual(actual, expected)
+
+    def test_filesystem_access_is_rejected(self):
+        import duckdb
+
+        for sql_query in [
+            "SELECT * FROM read_csv('/etc/passwd')",
+            f"ATTACH '{os.path.join(self.directory, 'shop.db')}' AS source",
+            "SET enable_external_access = true",
+        ]:
+            with self.subTest(sql_query=sql_query):
+                with self.assertRaises(duckdb.Error):
+                    self.duckdb.execute(sql_query)
+
+
+class JobDeadlineTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_job_running_past_its_deadline_fails(self):
+        def work(job):
+            while True:
+                job.check_cancelled()
+                time.sleep(0.01)
+
+        with override_settings(QUERY_ENGINE_JOB_DIR=self.directory, QUERY_ENGINE_JOB_TIMEOUT=0.1):
+            manager = JobManager()
+            meta = manager.submit(1, 'question', 'E-Commerce', work)
+            self.assertEqual(meta['expires_at'], meta['deadline'] + manager.store.ttl)
+            for _ in range(200):
+                if not manager._running:
+                    break
+                time.sleep(0.01)
+            meta = manager.get(meta['id'])
+        self.assertEqual((meta['status'], meta['error']), ('failed', DEADLINE_ERROR))
+
+    def test_unfinished_jobs_of_dead_workers_expire(self):
+        store = JobStore(self.directory, ttl=60)
+        now = time.time()
+        store.write({'id': 'overdue', 'status': 'running', 'deadline': now - 1, 'expires_at': now + 59})
+        store.write({'id': 'expired', 'status': 'queued', 'deadline': now - 61, 'expires_at': now - 1})
+
+        self.assertEqual(store.read('overdue')['status'], 'failed')
+        store.purge_expired()
+        self.assertIsNone(store.read('expired'))
+        self.assertFalse(os.path.exists(store.path('expired', 'json')))
+
+
+class CheckGeneratedSQLTests(SimpleTestCase):
+    def test_semicolons_in_quotes_and_comments_are_allowed(self):
+        for sql_query in [
+            "SELECT 'a;b' FROM t;",
+            'SELECT "odd;name" FROM t',
+            "SELECT [odd;name], `other;name` FROM t",
+            "SELECT 1 -- trailing; comment",
+            "/* leading; comment */ SELECT 1",
+            "-- which customers?\nSELECT name FROM customers; -- done",
+        ]:
+            with self.subTest(sql_query=sql_query):
+                self.assertIsNone(check_generated_sql(sql_query))
+
+    def test_rejects_more_than_one_statement(self):
+        for sql_query in [
+            "SELECT 1; DROP TABLE t",
+            'SELECT "a" FROM t; DELETE FROM t',
+            "SELECT 1 /* c */; UPDATE t SET a = 1",
+        ]:
+            with self.subTest(sql_query=sql_query):
+                self.assertEqual(check_generated_sql(sql_query), 'Only a single SQL statement is allowed')
+
+    def test_rejects_statements_hidden_behind_comments(self):
+        self.assertEqual(check_generated_sql("-- SELECT\nDELETE FROM t"), 'Only SELECT statements are allowed')
+
+
+# Every cache in this process, so tests never read or write query_cache.sqlite3
+LOCAL_CACHES = {'local': {'BACKEND': 'locmem'}, 'shared': {'BACKEND': 'locmem'}}
+
+
+@override_settings(
+    QUERY_ENGINE_CACHES=LOCAL_CACHES, QUERY_ENGINE_TEMPLATES=False, QUERY_ENGINE_SIMILARITY=False,
+    QUERY_ENGINE_SUMMARY_REWRITE=False, QUERY_ENGINE_ROLE_LIMITS={},
+    QUERY_ENGINE_DEFAULT_LIMITS={'llm_per_minute': 1, 'llm_burst': 1, 'max_concurrent': 2},
+)
+class APITestCase(TransactionTestCase):
+    """Requests against the query API with private caches and admission state"""
+
+    def setUp(self):
+        self.clear_caches()
+        self.addCleanup(self.clear_caches)
+        self.admission = AdmissionController()
+        patcher = mock.patch.object(views, 'admission', self.admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        role = Role.objects.create(name='analyst')
+        DatabasePermission.objects.create(role=role, database_name='ecommerce')
+        self.role = role
+
+    def clear_caches(self):
+        cache._backends.clear()
+        cache._namespaces.clear()
+
+    def create_user(self, name):
+        return User.objects.create(username=name, email=f'{name}@example.com', role=self.role)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+
+def fake_model(sql_query):
+    """Patch SQLGenerator so the model always answers with sql_query"""
+    generator = mock.MagicMock()
+    generator.return_value.generate_sql.return_value = {
+        'success': True, 'sql_query': sql_query, 'explanation': None, 'error': None
+    }
+    return mock.patch.object(views, 'SQLGenerator', generator)
+
+
+class SignallingEvent(threading.Event):
+    """Event that reports when somebody starts waiting on it"""
+
+    waiting = None
+
+    def wait(self, timeout=None):
+        self.waiting.set()
+        return super().wait(timeout)
+
+
+class CoalescedThrottleTests(APITestCase):
+    def test_follower_is_not_throttled_by_the_leaders_bucket(self):
+        a, b = self.create_user('a'), self.create_user('b')
+        # a has already spent its only token
+        self.admission.charge(a)
+
+        follower_waiting, release_leader = threading.Event(), threading.Event()
+        charge = self.admission.charge
+
+        def charge_after_follower_joins(user):
+            if user.pk == a.pk:
+                release_leader.wait(5)
+            charge(user)
+
+        def new_call(call):
+            call.done = SignallingEvent()
+            call.done.waiting = follower_waiting
+            call.value = call.error = None
+
+        responses = {}
+
+        def ask(user):
+            responses[user.pk] = self.client_for(user).post(
+                '/api/query/execute/', {'query': 'How many orders?', 'database': 'E-Commerce'}, format='json'
+            )
+
+        with fake_model('SELECT COUNT(*) FROM orders'), \
+                mock.patch.object(self.admission, 'charge', side_effect=charge_after_follower_joins), \
+                mock.patch.object(singleflight._Call, '__init__', new_call), \
+                mock.patch.object(views, 'execute_generated_sql', return_value=(['n'], [(3,)], None)):
+            leader = threading.Thread(target=ask, args=(a,))
+            leader.start()
+            for _ in range(500):
+                if singleflight.coalescer._calls:
+                    break
+                time.sleep(0.01)
+            follower = threading.Thread(target=ask, args=(b,))
+            follower.start()
+            self.assertTrue(follower_waiting.wait(5))
+            release_leader.set()
+            leader.join(5)
+            follower.join(5)
+
+        self.assertEqual(responses[a.pk].status_code, 429)
+        self.assertEqual(responses[b.pk].status_code, 200)
+        self.assertEqual(responses[b.pk].data['data'], [{'n': 3}])
+
+
+class JobAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        settings = override_settings(
+            QUERY_ENGINE_JOB_DIR=directory, QUERY_ENGINE_JOB_WORKERS=1, QUERY_ENGINE_JOB_MAX_QUEUED=2
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.manager = JobManager()
+
+    def work(self, job):
+        self.release.wait(5)
+        return {'columns': [], 'rows': [], 'execution_time': 0}
+
+    @override_settings(QUERY_ENGINE_JOB_MAX_QUEUED=10)
+    def test_per_user_limit(self):
+        self.manager.submit(1, 'q', 'E-Commerce', self.work, max_in_flight=2)
+        self.manager.submit(1, 'q', 'E-Commerce', self.work, max_in_flight=2)
+        with self.assertRaises(Throttled) as refused:
+            self.manager.submit(1, 'q', 'E-Commerce', self.work, max_in_flight=2)
+        self.assertEqual(refused.exception.reason, 'job_concurrency')
+        # Other users are unaffected
+        self.manager.submit(2, 'q', 'E-Commerce', self.work, max_in_flight=2)
+
+    def test_queue_depth(self):
+        first = self.manager.submit(1, 'q', 'E-Commerce', self.work)
+        for _ in range(200):
+            if self.manager.get(first['id'])['status'] == 'running':
+                break
+            time.sleep(0.01)
+        # One job thread is busy, so these two wait in the queue
+        self.manager.submit(2, 'q', 'E-Commerce', self.work)
+        self.manager.submit(3, 'q', 'E-Commerce', self.work)
+        with self.assertRaises(Throttled) as refused:
+            self.manager.submit(4, 'q', 'E-Commerce', self.work)
+        self.assertEqual(refused.exception.reason, 'job_queue')
+
+
+class JobSubmitTests(APITestCase):
+    def test_user_over_their_job_limit_gets_429(self):
+        user = self.create_user('a')
+        manager = mock.MagicMock()
+        with mock.patch.object(views, 'job_manager', manager):
+            manager.submit.side_effect = Throttled('Too many jobs in progress for this user', 'job_concurrency', 5)
+            response = self.client_for(user).post(
+                '/api/query/jobs/', {'query': 'How many orders?', 'database': 'E-Commerce'}, format='json'
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(manager.submit.call_args.kwargs['max_in_flight'], 2)
+
+
+class TemplateMatchTests(TestCase):
+    def remember(self, question, sql_query):
+        remember_template(question, 'E-Commerce', {'sql_query': sql_query, 'explanation': ''})
+
+    def test_binds_a_value_of_the_same_shape(self):
+        self.remember('customers in Germany', "SELECT * FROM customers WHERE country = 'Germany'")
+        result = match_template('Customers in France?', 'E-Commerce')
+        self.assertEqual(result['template']['params'], ['France'])
+
+    def test_longer_values_fall_through_to_the_model(self):
+        self.remember('customers in Germany', "SELECT * FROM customers WHERE country = 'Germany'")
+        self.assertIsNone(match_template('customers in Germany or France', 'E-Commerce'))
+        self.assertIsNone(match_template('customers in United Kingdom', 'E-Commerce'))
+
+    def test_connectives_are_never_bound(self):
+        self.remember('customers in New York City', "SELECT * FROM customers WHERE city = 'New York City'")
+        self.assertEqual(match_template('customers in Salt Lake City', 'E-Commerce')['template']['params'],
+                         ['Salt Lake City'])
+        self.assertIsNone(match_template('customers in Paris or Lyon', 'E-Commerce'))
+        self.assertIsNone(match_template('customers in not Paris', 'E-Commerce'))
+
+
+class SimilarReuseTests(TestCase):
+    question = 'names of the customers with the highest number of orders'
+    sql_query = 'SELECT name FROM customers ORDER BY order_count DESC LIMIT 10'
+
+    def setUp(self):
+        _indexes.clear()
+        self.addCleanup(_indexes.clear)
+        user = User.objects.create(username='a', email='a@example.com')
+        questions = [self.question] + [
+            f'{extreme} {measure} of {subject}'
+            for extreme in ('highest', 'lowest') for measure in ('price', 'total', 'count')
+            for subject in ('products', 'orders', 'customers')
+        ]
+        for question in questions:
+            QueryLog.objects.create(user=user, natural_language_query=question, generated_sql=self.sql_query,
+                                    database_name='E-Commerce')
+
+    @override_settings(QUERY_ENGINE_SIMILARITY_REUSE=True)
+    def test_antonym_is_a_hint_not_a_reuse(self):
+        question = self.question.replace('highest', 'lowest')
+        reuse, examples = find_similar(question, 'E-Commerce')
+        self.assertIsNone(reuse)
+        self.assertEqual(examples[0][2], self.question)
+        self.assertGreaterEqual(examples[0][0], 0.9)
+
+    @override_settings(QUERY_ENGINE_SIMILARITY_REUSE=True)
+    def test_same_words_are_reused(self):
+        reuse, _ = find_similar('Names of the customer with the highest numbers of orders?', 'E-Commerce')
+        self.assertEqual(reuse[2], self.question)
+
+    def test_reuse_is_off_by_default(self):
+        reuse, examples = find_similar(self.question, 'E-Commerce')
+        self.assertIsNone(reuse)
+        self.assertTrue(examples)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'FTS5 search index is SQLite-only')
+class SearchIndexTests(TransactionTestCase):
+    def alter_database_name(self, max_length):
+        old_field = QueryLog._meta.get_field('database_name')
+        new_field = models.CharField(max_length=max_length)
+        new_field.set_attributes_from_name('database_name')
+        # SQLite applies this by rebuilding authentication_querylog
+        with connection.schema_editor() as editor:
+            editor.alter_field(QueryLog, old_field, new_field)
+
+    def test_triggers_exist_after_migrate(self):
+        self.assertEqual(missing_search_triggers(), [])
+
+    def test_table_rebuild_triggers_are_recreated(self):
+        self.alter_database_name(60)
+        self.addCleanup(ensure_search_index)
+        self.addCleanup(self.alter_database_name, 50)
+        self.assertEqual(len(missing_search_triggers()), 3)
+
+        user = User.objects.create(username='a', email='a@example.com')
+        QueryLog.objects.create(user=user, natural_language_query='monthly revenue by region',
+                                generated_sql='SELECT 1', database_name='E-Commerce')
+        ensure_search_index()
+
+        self.assertEqual(missing_search_triggers(), [])
+        self.assertEqual(len(search_history(user, 'revenue')[0]), 1)
+        QueryLog.objects.create(user=user, natural_language_query='revenue by product',
+                                generated_sql='SELECT 2', database_name='E-Commerce')
+        self.assertEqual(len(search_history(user, 'revenue')[0]), 2)
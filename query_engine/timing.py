@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+
+
+class RequestTimer:
+    """Collects named stage durations for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+        self._open = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def begin(self, name):
+        """Open a span that is closed later by end() or finish(), possibly in another layer"""
+        self._open[name] = time.perf_counter()
+
+    def end(self, name):
+        start = self._open.pop(name, None)
+        if start is not None:
+            self.add(name, time.perf_counter() - start)
+
+    def finish(self):
+        """Close any open spans and record the total"""
+        for name in list(self._open):
+            self.end(name)
+        self.spans['total'] = time.perf_counter() - self.started
+
+    def breakdown(self):
+        """Stage durations in milliseconds, in the order the stages ran"""
+        return {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()}
+
+    def header_value(self):
+        return ', '.join(f"{name};dur={milliseconds}" for name, milliseconds in self.breakdown().items())
+
+
+def get_timer(request):
+    """Return the request's timer, attaching one if no middleware did"""
+    timer = getattr(request, 'timer', None)
+    if timer is None:
+        timer = RequestTimer()
+        request.timer = timer
+    return timer
@@ -3,7 +3,12 @@ from .views import (
     generate_and_execute_sql,
     get_database_schema,
     get_query_history,
-    get_database_stats
+    get_database_stats,
+    export_query_results,
+    submit_query_job,
+    query_job,
+    explain_query,
+    workload_analytics
 )
 
 urlpatterns = [
@@ -11,4 +16,9 @@ urlpatterns = [
     path('schema/', get_database_schema, name='get_schema'),
     path('history/', get_query_history, name='query_history'),
     path('stats/', get_database_stats, name='database_stats'),
+    path('export/', export_query_results, name='export_results'),
+    path('explain/', explain_query, name='explain_query'),
+    path('analytics/', workload_analytics, name='workload_analytics'),
+    path('jobs/', submit_query_job, name='submit_job'),
+    path('jobs/<uuid:job_id>/', query_job, name='query_job'),
 ]
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+import threading
+from typing import Optional
+from .connections import get_database_version
+from .database_schemas import get_database_path
+from .query_plan import check_generated_sql
+
+# Authorizer actions a read-only SELECT needs
+READ_ONLY_ACTIONS = frozenset((
+    sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE
+))
+
+
+class SchemaClone:
+    """
+    Empty in-memory copy of a database's schema
+
+    Statements are compiled here with EXPLAIN, so a bad table or column
+    name, a syntax error or a write is rejected without opening the real
+    database file or running anything.
+    """
+
+    def __init__(self, database_name, version, statements):
+        self.database_name = database_name
+        self.version = version
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        for statement in statements:
+            self.conn.execute(statement)
+        self._denied = []
+        self._lock = threading.Lock()
+        self.conn.set_authorizer(self._authorize)
+
+    def _authorize(self, action, arg1, arg2, db_name, trigger):
+        if action == sqlite3.SQLITE_READ and arg1 and arg1.startswith('sqlite_'):
+            self._denied.append(f"reads the internal table {arg1}")
+            return sqlite3.SQLITE_DENY
+        if action in READ_ONLY_ACTIONS:
+            return sqlite3.SQLITE_OK
+        self._denied.append('is not read-only')
+        return sqlite3.SQLITE_DENY
+
+    def validate(self, sql_query, params=()):
+        """Return an error message, or None if the statement compiles as a single read-only SELECT"""
+        with self._lock:
+            self._denied.clear()
+            try:
+                self.conn.execute(f"EXPLAIN {sql_query}", params)
+            except sqlite3.ProgrammingError as e:
+                if 'one statement at a time' in str(e):
+                    return 'Only a single SQL statement is allowed'
+                return str(e)
+            except sqlite3.Error as e:
+                if self._denied:
+                    return f"The statement {self._denied[0]}"
+                return str(e)
+        return None
+
+    def result_columns(self, sql_query, params=()):
+        """Column names SQLite gives the statement's result, or None if it can't be run here cheaply"""
+        with self._lock:
+            # The tables are empty, so only table-less recursive queries run long; those are abandoned
+            self.conn.set_progress_handler(lambda: True, 100000)
+            try:
+                cursor = self.conn.execute(sql_query, params)
+            except sqlite3.Error:
+                return None
+            finally:
+                self.conn.set_progress_handler(None, 0)
+            return [description[0] for description in cursor.description or []]
+
+
+def load_schema_statements(db_path):
+    """CREATE statements for the tables, views and indexes of a database, in creation order"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT sql FROM sqlite_master"
+            " WHERE sql IS NOT NULL AND type IN ('table', 'view', 'index') AND name NOT LIKE 'sqlite_%'"
+            " ORDER BY rowid"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [sql for (sql,) in rows]
+
+
+_clones = {}
+_clones_lock = threading.Lock()
+
+
+def get_schema_clone(database_name):
+    """
+    Return the schema clone for a database, or None if its file is missing
+
+    The clone is rebuilt when the database file changes, so schema
+    migrations are picked up on the next validation.
+    """
+    version = get_database_version(database_name)
+    clone = _clones.get(database_name)
+    if clone is not None and clone.version == version:
+        return clone
+
+    db_path = get_database_path(database_name)
+    if not db_path or not os.path.exists(db_path):
+        return None
+    with _clones_lock:
+        clone = _clones.get(database_name)
+        if clone is None or clone.version != version:
+            clone = SchemaClone(database_name, version, load_schema_statements(db_path))
+            _clones[database_name] = clone
+    return clone
+
+
+def validate_sql(sql_query: str, database_name: str, params=()) -> Optional[str]:
+    """
+    Check a statement before execution
+
+    Returns:
+        An error message, or None if the statement is a single read-only
+        SELECT that compiles against the database's tables and columns
+    """
+    error = check_generated_sql(sql_query)
+    if error:
+        return error
+    clone = get_schema_clone(database_name)
+    if clone is None:
+        # Execution will report the missing file
+        return None
+    return clone.validate(sql_query, params)
+
+
+def result_columns(sql_query, database_name, params=()):
+    """Column names of the statement's result as SQLite would label them, or None if unknown"""
+    clone = get_schema_clone(database_name)
+    if clone is None:
+        return None
+    return clone.result_columns(sql_query, params)
@@ -2,29 +2,69 @@ from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-import pandas as pd
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+import logging
 import sqlite3
 import json
 import os
 from django.conf import settings
 import time
-from .sql_generator import SQLGenerator
-from .database_schemas import DATABASES, get_schema_prompt
+import hashlib
+from .sql_generator import SQLGenerator, sql_hash
+from .database_schemas import DATABASES, get_schema_prompt, get_database_path, get_schema_hash, get_public_schema
+from .query_plan import check_generated_sql, plan_query
+from .renderers import columnar_payload, json_response
+from .exporters import EXPORT_CONTENT_TYPES, EXPORT_PROFILE_ROWS, export_filename, stream_export
+from .connections import BudgetExceeded, get_pool, get_database_version, memory_copy_stats
+from . import engines, metrics
+from .timing import get_timer
+from .singleflight import coalescer, coalesce_key
+from .admission import admission, Throttled
+from .jobs import JobFailed, TERMINAL_STATES, job_manager, public_job
+from .query_templates import match_template, remember_template
+from .similarity import find_similar
+from .cache import get_cache
+from .history import InvalidCursor, search_history
+from .analytics import WINDOWS, pending_rows, refresh_rollups, workload_report
+from .validation import validate_sql
+from .summaries import plan_rewrite, summary_is_fresh
 from authentication.models import QueryLog
 
-# Database file mapping
-DB_FILE_MAPPING = {
-    "E-Commerce": "databases/ecommerce.db",
-    "Hospital Management": "databases/hospital.db",
-    "School Management": "databases/school.db"
-}
+logger = logging.getLogger(__name__)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def generate_and_execute_sql(request):
+    timer = get_timer(request)
+    # DRF authentication and permission classes ran between process_view and here
+    timer.end('auth')
+    
+    try:
+        with admission.admit(request.user, timer):
+            with metrics.track_in_flight():
+                response = run_generate_and_execute(request, timer)
+    except Throttled as e:
+        metrics.count_throttle(e.reason)
+        response = Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = e.retry_after_header()
+    
+    metrics.observe_request(
+        request.data.get('database'),
+        metrics.outcome_for_status(response.status_code),
+        time.perf_counter() - timer.started
+    )
+    return response
+
+def run_generate_and_execute(request, timer):
     try:
         natural_language_query = request.data.get('query')
         database_name = request.data.get('database')
+        dry_run = str(request.data.get('dry_run', '')).lower() in ('true', '1', 'yes')
+        response_format = request.data.get('format', 'records')
         
         if not natural_language_query or not database_name:
             return Response({
@@ -33,47 +73,80 @@ def generate_and_execute_sql(request):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         # Check if user has access to the database
-        if not request.user.can_access_database(database_name.lower().replace(' ', '_').replace('-', '')):
+        with timer.span('permission'):
+            has_access = user_can_access(request.user, database_name)
+        if not has_access:
+            metrics.count_permission_denial(database_name)
             return Response({
                 'success': False,
                 'error': 'You do not have access to this database'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Initialize SQL Generator
-        sql_generator = SQLGenerator()
-        
         # Get schema for selected database
-        schema = get_schema_prompt(database_name)
+        with timer.span('schema'):
+            schema = get_schema_prompt(database_name)
         
-        # Generate SQL
-        result = sql_generator.generate_sql(
-            natural_language_query=natural_language_query,
-            schema=schema,
-            database_name=database_name
+        if dry_run:
+            with timer.span('llm'):
+                result = generate_sql(natural_language_query, schema, database_name, request.user)
+            if not result['success']:
+                return Response({
+                    'success': False,
+                    'error': result['error']
+                }, status=status.HTTP_400_BAD_REQUEST)
+            return dry_run_response(result, database_name)
+        
+        # Identical concurrent questions share one generation and execution
+        start_time = time.perf_counter()
+        outcome, shared = coalescer.run(
+            coalesce_key(natural_language_query, database_name),
+            lambda: generate_and_execute(natural_language_query, schema, database_name, timer, request.user),
+            # Each caller is throttled against its own LLM token bucket
+            private_errors=(Throttled,)
         )
+        metrics.count_cache('coalesce', hit=shared)
+        if shared:
+            timer.add('coalesced', time.perf_counter() - start_time)
         
+        result = outcome['result']
         if not result['success']:
             return Response({
                 'success': False,
                 'error': result['error']
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Execute query
-        start_time = time.time()
-        df, error = execute_query(result['sql_query'], database_name)
-        execution_time = time.time() - start_time
+        columns, rows, error = outcome['columns'], outcome['rows'], outcome['error']
+        execution_time = outcome['execution_time']
+        
+        if not error:
+            with timer.span('convert'):
+                if response_format == 'columnar':
+                    # Columnar responses skip pandas and DRF rendering entirely
+                    payload = columnar_payload(columns, rows)
+                else:
+                    # pandas is only imported by the requests that need it
+                    import pandas as pd
+                    
+                    # Convert DataFrame to JSON
+                    df = pd.DataFrame.from_records(rows, columns=columns)
+                    payload = {
+                        'data': df.to_dict(orient='records'),
+                        'columns': columns
+                    }
         
         # Log the query
-        query_log = QueryLog.objects.create(
-            user=request.user,
-            natural_language_query=natural_language_query,
-            generated_sql=result['sql_query'],
-            database_name=database_name,
-            execution_time=execution_time,
-            row_count=len(df) if df is not None else 0,
-            success=error is None,
-            error_message=error
-        )
+        with timer.span('log'):
+            query_log = QueryLog.objects.create(
+                user=request.user,
+                natural_language_query=natural_language_query,
+                generated_sql=result['sql_query'],
+                database_name=database_name,
+                execution_time=execution_time,
+                row_count=len(rows) if rows is not None else 0,
+                success=error is None,
+                error_message=error,
+                stage_timings=timer.breakdown()
+            )
         
         if error:
             return Response({
@@ -81,40 +154,548 @@ def generate_and_execute_sql(request):
                 'error': error
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Convert DataFrame to JSON
-        data = df.to_dict(orient='records')
-        columns = list(df.columns)
-        
-        return Response({
+        response_data = {
             'success': True,
             'sql_query': result['sql_query'],
             'explanation': result['explanation'],
-            'data': data,
-            'columns': columns,
-            'row_count': len(df),
-            'execution_time': round(execution_time, 3)
-        })
+            **payload,
+            'row_count': len(rows),
+            'execution_time': round(execution_time, 3),
+            'coalesced': shared,
+            'template': bool(result.get('template')),
+            'reused_query_id': result.get('reused_query_id'),
+            'model_tier': result.get('tier'),
+            'summary_rewrite': result.get('rewrite')
+        }
         
+        # Closed by ServerTimingMiddleware once the response body is rendered
+        timer.begin('render')
+        if response_format == 'columnar':
+            return json_response(request, response_data)
+        return Response(response_data)
+        
+    except Throttled:
+        # Answered with a 429 by generate_and_execute_sql
+        raise
     except Exception as e:
         return Response({
             'success': False,
             'error': str(e)
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def generate_sql(natural_language_query, schema, database_name, user=None):
+    """
+    Generate SQL, avoiding the LLM where possible
+
+    An identical earlier question is answered from the generation cache. A
+    matching template has its new literals bound; otherwise, when reuse is
+    enabled, a near-duplicate earlier question has its SQL reused as is.
+    Less similar earlier questions are passed to the model as few-shot
+    examples.
+
+    Only the model call spends one of user's LLM tokens; it raises
+    Throttled when the user or their role is out of tokens.
+    """
+    generation_cache = get_cache('generation')
+    cache_key = coalesce_key(natural_language_query, database_name)
+    cached = generation_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    if getattr(settings, 'QUERY_ENGINE_TEMPLATES', True):
+        result = match_template(natural_language_query, database_name)
+        metrics.count_cache('template', hit=result is not None)
+        if result is not None:
+            return result
+    
+    examples = []
+    if getattr(settings, 'QUERY_ENGINE_SIMILARITY', True):
+        reuse, matches = find_similar(natural_language_query, database_name)
+        metrics.count_cache('similar_reuse', hit=reuse is not None)
+        if reuse is not None:
+            score, query_id, _, sql_query = reuse
+            return {
+                'success': True,
+                'sql_query': sql_query,
+                'explanation': f"Reused the SQL of a near-identical earlier question (similarity {score:.2f}).",
+                'reused_query_id': query_id,
+                'error': None
+            }
+        metrics.count_cache('similar_hint', hit=bool(matches))
+        examples = [(question, sql_query) for _, _, question, sql_query in matches]
+    
+    if user is not None:
+        admission.charge(user)
+    sql_generator = SQLGenerator()
+    result = sql_generator.generate_sql(
+        natural_language_query=natural_language_query,
+        schema=schema,
+        database_name=database_name,
+        examples=examples
+    )
+    if result['success'] and not result.get('validation_error'):
+        generation_cache.set(cache_key, result)
+    return result
+
+def generate_and_execute(natural_language_query, schema, database_name, timer, user):
+    """Generate SQL and run it; this is the unit of work shared by coalesced requests"""
+    with timer.span('llm'):
+        result = generate_sql(natural_language_query, schema, database_name, user)
+    if not result['success']:
+        return {'result': result}
+    
+    start_time = time.time()
+    with timer.span('sql'):
+        columns, rows, error = execute_generated_sql(result, database_name)
+    if error is None:
+        learn_template(natural_language_query, database_name, result)
+    
+    return {
+        'result': result,
+        'columns': columns,
+        'rows': rows,
+        'error': error,
+        'execution_time': time.time() - start_time
+    }
+
+def dry_run_response(result, database_name):
+    """Plan the generated SQL with EXPLAIN QUERY PLAN instead of executing it"""
+    sql_query = result['sql_query']
+    
+    # Reject unusable statements before touching the database
+    error = check_generated_sql(sql_query)
+    if error:
+        return Response({
+            'success': False,
+            'error': error,
+            'sql_query': sql_query
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    db_path = get_database_path(database_name)
+    if not db_path or not os.path.exists(db_path):
+        return Response({
+            'success': False,
+            'error': f"Database file not found: {db_path}"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        plan = plan_query(sql_query, db_path)
+    except sqlite3.Error as e:
+        return Response({
+            'success': False,
+            'error': str(e),
+            'sql_query': sql_query
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response({
+        'success': True,
+        'dry_run': True,
+        'sql_query': sql_query,
+        'explanation': result['explanation'],
+        'plan': plan['plan'],
+        'tables': plan['tables'],
+        'indexes': plan['indexes'],
+        'estimated_rows': plan['estimated_rows']
+    })
+
+def execute_generated_sql(result, database_name, job=None):
+    """
+    Execute a generation result, using the template's prepared statement and bound literals if it has one
+
+    Results are cached until the database file changes; large results are not cached.
+    Anything else is first checked against the schema clone, so invalid SQL
+    is rejected without touching the database. Aggregates that a fresh
+    summary table can answer are rewritten to read it; the rewrite is
+    recorded in result['rewrite'].
+    """
+    template = result.get('template')
+    if template:
+        sql_query, params = template['sql'], template['params']
+    else:
+        sql_query, params = result['sql_query'], ()
+    
+    results_cache = get_cache('results')
+    cache_key = '\x1f'.join([database_name, get_database_version(database_name), sql_query, repr(params)])
+    cached = results_cache.get(cache_key)
+    if cached is not None:
+        columns, rows = cached[0], cached[1]
+        result['rewrite'] = cached[2] if len(cached) > 2 else None
+        return columns, rows, None
+    
+    error = validate_sql(sql_query, database_name, params)
+    if error is not None:
+        return None, None, error
+    
+    rewrite = summary_rewrite(sql_query, database_name)
+    result['rewrite'] = rewrite
+    columns, rows, error = execute_query_rows(
+        rewrite['sql'] if rewrite else sql_query, database_name, job=job, params=params
+    )
+    if error is None and len(rows) <= getattr(settings, 'QUERY_ENGINE_RESULT_CACHE_MAX_ROWS', 10000):
+        results_cache.set(cache_key, (columns, rows, rewrite))
+    return columns, rows, error
+
+def summary_rewrite(sql_query, database_name):
+    """Rewrite to read a summary table if one matches and has absorbed every fact row"""
+    if not getattr(settings, 'QUERY_ENGINE_SUMMARY_REWRITE', True):
+        return None
+    try:
+        planned = plan_rewrite(sql_query, database_name)
+    except Exception as e:
+        logger.warning("Summary rewrite failed: %s", e)
+        return None
+    if planned is None:
+        return None
+    name, rewritten = planned
+    with get_pool(database_name).connection() as conn:
+        fresh = summary_is_fresh(conn, database_name, name)
+    metrics.count_cache('summary', hit=fresh)
+    return {'summary': name, 'sql': rewritten} if fresh else None
+
+def user_can_access(user, database_name):
+    """DatabasePermission check, cached per role and invalidated when permissions change"""
+    if not user.role_id:
+        return False
+    normalized = database_name.lower().replace(' ', '_').replace('-', '')
+    return get_cache('permissions').get_or_set(
+        f"{user.role_id}:{normalized}",
+        lambda: user.can_access_database(normalized)
+    )
+
+def learn_template(natural_language_query, database_name, result):
+    """Parameterize freshly generated SQL that ran successfully so similar questions skip the LLM"""
+    if result.get('template') or not getattr(settings, 'QUERY_ENGINE_TEMPLATES', True):
+        return
+    try:
+        remember_template(natural_language_query, database_name, result)
+    except Exception as e:
+        # Learning is best effort and must never fail the request
+        logger.warning("Could not store query template: %s", e)
+
+def execute_query_rows(sql_query, database_name, job=None, params=()):
+    """
+    Execute SQL query and return column names and raw cursor rows
+
+    The statement runs on the engine chosen for it by
+    QUERY_ENGINE_DATABASE_ENGINES (SQLite unless configured otherwise).
+    """
+    try:
+        db_path = get_database_path(database_name)
+        if not db_path or not os.path.exists(db_path):
+            return None, None, f"Database file not found: {db_path}"
+        
+        _, columns, rows = engines.run(sql_query, database_name, params, job)
+        return columns, rows, None
+    except Exception as e:
+        return None, None, str(e)
+
 def execute_query(sql_query, database_name):
     """Execute SQL query and return results"""
+    import pandas as pd
+    
+    columns, rows, error = execute_query_rows(sql_query, database_name)
+    if error:
+        return None, error
+    return pd.DataFrame.from_records(rows, columns=columns), None
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def submit_query_job(request):
+    """Queue a question for background generation and execution, returning a job id"""
+    natural_language_query = request.data.get('query')
+    database_name = request.data.get('database')
+    
+    if not natural_language_query or not database_name:
+        return Response({
+            'success': False,
+            'error': 'Query and database name are required'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Check if user has access to the database
+    if not user_can_access(request.user, database_name):
+        metrics.count_permission_denial(database_name)
+        return Response({
+            'success': False,
+            'error': 'You do not have access to this database'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    user = request.user
     try:
-        db_path = os.path.join(settings.BASE_DIR, DB_FILE_MAPPING.get(database_name))
+        meta = job_manager.submit(
+            user.pk,
+            natural_language_query,
+            database_name,
+            lambda job: run_query_job(job, user, natural_language_query, database_name),
+            max_in_flight=admission.max_concurrent(user)
+        )
+    except Throttled as e:
+        metrics.count_throttle(e.reason)
+        response = Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = e.retry_after_header()
+        return response
+    
+    response = Response({
+        'success': True,
+        'job': public_job(meta)
+    }, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = f"/api/query/jobs/{meta['id']}/"
+    return response
+
+def run_query_job(job, user, natural_language_query, database_name):
+    """Work function for the job API; runs on a job worker thread"""
+    job.update(stage='generating')
+    schema = get_schema_prompt(database_name)
+    try:
+        result = generate_sql(natural_language_query, schema, database_name, user)
+    except Throttled as e:
+        metrics.count_throttle(e.reason)
+        raise JobFailed(str(e))
+    if not result['success']:
+        raise JobFailed(result['error'])
+    job.check_cancelled()
+    
+    job.update(stage='executing', sql_query=result['sql_query'], explanation=result['explanation'])
+    start_time = time.time()
+    columns, rows, error = execute_generated_sql(result, database_name, job=job)
+    execution_time = time.time() - start_time
+    job.update(summary_rewrite=result.get('rewrite'))
+    job.check_cancelled()
+    if error is None:
+        learn_template(natural_language_query, database_name, result)
+    
+    QueryLog.objects.create(
+        user=user,
+        natural_language_query=natural_language_query,
+        generated_sql=result['sql_query'],
+        database_name=database_name,
+        execution_time=execution_time,
+        row_count=len(rows) if rows is not None else 0,
+        success=error is None,
+        error_message=error
+    )
+    
+    if error:
+        raise JobFailed(error)
+    return {'columns': columns, 'rows': rows, 'execution_time': execution_time}
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def query_job(request, job_id):
+    """
+    GET returns the job's status (and its results once it has succeeded),
+    or a text/event-stream of status changes with ?stream=1. DELETE cancels it.
+    """
+    job_id = str(job_id)
+    meta = job_manager.get(job_id)
+    if meta is None or meta['owner_id'] != request.user.pk:
+        return Response({
+            'success': False,
+            'error': 'Job not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    if request.method == 'DELETE':
+        meta = job_manager.cancel(job_id) or meta
+        return Response({
+            'success': True,
+            'job': public_job(meta)
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    if str(request.GET.get('stream', '')).lower() in ('true', '1', 'yes'):
+        response = StreamingHttpResponse(stream_job_events(job_id), content_type='text/event-stream')
+        # Keep reverse proxies from buffering the event stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
+    response_data = {
+        'success': True,
+        'job': public_job(meta)
+    }
+    if meta['status'] == 'succeeded':
+        payload = job_manager.store.read_result(job_id)
+        if payload is None:
+            return Response({
+                'success': False,
+                'error': 'Job results have expired'
+            }, status=status.HTTP_404_NOT_FOUND)
+        # ?format= is reserved by DRF for renderer selection
+        if request.GET.get('result_format') == 'columnar':
+            response_data.update(payload)
+        else:
+            columns = payload['columns']
+            response_data['columns'] = columns
+            response_data['data'] = [dict(zip(columns, row)) for row in payload['rows']]
+    return Response(response_data)
+
+def stream_job_events(job_id):
+    """Yield a server-sent event whenever the job's status or stage changes"""
+    interval = getattr(settings, 'QUERY_ENGINE_JOB_POLL_INTERVAL', 0.5)
+    deadline = time.monotonic() + getattr(settings, 'QUERY_ENGINE_JOB_STREAM_TIMEOUT', 300)
+    last = None
+    while time.monotonic() < deadline:
+        meta = job_manager.get(job_id)
+        if meta is None:
+            yield 'event: error\ndata: {"error": "Job not found"}\n\n'
+            return
+        current = public_job(meta)
+        if current != last:
+            yield f"event: status\ndata: {json.dumps(current)}\n\n"
+            last = current
+        if meta['status'] in TERMINAL_STATES:
+            return
+        time.sleep(interval)
+    # Clients reconnect or fall back to polling after the stream times out
+    yield 'event: timeout\ndata: {}\n\n'
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def explain_query(request):
+    """
+    Explain generated SQL on demand
+
+    Generation skips the prose explanation in SQL-only mode, so the UI asks
+    for it here only when the user opens the panel. Explanations are cached
+    by database and SQL hash.
+    """
+    sql_query = request.data.get('sql_query')
+    database_name = request.data.get('database')
+    natural_language_query = request.data.get('query')
+    
+    if not sql_query or not database_name:
+        return Response({
+            'success': False,
+            'error': 'SQL query and database name are required'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    if not user_can_access(request.user, database_name):
+        metrics.count_permission_denial(database_name)
+        return Response({
+            'success': False,
+            'error': 'You do not have access to this database'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    explanations = get_cache('explanations')
+    cache_key = sql_hash(sql_query, database_name)
+    explanation = explanations.get(cache_key)
+    if explanation is not None:
+        return Response({
+            'success': True,
+            'explanation': explanation,
+            'cached': True
+        })
+    
+    try:
+        admission.charge(request.user)
+    except Throttled as e:
+        metrics.count_throttle(e.reason)
+        response = Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = e.retry_after_header()
+        return response
+    
+    result = SQLGenerator().explain_sql(
+        sql_query,
+        get_schema_prompt(database_name),
+        database_name,
+        natural_language_query=natural_language_query
+    )
+    if not result['success']:
+        return Response({
+            'success': False,
+            'error': result['error']
+        }, status=status.HTTP_502_BAD_GATEWAY)
+    
+    explanations.set(cache_key, result['explanation'])
+    return Response({
+        'success': True,
+        'explanation': result['explanation'],
+        'cached': False
+    })
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def export_query_results(request):
+    """Stream a logged query or fresh SQL as Arrow IPC or Parquet"""
+    try:
+        query_id = request.data.get('query_id')
+        export_format = request.data.get('format', 'arrow')
+        
+        if export_format not in EXPORT_CONTENT_TYPES:
+            return Response({
+                'success': False,
+                'error': f"Format must be one of: {', '.join(EXPORT_CONTENT_TYPES)}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if query_id:
+            try:
+                query_log = QueryLog.objects.get(id=query_id, user=request.user)
+            except (QueryLog.DoesNotExist, ValueError):
+                return Response({
+                    'success': False,
+                    'error': 'Query not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+            sql_query = query_log.generated_sql
+            database_name = query_log.database_name
+            source = f"{database_name} query {query_log.id}"
+        else:
+            sql_query = request.data.get('sql')
+            database_name = request.data.get('database')
+            source = f"{database_name} export"
+        
+        if not sql_query or not database_name:
+            return Response({
+                'success': False,
+                'error': 'Either query_id or sql and database are required'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Check if user has access to the database
+        if not user_can_access(request.user, database_name):
+            return Response({
+                'success': False,
+                'error': 'You do not have access to this database'
+            }, status=status.HTTP_403_FORBIDDEN)
+        
+        error = check_generated_sql(sql_query)
+        if error:
+            return Response({
+                'success': False,
+                'error': error
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        db_path = get_database_path(database_name)
         if not db_path or not os.path.exists(db_path):
-            return None, f"Database file not found: {db_path}"
+            return Response({
+                'success': False,
+                'error': 'Database file not found'
+            }, status=status.HTTP_404_NOT_FOUND)
         
-        conn = sqlite3.connect(db_path)
-        df = pd.read_sql_query(sql_query, conn)
-        conn.close()
+        # The response body is produced after the view returns, possibly on another thread
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            chunks = stream_export(
+                conn, sql_query, export_format,
+                budget=getattr(settings, 'QUERY_ENGINE_SQL_TIME_BUDGET', None),
+                sample_rows=getattr(settings, 'QUERY_ENGINE_EXPORT_PROFILE_ROWS', EXPORT_PROFILE_ROWS)
+            )
+        except (sqlite3.Error, BudgetExceeded) as e:
+            return Response({
+                'success': False,
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        response = StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{export_filename(source, export_format)}"'
+        return response
         
-        return df, None
     except Exception as e:
-        return None, str(e)
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -128,7 +709,7 @@ def get_database_schema(request):
         }, status=status.HTTP_400_BAD_REQUEST)
     
     # Check if user has access
-    if not request.user.can_access_database(database_name.lower().replace(' ', '_').replace('-', '')):
+    if not user_can_access(request.user, database_name):
         return Response({
             'success': False,
             'error': 'You do not have access to this database'
@@ -140,23 +721,67 @@ def get_database_schema(request):
             'error': 'Invalid database name'
         }, status=status.HTTP_400_BAD_REQUEST)
     
-    return Response({
-        'success': True,
-        'schema': DATABASES[database_name]
-    })
+    return conditional_response(
+        request,
+        f'"{get_schema_hash(database_name)}"',
+        lambda: {
+            'success': True,
+            'schema': get_public_schema(database_name)
+        }
+    )
+
+def conditional_response(request, etag, build_payload):
+    """
+    Answer with 304 Not Modified when the client already holds this ETag
+
+    The payload is only built on a miss. Responses are cacheable by the
+    browser but must be revalidated on every use.
+    """
+    client_etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    client_etags = [client_etag.removeprefix('W/') for client_etag in client_etags]
+    
+    if etag in client_etags or '*' in client_etags:
+        metrics.count_cache('etag', hit=True)
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        metrics.count_cache('etag', hit=False)
+        response = Response(build_payload())
+    
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_query_history(request):
+    """
+    The user's latest queries, or with ?search= their best matches for
+    the text; search results are paged with ?cursor=<next_cursor>
+    """
     limit = int(request.GET.get('limit', 10))
     database = request.GET.get('database')
+    search = request.GET.get('search', '').strip()
+    next_cursor = None
     
-    queries = QueryLog.objects.filter(user=request.user)
-    
-    if database:
-        queries = queries.filter(database_name=database)
-    
-    queries = queries[:limit]
+    if search:
+        limit = max(1, min(limit, getattr(settings, 'QUERY_ENGINE_HISTORY_SEARCH_MAX_LIMIT', 100)))
+        try:
+            queries, next_cursor = search_history(
+                request.user, search, database=database, limit=limit, cursor=request.GET.get('cursor')
+            )
+        except InvalidCursor as e:
+            return Response({
+                'success': False,
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        queries = QueryLog.objects.filter(user=request.user)
+        
+        if database:
+            queries = queries.filter(database_name=database)
+        
+        queries = queries[:limit]
     
     history = []
     for query in queries:
@@ -173,7 +798,8 @@ def get_query_history(request):
     
     return Response({
         'success': True,
-        'history': history
+        'history': history,
+        'next_cursor': next_cursor
     })
 
 @api_view(['GET'])
@@ -188,37 +814,96 @@ def get_database_stats(request):
         }, status=status.HTTP_400_BAD_REQUEST)
     
     # Check if user has access
-    if not request.user.can_access_database(database_name.lower().replace(' ', '_').replace('-', '')):
+    if not user_can_access(request.user, database_name):
         return Response({
             'success': False,
             'error': 'You do not have access to this database'
         }, status=status.HTTP_403_FORBIDDEN)
     
     try:
-        db_path = os.path.join(settings.BASE_DIR, DB_FILE_MAPPING.get(database_name))
-        if not os.path.exists(db_path):
+        db_path = get_database_path(database_name)
+        if not db_path or not os.path.exists(db_path):
             return Response({
                 'success': False,
                 'error': 'Database file not found'
             }, status=status.HTTP_404_NOT_FOUND)
         
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        stats = {}
-        for table_name in DATABASES[database_name]['tables'].keys():
-            cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-            count = cursor.fetchone()[0]
-            stats[table_name] = count
+        def build_stats():
+            stats = {}
+            with get_pool(database_name).connection() as conn:
+                cursor = conn.cursor()
+                for table_name in DATABASES[database_name]['tables'].keys():
+                    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+                    count = cursor.fetchone()[0]
+                    stats[table_name] = count
+            
+            return {
+                'success': True,
+                'stats': stats,
+                'memory_copy': memory_copy_stats().get(database_name)
+            }
         
-        conn.close()
+        # Row counts only change when the file does, so the ETag covers both
+        version = f"{get_schema_hash(database_name)}:{get_database_version(database_name)}"
+        etag = f'"{hashlib.sha1(version.encode()).hexdigest()}"'
         
+        return conditional_response(request, etag, build_stats)
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def workload_analytics(request):
+    """
+    Workload report for administrators: latency percentiles, failure rates,
+    the slowest and most failing SQL, and per-user volumes
+
+    ?window= is one of 24h (default), 7d or 30d. Rows logged since the last
+    refresh are folded into the rollups first, up to a bounded number;
+    `manage.py refresh_analytics` keeps the backlog short.
+    """
+    if not (request.user.role_id and request.user.role.name == 'admin'):
+        return Response({
+            'success': False,
+            'error': 'Only administrators can view workload analytics'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    window = request.GET.get('window', '24h')
+    if window not in WINDOWS:
+        return Response({
+            'success': False,
+            'error': f"window must be one of: {', '.join(WINDOWS)}"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 10)), 100))
+    except ValueError:
+        return Response({
+            'success': False,
+            'error': 'limit must be an integer'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        refresh_rollups(max_rows=getattr(settings, 'QUERY_ENGINE_ANALYTICS_REFRESH_MAX_ROWS', 50000))
+        report = workload_report(window, request.GET.get('database') or None, limit)
         return Response({
             'success': True,
-            'stats': stats
+            **report,
+            'pending_rows': pending_rows()
         })
     except Exception as e:
         return Response({
             'success': False,
             'error': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def prometheus_metrics(request):
+    """Expose query engine metrics in the Prometheus text format"""
+    token = getattr(settings, 'METRICS_AUTH_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    
+    body, content_type = metrics.render_latest()
+    return HttpResponse(body, content_type=content_type)
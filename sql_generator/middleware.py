@@ -1,5 +1,6 @@
 from django.utils.cache import add_never_cache_headers
 from django.utils.deprecation import MiddlewareMixin
+from query_engine.timing import RequestTimer
 
 class NoCacheMiddleware(MiddlewareMixin):
     """Middleware to prevent caching of sensitive pages"""
@@ -7,8 +8,31 @@ class NoCacheMiddleware(MiddlewareMixin):
     def process_response(self, request, response):
         # Add no-cache headers to dashboard and API endpoints
         if request.path.startswith('/dashboard') or request.path.startswith('/api'):
+            # Responses validated with an ETag set their own revalidation policy
+            if response.has_header('ETag'):
+                return response
             add_never_cache_headers(response)
             response['Cache-Control'] = 'no-cache, no-store, must-revalidate, private'
             response['Pragma'] = 'no-cache'
             response['Expires'] = '0'
-        return response
\ No newline at end of file
+        return response
+
+class ServerTimingMiddleware(MiddlewareMixin):
+    """Attach a stage timer to API requests and report it in a Server-Timing header"""
+    
+    def process_request(self, request):
+        if request.path.startswith('/api'):
+            request.timer = RequestTimer()
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = getattr(request, 'timer', None)
+        if timer is not None:
+            # Ended by the view once DRF has authenticated the request
+            timer.begin('auth')
+    
+    def process_response(self, request, response):
+        timer = getattr(request, 'timer', None)
+        if timer is not None:
+            timer.finish()
+            response['Server-Timing'] = timer.header_value()
+        return response
@@ -64,6 +64,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'sql_generator.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -160,4 +161,191 @@ CORS_ALLOWED_ORIGINS = [
 CORS_ALLOW_CREDENTIALS = True
 
 # OpenAI API Key
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
\ No newline at end of file
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# Query engine
+QUERY_ENGINE_POOL_SIZE = 4  # read-only connections per target database
+QUERY_ENGINE_POOL_TIMEOUT = 10  # seconds to wait for a free connection
+QUERY_ENGINE_SQL_TIME_BUDGET = 30  # seconds before a running statement is interrupted
+QUERY_ENGINE_EXPORT_PROFILE_ROWS = 100000  # rows sampled to type Arrow/Parquet export columns
+
+# Query engine caches. Each namespace lives in one of QUERY_ENGINE_CACHES:
+# 'locmem' (per process), 'sqlite' (a file shared by the workers on one
+# machine) or 'django' (a Django cache alias, for Redis/memcached).
+# MAX_BYTES bounds the serialized size; ttl is in seconds (None = no expiry).
+# Bump QUERY_ENGINE_CACHE_VERSION to drop every entry after a format change.
+QUERY_ENGINE_CACHE_VERSION = 1
+QUERY_ENGINE_CACHES = {
+    'local': {'BACKEND': 'locmem', 'MAX_BYTES': 16 * 1024 * 1024},
+    'shared': {
+        'BACKEND': 'sqlite',
+        'PATH': os.getenv('QUERY_ENGINE_CACHE_PATH', BASE_DIR / 'query_cache.sqlite3'),
+        'MAX_BYTES': 256 * 1024 * 1024,
+    },
+}
+QUERY_ENGINE_CACHE_NAMESPACES = {
+    'generation': {'cache': 'shared', 'ttl': 24 * 3600},
+    'results': {'cache': 'shared', 'ttl': 300},
+    'schema': {'cache': 'local', 'ttl': None},
+    'permissions': {'cache': 'shared', 'ttl': 300},
+    'routing': {'cache': 'shared', 'ttl': 7 * 24 * 3600},
+    'explanations': {'cache': 'shared', 'ttl': 7 * 24 * 3600},
+    # Must be shared across workers for cross-worker coalescing
+    'singleflight': {'cache': 'shared', 'ttl': None},
+}
+QUERY_ENGINE_RESULT_CACHE_MAX_ROWS = 10000  # larger results are not cached
+
+# Identical concurrent questions are coalesced into one generation and
+# execution, coordinated across workers through the 'singleflight' cache.
+QUERY_ENGINE_COALESCE_WAIT = 120  # seconds a follower waits for the leader
+QUERY_ENGINE_COALESCE_RESULT_TTL = 2  # seconds the leader's result stays shareable
+
+# Simple questions (one table, no join/grouping/ranking words) go to the
+# fast tier; its SQL is validated against the database and the question is
+# escalated to the strong tier if that fails. Prices are USD per million
+# tokens and only feed the cost metric.
+QUERY_ENGINE_MODEL_ROUTING = True
+QUERY_ENGINE_MODEL_TIERS = {
+    'fast': {'model': 'gpt-4o-mini', 'max_tokens': 500, 'prompt_cost': 0.15, 'completion_cost': 0.60},
+    'strong': {'model': 'gpt-4o', 'max_tokens': 1000, 'prompt_cost': 2.50, 'completion_cost': 10.00},
+}
+
+# Opt-in SQL-only mode: the model returns just {"sql": ...} (JSON output,
+# tight token cap) and the prose explanation is left out of /execute/ and
+# job results, to be generated on demand by /api/query/explain/ with the
+# explain tier, cached by SQL hash. Only enable it when every client
+# fetches explanations that way, as the dashboard does.
+QUERY_ENGINE_SQL_ONLY = False
+QUERY_ENGINE_SQL_ONLY_MAX_TOKENS = 400
+QUERY_ENGINE_EXPLAIN_TIER = 'fast'
+QUERY_ENGINE_EXPLAIN_MAX_TOKENS = 200
+
+# Generated SQL is compiled against an empty in-memory copy of the target
+# schema before it runs; rejected SQL is sent back to the model with the
+# error at most this many times.
+QUERY_ENGINE_SQL_REPAIR_ATTEMPTS = 1
+
+# Aggregates over the tables of a summary declared in DATABASES are
+# rewritten to read the summary table, when `manage.py refresh_summaries`
+# has absorbed every fact row. Run that command after loading new data.
+QUERY_ENGINE_SUMMARY_REWRITE = True
+
+# LLM call resilience. Each attempt gets its own deadline within the total
+# budget; timeouts, connection errors, 429s and 5xx are retried with full
+# jitter backoff. With hedging on, a duplicate request is sent once an
+# attempt outlives the model's p95 latency (after enough samples) and the
+# first response wins. The circuit opens after consecutive failures and
+# lets one probe through after the reset period.
+QUERY_ENGINE_LLM_ATTEMPT_TIMEOUT = 30  # seconds
+QUERY_ENGINE_LLM_TOTAL_TIMEOUT = 60  # seconds, including retries
+QUERY_ENGINE_LLM_MAX_RETRIES = 2
+QUERY_ENGINE_LLM_BACKOFF_BASE = 0.5  # seconds, doubled per retry
+QUERY_ENGINE_LLM_BACKOFF_MAX = 8
+QUERY_ENGINE_LLM_HEDGE = False
+QUERY_ENGINE_LLM_HEDGE_MIN_SAMPLES = 20
+QUERY_ENGINE_LLM_BREAKER_THRESHOLD = 5  # consecutive failures
+QUERY_ENGINE_LLM_BREAKER_RESET = 30  # seconds before a probe is allowed
+
+# Successful generations are parameterized into templates; questions that
+# match a template's skeleton get their literals bound without an LLM call.
+QUERY_ENGINE_TEMPLATES = True
+QUERY_ENGINE_TEMPLATE_SCAN_LIMIT = 500  # templates tried per question, most used first
+
+# Near-duplicate questions are found with a TF-IDF index over successful
+# QueryLog entries. Above the hint threshold an earlier question becomes a
+# few-shot example in the prompt. With QUERY_ENGINE_SIMILARITY_REUSE, an
+# earlier question above the reuse threshold with the same words and
+# literals has its SQL reused without calling the model.
+QUERY_ENGINE_SIMILARITY = True
+QUERY_ENGINE_SIMILARITY_REUSE = False
+QUERY_ENGINE_SIMILARITY_REUSE_THRESHOLD = 0.9  # cosine similarity
+QUERY_ENGINE_SIMILARITY_HINT_THRESHOLD = 0.3
+QUERY_ENGINE_SIMILARITY_EXAMPLES = 3  # few-shot examples per prompt
+QUERY_ENGINE_SIMILARITY_MAX_ENTRIES = 2000  # indexed questions per database
+QUERY_ENGINE_SIMILARITY_REFRESH = 5  # seconds between index refreshes
+
+# Admission control for /api/query/execute/. Each request that reaches the
+# model spends one token from the user's bucket (and the role's shared bucket
+# when configured); cache, template and reuse hits are free. A user may only
+# have max_concurrent requests in flight, and everything then queues fairly
+# for one of the global execution slots. Limits are per worker.
+QUERY_ENGINE_DEFAULT_LIMITS = {
+    'llm_per_minute': 10,
+    'llm_burst': 5,
+    'max_concurrent': 1,
+}
+QUERY_ENGINE_ROLE_LIMITS = {
+    'admin': {'llm_per_minute': 60, 'llm_burst': 20, 'max_concurrent': 4},
+    'developer': {'llm_per_minute': 30, 'llm_burst': 10, 'max_concurrent': 2},
+    'analyst': {
+        'llm_per_minute': 20, 'llm_burst': 10, 'max_concurrent': 2,
+        'role_llm_per_minute': 120, 'role_llm_burst': 30,
+    },
+    'viewer': {'llm_per_minute': 10, 'llm_burst': 5, 'max_concurrent': 1},
+}
+QUERY_ENGINE_MAX_CONCURRENT_EXECUTIONS = 8  # global execution slots
+QUERY_ENGINE_QUEUE_TIMEOUT = 5  # seconds to wait for a slot before returning 429
+
+# Background jobs (/api/query/jobs/). Metadata and results are spilled to
+# QUERY_ENGINE_JOB_DIR, which must be shared by all workers so any of them
+# can answer status requests and cancel a job.
+QUERY_ENGINE_JOB_DIR = os.getenv('QUERY_ENGINE_JOB_DIR', BASE_DIR / 'query_jobs')
+QUERY_ENGINE_JOB_WORKERS = 2  # job threads per worker process
+QUERY_ENGINE_JOB_TTL = 3600  # seconds finished jobs and their results are kept
+QUERY_ENGINE_JOB_TIMEOUT = 1800  # seconds a job may take from submit to finish before it fails
+# Jobs waiting for a job thread per worker; further submits get a 429. Each
+# user may also have at most their role's max_concurrent jobs unfinished.
+QUERY_ENGINE_JOB_MAX_QUEUED = 20
+QUERY_ENGINE_JOB_STREAM_TIMEOUT = 300  # seconds a progress stream stays open
+
+# When set, /metrics requires "Authorization: Bearer <token>"
+METRICS_AUTH_TOKEN = os.getenv('METRICS_AUTH_TOKEN')
+
+# 'thread' runs SQL on pooled connections in the request thread; 'process'
+# runs it in a pool of worker processes so heavy statements use other cores.
+QUERY_ENGINE_EXECUTION_BACKEND = os.getenv('QUERY_ENGINE_EXECUTION_BACKEND', 'thread')
+QUERY_ENGINE_PROCESS_POOL_SIZE = 2  # worker processes per web worker
+QUERY_ENGINE_PROCESS_TASK_TIMEOUT = 30  # seconds before a statement is abandoned
+QUERY_ENGINE_PROCESS_MAX_TASKS_PER_CHILD = 500  # statements before a worker is replaced
+
+# Target databases listed here are copied into a shared-cache in-memory
+# database (per web worker) and pooled connections read the copy instead of
+# the file. The copy is reloaded when the file changes, checked at most once
+# per interval. Files above the size limit keep being served from disk. The
+# 'process' execution backend still reads the files.
+QUERY_ENGINE_IN_MEMORY_DATABASES = [
+    name.strip() for name in os.getenv('QUERY_ENGINE_IN_MEMORY_DATABASES', '').split(',') if name.strip()
+]
+QUERY_ENGINE_IN_MEMORY_CHECK_INTERVAL = 1  # seconds
+QUERY_ENGINE_IN_MEMORY_MAX_BYTES = 512 * 1024 * 1024
+
+# Execution engines. QUERY_ENGINE_DATABASE_ENGINES maps a database to
+# 'sqlite', 'duckdb' (a columnar snapshot of the file, kept in
+# QUERY_ENGINE_COLUMNAR_DIR and rebuilt in the background when the file
+# changes; needs the duckdb package) or 'auto', which sends aggregates and
+# joins reading at least QUERY_ENGINE_COLUMNAR_MIN_ROWS rows to duckdb.
+# Statements duckdb can't run fall back to sqlite. A dotted path to an
+# ExecutionEngine subclass also works. Compare the engines with
+# `manage.py benchmark_engines`.
+QUERY_ENGINE_DEFAULT_ENGINE = os.getenv('QUERY_ENGINE_DEFAULT_ENGINE', 'sqlite')
+QUERY_ENGINE_DATABASE_ENGINES = {}
+QUERY_ENGINE_COLUMNAR_DIR = BASE_DIR / 'databases' / 'columnar'
+QUERY_ENGINE_COLUMNAR_MIN_ROWS = 100000
+QUERY_ENGINE_COLUMNAR_THREADS = None  # DuckDB worker threads; None uses every core
+
+# Largest page of /api/query/history/?search= results (an FTS5 index over
+# QueryLog, ranked with bm25)
+QUERY_ENGINE_HISTORY_SEARCH_MAX_LIMIT = 100
+
+# /api/query/analytics/ reads hourly and daily rollups of QueryLog. Each
+# request first folds in up to REFRESH_MAX_ROWS newly logged rows; run
+# `manage.py refresh_analytics` periodically so requests rarely have to.
+QUERY_ENGINE_ANALYTICS_REFRESH_MAX_ROWS = 50000
+QUERY_ENGINE_ANALYTICS_BATCH_SIZE = 5000  # rows per rollup transaction
+QUERY_ENGINE_ANALYTICS_RETENTION_DAYS = 90  # rollups pruned by refresh_analytics
+
+# Work done in AppConfig.ready() before a worker serves traffic.
+# Any of: 'schema_cache', 'memory_copies', 'connection_pool', 'process_pool'
+QUERY_ENGINE_WARMUP = [
+    step.strip() for step in os.getenv('QUERY_ENGINE_WARMUP', '').split(',') if step.strip()
+]
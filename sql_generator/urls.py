@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from authentication.views import login_page, dashboard_page
+from query_engine.views import prometheus_metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -9,4 +10,5 @@ urlpatterns = [
     path('', login_page, name='home'),
     path('login/', login_page, name='login'),
     path('dashboard/', dashboard_page, name='dashboard'),
+    path('metrics', prometheus_metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -4,6 +4,8 @@ let accessToken = localStorage.getItem('access_token');
 let currentDatabase = null;
 let queryResults = null;
 let sessionCheckInterval = null;
+let historyCursor = null;
+let historySearchTimer = null;
 
 // Example queries for each database
 const exampleQueries = {
@@ -134,7 +136,10 @@ function setupEventListeners() {
     document.getElementById('databaseSelect').addEventListener('change', handleDatabaseChange);
     document.getElementById('generateBtn').addEventListener('click', generateAndExecuteSQL);
     document.getElementById('copySqlBtn').addEventListener('click', copySQLToClipboard);
+    document.getElementById('sqlExplanation').addEventListener('toggle', loadExplanation);
     document.getElementById('exportCsvBtn').addEventListener('click', exportToCSV);
+    document.getElementById('historySearch').addEventListener('input', handleHistorySearch);
+    document.getElementById('historyMoreBtn').addEventListener('click', () => loadQueryHistory(currentDatabase, true));
     
     // Intercept browser back button
     window.addEventListener('popstate', async (event) => {
@@ -414,6 +419,7 @@ async function generateAndExecuteSQL() {
         const data = await response.json();
         
         if (data.success) {
+            data.query = query;
             displayResults(data);
             showToast('Query executed successfully!', 'success');
         } else {
@@ -443,14 +449,11 @@ function displayResults(data) {
         Prism.highlightElement(sqlQuery);
     }
     
-    // Display explanation
+    // Explanation panel; the text is fetched the first time it is opened
     const explanation = document.getElementById('sqlExplanation');
-    if (data.explanation) {
-        explanation.textContent = `💡 ${data.explanation}`;
-        explanation.style.display = 'block';
-    } else {
-        explanation.style.display = 'none';
-    }
+    explanation.open = false;
+    explanation.dataset.loaded = data.explanation ? 'true' : '';
+    document.getElementById('sqlExplanationText').textContent = data.explanation || '';
     
     // Display statistics
     document.getElementById('resultStats').textContent = 
@@ -463,6 +466,55 @@ function displayResults(data) {
     document.getElementById('resultsSection').scrollIntoView({ behavior: 'smooth' });
 }
 
+// Load the explanation for the current query when the panel is opened
+async function loadExplanation() {
+    const explanation = document.getElementById('sqlExplanation');
+    const text = document.getElementById('sqlExplanationText');
+    if (!explanation.open || explanation.dataset.loaded || !queryResults) {
+        return;
+    }
+    explanation.dataset.loaded = 'true';
+    text.textContent = 'Loading explanation...';
+    const sqlQuery = queryResults.sql_query;
+    
+    try {
+        const token = localStorage.getItem('access_token');
+        const response = await fetch(`${API_BASE_URL}/query/explain/`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${token}`,
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                sql_query: sqlQuery,
+                database: currentDatabase,
+                query: queryResults.query
+            })
+        });
+        
+        if (response.status === 401) {
+            clearSessionAndRedirect();
+            return;
+        }
+        
+        const data = await response.json();
+        if (!queryResults || queryResults.sql_query !== sqlQuery) {
+            // A newer query replaced the results while this was loading
+            return;
+        }
+        if (data.success) {
+            text.textContent = data.explanation;
+        } else {
+            text.textContent = data.error || 'Failed to load explanation';
+            explanation.dataset.loaded = '';
+        }
+    } catch (error) {
+        console.error('Error loading explanation:', error);
+        text.textContent = 'Failed to load explanation';
+        explanation.dataset.loaded = '';
+    }
+}
+
 // Display result table
 function displayResultTable(columns, data) {
     const table = document.getElementById('resultsTable');
@@ -551,8 +603,14 @@ function exportToCSV() {
     showToast('Results exported successfully!', 'success');
 }
 
-// Load query history with session validation
-async function loadQueryHistory(database) {
+// Search history as the user types, once they pause
+function handleHistorySearch() {
+    clearTimeout(historySearchTimer);
+    historySearchTimer = setTimeout(() => loadQueryHistory(currentDatabase), 250);
+}
+
+// Load query history with session validation; append loads the next page of search results
+async function loadQueryHistory(database, append = false) {
     try {
         const token = localStorage.getItem('access_token');
         if (!token) {
@@ -560,7 +618,16 @@ async function loadQueryHistory(database) {
             return;
         }
         
-        const response = await fetch(`${API_BASE_URL}/query/history/?database=${encodeURIComponent(database)}&limit=5`, {
+        const search = document.getElementById('historySearch').value.trim();
+        let url = `${API_BASE_URL}/query/history/?database=${encodeURIComponent(database)}&limit=5`;
+        if (search) {
+            url += `&search=${encodeURIComponent(search)}`;
+            if (append && historyCursor) {
+                url += `&cursor=${encodeURIComponent(historyCursor)}`;
+            }
+        }
+        
+        const response = await fetch(url, {
             headers: {
                 'Authorization': `Bearer ${token}`
             }
@@ -576,8 +643,15 @@ async function loadQueryHistory(database) {
         
         const data = await response.json();
         
-        if (data.success && data.history.length > 0) {
-            displayQueryHistory(data.history);
+        // A newer search may have started while this one was in flight
+        if (search !== document.getElementById('historySearch').value.trim()) {
+            return;
+        }
+        
+        if (data.success && (data.history.length > 0 || search)) {
+            displayQueryHistory(data.history, append);
+            historyCursor = data.next_cursor;
+            document.getElementById('historyMoreBtn').style.display = historyCursor ? 'inline-block' : 'none';
             document.getElementById('historySection').style.display = 'block';
         } else {
             document.getElementById('historySection').style.display = 'none';
@@ -588,9 +662,11 @@ async function loadQueryHistory(database) {
 }
 
 // Display query history
-function displayQueryHistory(history) {
+function displayQueryHistory(history, append = false) {
     const historyDiv = document.getElementById('queryHistory');
-    historyDiv.innerHTML = '';
+    if (!append) {
+        historyDiv.innerHTML = '';
+    }
     
     history.forEach((item, index) => {
         const historyItem = document.createElement('div');